@@ -3,9 +3,10 @@ USE patient_data;
 -- Drop the existing tables if they exist
 DROP TABLE IF EXISTS test_results;
 
--- Create the unified table
+-- Create the unified table, the database gives the ids
+-- (tables made before: ALTER TABLE test_results MODIFY id INT NOT NULL AUTO_INCREMENT)
 CREATE TABLE test_results (
-    id INT PRIMARY KEY,
+    id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
     first_name VARCHAR(255) NOT NULL,
     last_name VARCHAR(255) NOT NULL,
     loinc_num VARCHAR(50) NOT NULL,
@@ -15,6 +16,22 @@ CREATE TABLE test_results (
     transaction_time DATETIME
 );
 
+-- Bitemporal lookups: one patient LOINC by valid time, versions by transaction time
+CREATE INDEX idx_test_results_bitemporal
+    ON test_results (first_name, last_name, loinc_num, valid_start_time, transaction_time);
+
+-- Rows of a patient LOINC added after an id: bitemporal index catch up
+CREATE INDEX idx_test_results_patient_id
+    ON test_results (first_name, last_name, loinc_num, id);
+
+-- Population scans: one LOINC of all the patients by valid time
+CREATE INDEX idx_test_results_loinc_valid
+    ON test_results (loinc_num, valid_start_time);
+
+-- Rows recorded since a time: snapshot deltas, ingestion dedup, GUI pick list refresh
+CREATE INDEX idx_test_results_transaction
+    ON test_results (transaction_time);
+
 -- Insert data directly into the unified table
 -- INSERT INTO test_results (id, first_name, last_name, loinc_num, value, unit, valid_start_time, transaction_time) VALUES
 -- (1, 'Eyal', 'Rothman', '11218-5', 4500, 'cells/ml', '2018-05-17 13:11:00', '2018-05-27 10:00:00'),
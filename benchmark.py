@@ -0,0 +1,236 @@
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import statistics
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from database import PatientData
+from dss_engine import DSSEngine
+from insert_csv_file import CSV_COLUMNS, CSV_TIME_FORMAT, ingest_csv
+from knowlege_base import KnowledgeBase
+from metrics import REGISTRY
+from parallel import ShardedExecutor
+from result_cache import ResultCache
+from storage import open_storage
+
+
+# LOINC -> (unit, values(rng, size)), the concepts of project_db.csv and the ones the knowledge base grades
+def _uniform(low, high, decimals=1):
+    return lambda rng, size: np.round(rng.uniform(low, high, size), decimals).astype(str)
+
+
+def _choice(options):
+    return lambda rng, size: rng.choice(options, size)
+
+
+CONCEPTS = {
+    '11218-5': ('cells/ml', _uniform(2000, 15000, 0)),
+    '12181-4': ('mg/dl', _uniform(6, 18)),
+    '30313-1': ('gr/dl', _uniform(6, 18)),
+    '39106-0': ('degrees-celsious', _uniform(36, 41.5)),
+    '76477-9': ('BPM', _uniform(50, 130, 0)),
+    '2055-2': ('mmHg', _uniform(80, 160, 0)),
+    '20252-3': ('mm-Hg', _uniform(50, 100, 0)),
+    '14743-9': ('none', _uniform(70, 180, 0)),
+    'chills': ('none', _choice(['None', 'Shaking', 'Rigor'])),
+    'skin-look': ('none', _choice(['Erythema', 'Vesiculation', 'Desquamation', 'Exfoliation'])),
+    'allergic-state': ('none', _choice(['Edema', 'Bronchospasm', 'Severe-Bronchospasm', 'Anaphylactic-Shock'])),
+}
+FIRST_VALID_TIME = pd.Timestamp('2018-05-01 00:00')
+
+
+# Synthetic test results in the CSV format of project_db.csv:
+# patients x loincs concepts, measurements per concept every few hours, each measurement with
+# versions versions (the first one recorded a day after it was taken, every correction a day later).
+# LOINCs beyond the known concepts are numeric 'SYN-n' codes.
+def generate_test_results(patients, loincs, versions, measurements=10, seed=0):
+    rng = np.random.default_rng(seed)
+    loinc_nums = list(CONCEPTS)[:loincs] + [f'SYN-{i}' for i in range(loincs - len(CONCEPTS))]
+
+    patient_ids = np.repeat(np.arange(patients), len(loinc_nums) * measurements * versions)
+    loinc_ids = np.tile(np.repeat(np.arange(len(loinc_nums)), measurements * versions), patients)
+    measurement_ids = np.tile(np.repeat(np.arange(measurements), versions), patients * len(loinc_nums))
+    version_ids = np.tile(np.arange(versions), patients * len(loinc_nums) * measurements)
+    size = len(version_ids)
+
+    # Measurements are 6 hours apart with a random minute offset, the same for all the versions
+    offsets = rng.integers(0, 6 * 60, patients * len(loinc_nums) * measurements)
+    valid_times = (FIRST_VALID_TIME + pd.to_timedelta(measurement_ids * 6 * 60 + np.repeat(offsets, versions), unit='m'))
+    transaction_times = valid_times + pd.to_timedelta(1 + version_ids, unit='D')
+
+    values = np.empty(size, dtype=object)
+    units = np.empty(size, dtype=object)
+    for i, loinc_num in enumerate(loinc_nums):
+        rows = loinc_ids == i
+        unit, make_values = CONCEPTS.get(loinc_num, ('none', _uniform(0, 100)))
+        values[rows] = make_values(rng, rows.sum())
+        units[rows] = unit
+
+    test_results = pd.DataFrame({
+        'first_name': np.char.add('First', patient_ids.astype(str)),
+        'last_name': np.char.add('Last', patient_ids.astype(str)),
+        'loinc_num': np.asarray(loinc_nums, dtype=object)[loinc_ids],
+        'value': values,
+        'unit': units,
+        'valid_start_time': valid_times,
+        'transaction_time': transaction_times,
+    })
+    # Rows come in transaction time order, the way they are recorded
+    return test_results.sort_values('transaction_time', kind='stable').reset_index(drop=True)
+
+
+def write_csv(test_results, csv_file):
+    csv = test_results.rename(columns={column: header for header, column in CSV_COLUMNS.items()})
+    for column in ('Valid start time', 'Transaction time'):
+        csv[column] = csv[column].dt.strftime(CSV_TIME_FORMAT)
+    csv.to_csv(csv_file, index=False)
+
+
+def timed(function, runs=1):
+    timings = []
+    result = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    return timings, result
+
+
+def summary(timings, **extra):
+    return dict({
+        'runs': len(timings),
+        'total_s': sum(timings),
+        'mean_s': statistics.mean(timings),
+        'median_s': statistics.median(timings),
+        'min_s': min(timings),
+        'max_s': max(timings),
+    }, **extra)
+
+
+# cache - keep the engine result cache on (off by default, the scenarios time the uncached queries)
+# processes - also time the population scenarios sharded on this many worker processes
+def run_benchmark(patients=100, loincs=11, versions=2, measurements=10, queries=200, runs=3, seed=0, workdir=None,
+                  cache=False, processes=None):
+    workdir = workdir or tempfile.mkdtemp(prefix='dss-benchmark-')
+    csv_file = os.path.join(workdir, 'test_results.csv')
+    database_file = os.path.join(workdir, 'patient_data.db')
+    knowledge_base_file = os.path.join(workdir, 'kb.db')
+    for path in (database_file, knowledge_base_file):
+        if os.path.exists(path):
+            os.remove(path)
+
+    REGISTRY.reset()
+    test_results = generate_test_results(patients, loincs, versions, measurements, seed)
+    write_csv(test_results, csv_file)
+    patient_data = PatientData(pool=open_storage('sqlite', database_file))
+    knowlege_base = KnowledgeBase(pool=open_storage('sqlite', knowledge_base_file, knowledge_base=True))
+    engine = DSSEngine(patient_data, knowlege_base, cache=None if cache else ResultCache(max_entries=0))
+    scenarios = {}
+
+    timings, rows = timed(lambda: ingest_csv(patient_data, csv_file))
+    scenarios['ingestion'] = summary(timings, rows=rows, rows_per_s=rows / timings[0])
+
+    # Random measurements asked about at a random transaction time after they were first recorded
+    rng = np.random.default_rng(seed)
+    sample = test_results.iloc[rng.integers(0, len(test_results), queries)]
+    physician_times = sample['transaction_time'] + pd.to_timedelta(rng.integers(0, 3 * 24 * 60, queries), unit='m')
+    specific_queries = [
+        (row.first_name, row.last_name, row.loinc_num,
+         row.valid_start_time.strftime('%Y-%m-%d'), row.valid_start_time.strftime('%H:%M'),
+         physician_time.strftime('%Y-%m-%d'), physician_time.strftime('%H:%M'))
+        for row, physician_time in zip(sample.itertuples(), physician_times)
+    ]
+    timings = [timed(lambda: engine.retrieval_question(query))[0][0] for query in specific_queries]
+    scenarios['retrieval_question'] = summary(timings)
+
+    last_valid_time = test_results['valid_start_time'].max()
+    history_queries = [
+        (row.first_name, row.last_name, row.loinc_num, FIRST_VALID_TIME.strftime('%Y-%m-%d'), '00:00',
+         last_valid_time.strftime('%Y-%m-%d'), '23:59')
+        for row in sample.itertuples()
+    ]
+    timings, rows = [], 0
+    for query in history_queries:
+        (timing,), result = timed(lambda: engine.retrieval_history_question(query))
+        timings.append(timing)
+        rows += len(result)
+    scenarios['retrieval_history_question'] = summary(timings, rows=rows)
+
+    # Population state in the middle of the data (computed from test_results) and now (current state view)
+    middle = FIRST_VALID_TIME + (last_valid_time - FIRST_VALID_TIME) / 2
+    timings, result = timed(lambda: engine.patients_states_and_recommendations(
+        (middle.strftime('%Y-%m-%d'), middle.strftime('%H:%M'))), runs)
+    scenarios['population_state_as_of'] = summary(timings, patients=len(result))
+    now = datetime.datetime.now()
+    timings, result = timed(lambda: engine.patients_states_and_recommendations(
+        (now.strftime('%Y-%m-%d'), now.strftime('%H:%M'))), runs)
+    scenarios['population_state_now'] = summary(timings, patients=len(result))
+
+    timings, result = timed(lambda: patient_data.time_interval_tables(), runs)
+    scenarios['interval_abstraction'] = summary(timings, intervals=len(result))
+
+    if processes:
+        executor = ShardedExecutor(processes, min_rows=0)
+        sharded = DSSEngine(patient_data, knowlege_base, cache=ResultCache(max_entries=0), executor=executor)
+        timings, result = timed(lambda: sharded.patients_states_and_recommendations(
+            (middle.strftime('%Y-%m-%d'), middle.strftime('%H:%M'))), runs)
+        scenarios['population_state_as_of_sharded'] = summary(timings, patients=len(result), processes=processes)
+        timings, result = timed(lambda: patient_data.time_interval_tables(executor=executor), runs)
+        scenarios['interval_abstraction_sharded'] = summary(timings, intervals=len(result), processes=processes)
+        sharded.writer.close()
+        executor.close()
+
+    engine.writer.close()
+    return {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'backend': 'sqlite',
+        'parameters': {'patients': patients, 'loincs': loincs, 'versions': versions, 'measurements': measurements,
+                       'rows': len(test_results), 'queries': queries, 'runs': runs, 'seed': seed, 'cache': cache,
+                       'processes': processes},
+        'cache': {'hits': engine.cache.hits, 'misses': engine.cache.misses},
+        'scenarios': scenarios,
+        'metrics': REGISTRY.as_dict(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the DSS engine on synthetic data in SQLite.")
+    parser.add_argument('--patients', type=int, default=100)
+    parser.add_argument('--loincs', type=int, default=len(CONCEPTS))
+    parser.add_argument('--versions', type=int, default=2, help="versions of every measurement (1 = no corrections)")
+    parser.add_argument('--measurements', type=int, default=10, help="measurements per patient and LOINC")
+    parser.add_argument('--queries', type=int, default=200, help="single patient queries per scenario")
+    parser.add_argument('--runs', type=int, default=3, help="runs of the population scenarios")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', help="directory for the generated CSV and databases (default: a new temp dir)")
+    parser.add_argument('--output', default="benchmark_results.json")
+    parser.add_argument('--processes', type=int, help="also time the population scenarios on this many processes")
+    parser.add_argument('--cache', action='store_true', help="keep the engine result cache on")
+    parser.add_argument('--slow-query-seconds', type=float, help="log SQL statements slower than this")
+    args = parser.parse_args()
+
+    if args.slow_query_seconds is not None:
+        logging.basicConfig()
+        REGISTRY.slow_query_seconds = args.slow_query_seconds
+
+    results = run_benchmark(args.patients, args.loincs, args.versions, args.measurements,
+                            args.queries, args.runs, args.seed, args.workdir, args.cache,
+                            args.processes)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    for name, scenario in results['scenarios'].items():
+        print(f"{name}: {scenario['mean_s'] * 1000:.2f} ms mean over {scenario['runs']} runs")
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
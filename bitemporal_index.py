@@ -0,0 +1,156 @@
+import bisect
+import datetime
+import threading
+
+import pandas as pd
+
+
+# Column order of a stored row, same as PatientData.get_patient_data returns
+RECORD_COLUMNS = ['first_name', 'last_name', 'loinc_num', 'value', 'unit', 'valid_start_time', 'transaction_time']
+
+# Value of the version that deletes a measurement (tombstone), from its transaction time on
+# the measurement is no longer known
+DELETED_VALUE = 'DELETED'
+
+
+class _IndexEntry:
+    # All the versions of one (patient, LOINC) pair.
+    # valid_times is sorted, versions[i] holds the rows recorded for valid_times[i]
+    # sorted by transaction time (tx_times[i] is the matching list of keys for bisect).
+    def __init__(self):
+        self.valid_times = []
+        self.tx_times = []
+        self.versions = []
+
+    def add(self, row):
+        valid_time, transaction_time = row[5], row[6]
+        i = bisect.bisect_left(self.valid_times, valid_time)
+        if i == len(self.valid_times) or self.valid_times[i] != valid_time:
+            self.valid_times.insert(i, valid_time)
+            self.tx_times.insert(i, [])
+            self.versions.insert(i, [])
+        if row in self.versions[i]:
+            return
+        j = bisect.bisect_right(self.tx_times[i], transaction_time)
+        self.tx_times[i].insert(j, transaction_time)
+        self.versions[i].insert(j, row)
+
+    def known_at(self, i, as_of):
+        # Latest version of valid time slot i that was recorded until as_of (None if deleted by then)
+        j = bisect.bisect_right(self.tx_times[i], as_of)
+        if j == 0 or self.versions[i][j - 1][3] == DELETED_VALUE:
+            return None
+        return self.versions[i][j - 1]
+
+
+class BitemporalIndex:
+    # In-memory index of test results keyed by (patient, LOINC).
+    # patient is the (first_name, last_name) tuple the engine queries with,
+    # each (patient, LOINC) key is loaded on its own the first time it is asked for.
+    # The highest id loaded for a key is its watermark, rows of other writers (ids after it)
+    # are added with catch_up.
+    def __init__(self):
+        self.entries = {}
+        self.loaded = set()
+        self.watermarks = {}
+        self.loading = {}
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def _row(row):
+        row = tuple(row)
+        return row[:5] + (pd.Timestamp(row[5]), pd.Timestamp(row[6]))
+
+    def is_loaded(self, patient, loinc_num):
+        return (patient, loinc_num) in self.loaded
+
+    # Highest id loaded for a patient LOINC, None when it is not loaded
+    def watermark(self, patient, loinc_num):
+        with self.lock:
+            return self.watermarks.get((patient, loinc_num))
+
+    # Called before the rows of a patient LOINC are fetched: rows added from now on
+    # are kept and added by load, a write committed while the rows are fetched is not lost
+    def begin_load(self, patient, loinc_num):
+        with self.lock:
+            self.loading.setdefault((patient, loinc_num), [])
+
+    # Load all the rows (id and RECORD_COLUMNS) of a patient LOINC, as fetched from the database.
+    # Versions recorded at the same transaction time are kept in id order, the rows written while
+    # they were fetched come after them (rows fetched too are not added twice).
+    def load(self, patient, loinc_num, rows):
+        key = (patient, loinc_num)
+        with self.lock:
+            # Another thread may have loaded the key meanwhile, its rows are kept
+            entry = self.entries.setdefault(key, _IndexEntry())
+            written = self.loading.pop(key, [])
+            self.loaded.add(key)
+            self.watermarks.setdefault(key, 0)
+            self.catch_up(patient, loinc_num, rows)
+            for row in written:
+                entry.add(row)
+
+    # Add the rows (id and RECORD_COLUMNS) of a loaded patient LOINC written after its watermark, in id order
+    def catch_up(self, patient, loinc_num, rows):
+        key = (patient, loinc_num)
+        rows = [(row[0], self._row(row[1:])) for row in sorted(rows, key=lambda row: row[0])]
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return
+            for row_id, row in rows:
+                entry.add(row)
+                self.watermarks[key] = max(self.watermarks[key], row_id)
+
+    # Add a single new row. Keys that were never loaded are skipped,
+    # they will get all their rows (including this one) on the first load.
+    def add(self, row):
+        row = self._row(row)
+        key = ((row[0], row[1]), row[2])
+        with self.lock:
+            if key in self.loading:
+                self.loading[key].append(row)
+            elif key in self.loaded:
+                self.entries[key].add(row)
+
+    def invalidate(self, patient=None):
+        with self.lock:
+            if patient is None:
+                self.entries.clear()
+                self.loaded.clear()
+                self.watermarks.clear()
+                return
+            for key in [key for key in self.entries if key[0] == patient]:
+                del self.entries[key]
+                self.loaded.discard(key)
+                self.watermarks.pop(key, None)
+
+    # Value of the LOINC at exactly valid_time, as it was known at as_of
+    def value_at(self, patient, loinc_num, valid_time, as_of):
+        valid_time, as_of = pd.Timestamp(valid_time), pd.Timestamp(as_of)
+        with self.lock:
+            entry = self.entries.get((patient, loinc_num))
+            if entry is None:
+                return None
+            i = bisect.bisect_left(entry.valid_times, valid_time)
+            if i == len(entry.valid_times) or entry.valid_times[i] != valid_time:
+                return None
+            return entry.known_at(i, as_of)
+
+    # Latest measurement of the LOINC on the given day, as it was known at as_of
+    def latest_on_day(self, patient, loinc_num, day, as_of):
+        day_start = pd.Timestamp(day).normalize()
+        day_end = day_start + datetime.timedelta(days=1)
+        as_of = pd.Timestamp(as_of)
+        with self.lock:
+            entry = self.entries.get((patient, loinc_num))
+            if entry is None:
+                return None
+            first = bisect.bisect_left(entry.valid_times, day_start)
+            i = bisect.bisect_left(entry.valid_times, day_end) - 1
+            while i >= first:
+                row = entry.known_at(i, as_of)
+                if row is not None:
+                    return row
+                i -= 1
+            return None
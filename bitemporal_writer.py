@@ -0,0 +1,95 @@
+import datetime
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from bitemporal_index import DELETED_VALUE
+
+
+class BitemporalWriter:
+    # Persists corrections and deletes as new versions of test_results rows:
+    # a correction is a new version with the new value, a delete is a version with DELETED_VALUE,
+    # both recorded with the current transaction time. Nothing is overwritten.
+    #
+    # Writes from all the threads (clinicians) are group committed: the writer thread takes
+    # the writes that arrive within flush_latency seconds of the first one (up to max_batch)
+    # and inserts them with one executemany in one transaction.
+    # The database gives the ids. PatientData.add_test_results updates the bitemporal index and
+    # its write listeners in the same step, before the waiting callers are released.
+    def __init__(self, patient_data, flush_latency=0.05, max_batch=500):
+        self.db = patient_data
+        self.flush_latency = flush_latency
+        self.max_batch = max_batch
+        self.pending = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.closed = False
+
+    def correct(self, first_name, last_name, loinc_num, valid_start_time, new_value, unit):
+        return self._submit((first_name, last_name, loinc_num, str(new_value), unit, valid_start_time))
+
+    def delete(self, first_name, last_name, loinc_num, valid_start_time, unit):
+        return self._submit((first_name, last_name, loinc_num, DELETED_VALUE, unit, valid_start_time))
+
+    # Returns a Future with the committed record (RECORD_COLUMNS order)
+    def _submit(self, version):
+        future = Future()
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("The writer is closed.")
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="bitemporal-writer", daemon=True)
+                self.thread.start()
+        self.pending.put((version, future))
+        return future
+
+    # Wait until everything submitted so far is committed
+    def flush(self):
+        self._submit(None).result()
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            thread = self.thread
+        if thread is not None:
+            self.pending.put(None)
+            thread.join()
+
+    def _run(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.flush_latency
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.pending.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self.pending.put(None)
+                    break
+                batch.append(item)
+            self._commit(batch)
+
+    def _commit(self, batch):
+        writes = [(version, future) for version, future in batch if version is not None]
+        try:
+            transaction_time = datetime.datetime.now().replace(microsecond=0)
+            rows = [version + (transaction_time,) for version, _ in writes]
+            if rows:
+                self.db.add_test_results(rows, skip_existing=False)
+        except Exception as error:
+            for _, future in batch:
+                future.set_exception(error)
+            return
+        for row, (_, future) in zip(rows, writes):
+            future.set_result(row)
+        for version, future in batch:
+            if version is None:
+                future.set_result(None)
@@ -0,0 +1,187 @@
+import contextlib
+import queue
+import sqlite3
+import threading
+import time
+
+try:
+    import mysql.connector
+except ImportError:
+    # Embedded (SQLite) installs run without the MySQL driver
+    mysql = None
+
+from metrics import check_slow_query, count_round_trip, count_rows, phase
+
+
+# Errors that mean the connection itself is broken (server gone away, closed connection),
+# the connection is dropped and the operation can be tried again on a new one.
+STALE_CONNECTION_ERRORS = (sqlite3.ProgrammingError,)
+if mysql is not None:
+    STALE_CONNECTION_ERRORS += (mysql.connector.InterfaceError, mysql.connector.OperationalError)
+
+
+class PoolExhaustedError(Exception):
+    pass
+
+
+class ConnectionPool:
+    # A bounded pool of DB-API connections, safe to share between threads.
+    # connect - function that opens a new connection
+    # size - max number of connections open at the same time
+    # timeout - seconds to wait for a free connection before PoolExhaustedError
+    # health_check_interval - idle connections older than this are checked before reuse
+    # dialect - 'mysql' or 'sqlite', sets the parameter placeholder ('%s' or '?')
+    def __init__(self, connect, size=5, timeout=30, health_check_interval=30, retries=1, dialect='mysql'):
+        self.connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.retries = retries
+        self.dialect = dialect
+        self.placeholder = '?' if dialect == 'sqlite' else '%s'
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+
+    # SQLite stand-in, path should be a file (or a shared cache URI) so all connections see the same data
+    @classmethod
+    def for_sqlite(cls, path, size=5, **kwargs):
+        return cls(lambda: sqlite3.connect(path, check_same_thread=False, uri=path.startswith('file:')),
+                   size=size, dialect='sqlite', **kwargs)
+
+    # Write the query with the placeholder style of the driver
+    def sql(self, query):
+        return query.replace('%s', self.placeholder)
+
+    @staticmethod
+    def is_healthy(connection):
+        try:
+            if hasattr(connection, 'is_connected'):
+                return connection.is_connected()
+            connection.execute('SELECT 1')
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def _close(connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def _checkout(self):
+        if not self.slots.acquire(timeout=self.timeout):
+            raise PoolExhaustedError(f"No free database connection after {self.timeout} seconds.")
+        try:
+            while True:
+                try:
+                    connection, last_used = self.idle.get_nowait()
+                except queue.Empty:
+                    return self.connect()
+                if time.monotonic() - last_used < self.health_check_interval or self.is_healthy(connection):
+                    return connection
+                self._close(connection)
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def _checkin(self, connection, broken=False):
+        if broken:
+            self._close(connection)
+        else:
+            self.idle.put((connection, time.monotonic()))
+        self.slots.release()
+
+    # Check out a connection for one operation. Commits when the block ends,
+    # rolls back on error and drops the connection if it went stale.
+    @contextlib.contextmanager
+    def session(self):
+        connection = self._checkout()
+        try:
+            cursor = connection.cursor()
+            yield cursor
+            connection.commit()
+        except STALE_CONNECTION_ERRORS:
+            self._checkin(connection, broken=True)
+            # A server restart breaks every idle connection too
+            self.prune()
+            raise
+        except BaseException:
+            try:
+                connection.rollback()
+            except Exception:
+                pass
+            self._checkin(connection)
+            raise
+        else:
+            cursor.close()
+            self._checkin(connection)
+
+    # Run a single statement and return the fetched rows (empty for writes).
+    # many=True runs executemany with params as a list of rows.
+    # Stale connections are retried on a new connection.
+    # Execute and fetch time, round trips and rows are recorded in the metrics registry.
+    def execute(self, query, params=(), many=False):
+        for attempt in range(self.retries + 1):
+            try:
+                with self.session() as cursor:
+                    start = time.perf_counter()
+                    with phase('sql_execute'):
+                        if many:
+                            cursor.executemany(self.sql(query), params)
+                        else:
+                            cursor.execute(self.sql(query), params)
+                    count_round_trip()
+                    check_slow_query(query, f'{len(params)} rows' if many else params, time.perf_counter() - start)
+                    if not cursor.description:
+                        count_rows(len(params) if many else max(cursor.rowcount, 0), kind='written')
+                        return []
+                    with phase('fetch'):
+                        rows = cursor.fetchall()
+                    count_rows(len(rows))
+                    return rows
+            except STALE_CONNECTION_ERRORS:
+                if attempt == self.retries:
+                    raise
+
+    # Drop the idle connections that fail the health check
+    def prune(self):
+        healthy = []
+        while True:
+            try:
+                connection, last_used = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            if self.is_healthy(connection):
+                healthy.append((connection, last_used))
+            else:
+                self._close(connection)
+        for item in reversed(healthy):
+            self.idle.put(item)
+
+    def close(self):
+        while True:
+            try:
+                connection, _ = self.idle.get_nowait()
+            except queue.Empty:
+                return
+            self._close(connection)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+# Shared MySQL pool for the given server and database, every PatientData and
+# KnowledgeBase made with the same details checks out connections from it
+def get_pool(host, user, password, database, size=5):
+    if mysql is None:
+        raise ImportError("mysql-connector-python is needed for the MySQL backend, or use the SQLite backend.")
+    key = (host, user, password, database)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(
+                lambda: mysql.connector.connect(host=host, user=user, password=password, database=database),
+                size=size
+            )
+        return _pools[key]
@@ -1,193 +1,482 @@
-import pandas as pd
-import random
-import datetime
-import mysql.connector
-
-def abstract_data(measurements):
-    # Define a function to categorize the WBC count
-    def categorize_wbc(value):
-        value = int(value)
-        if value < 4000:
-            return 'wbc_low'
-        elif 4000 <= value <= 10000:
-            return 'wbc_medium'
-        else:
-            return 'wbc_high'
-
-    # Apply the function to the 'value' column and create a new 'state' column
-    measurements['state'] = measurements['value'].apply(categorize_wbc)
-    return measurements
-
-
-class PatientData:
-    def __init__(self, host, user, password, database):
-        self.db_connection = mysql.connector.connect(
-            host=host,
-            user=user,
-            password=password,
-            database=database
-        )
-        self.cursor = self.db_connection.cursor()
-
-    # Get patient by first name and last name
-    def get_patient_data(self, first_name, last_name):
-        print('@@@@@@@')
-        self.cursor.execute(
-            "SELECT first_name, last_na, loinc_num, value, unit, valid_start_time, transaction_time\
-            FROM test_results p\
-            WHERE first_name = %s AND last_name = %s",
-            (first_name, last_name,)
-        )
-        return self.cursor.fetchall()
-
-    # Get patient by first name and last name until thw last relevant time
-    def get_patient_data_by_valid_end_time(self, first_name, last_name, end_datetime):
-        self.cursor.execute(
-            """
-            SELECT loinc_num, value, unit, valid_start_time, transaction_time
-            FROM patients p
-            JOIN test_results t ON p.id = t.patient_id
-            WHERE first_name = %s AND last_name = %s
-            AND valid_start_time <= %s
-            ORDER BY valid_start_time DESC
-            """,
-            (first_name, last_name, end_datetime)
-        )
-        return self.cursor.fetchall()
-        
-        if result == []:
-            print("No data found for the given first name and last name.")
-            return None  # You can return None or any other indicator for no data found
-
-        return result
-
-
-
-
-
-
-
-
-
-
-    def time_interval_table(self, first_name, last_name):
-        patient_data = self.get_patient_data(first_name, last_name)
-        patient_data_columns = ['first_name', 'last_name','loinc_num', 'value','unit','valid_start_time','transaction_time']
-        df = pd.DataFrame(patient_data, columns=patient_data_columns)
-
-        # Filter the DataFrame to include only WBC measurements
-        wbc = df[df['unit'] == 'cells/ml']
-        hemoglobin = df[df['unit'] == 'gr/dl']
-
-        # Sort the DataFrame by valid_start_time
-        wbc = wbc.sort_values(by=['valid_start_time'])
-        hemoglobin = hemoglobin.sort_values(by=['valid_start_time'])
-        abstracts_1 = abstract_data(wbc)
-        abstracts_2 = abstract_data(hemoglobin)
-
-        return abstracts_1, abstracts_2
-
-
-    def dictinary_of_time_interval(self, measurements):
-        # Initialize variables
-        intervals = {}
-        interval_start = measurements.iloc[0]['valid_start_time']
-        interval_name = 'interval_1'
-        intervals[interval_name] = [interval_start]
-        interval_index = 1
-
-        # Iterate through the DataFrame to find intervals
-        for i in range(1, len(measurements)):
-            current_time = measurements.iloc[i]['valid_start_time']
-            previous_time = measurements.iloc[i - 1]['valid_start_time']
-
-            current_state = measurements.iloc[i]['state']
-            previous_state = measurements.iloc[i - 1]['state']
-
-            # Check if the time difference is more than 2 days
-            if current_time - previous_time < datetime.timedelta(days=2) and current_state == previous_state:
-                intervals[interval_name].append(current_time)
-            else:
-                intervals[interval_name].append(previous_time)
-                interval_index += 1
-                interval_name = f'interval_{interval_index}'
-                intervals[interval_name] = [current_time]
-
-        # Remove duplicates in intervals
-        for key in intervals:
-            intervals[key] = [intervals[key][0] - datetime.timedelta(days=2), intervals[key][-1] + datetime.timedelta(days=2)]
-
-        print(intervals)
-        return intervals
-
-
-    # Add a patient to the database
-    def add_patient(self, id, first_name, last_name):
-        self.cursor.execute(
-            "INSERT INTO patients (id, first_name, last_name) VALUES (%s, %s, %s)",
-            (id, first_name, last_name)
-        )
-        self.db_connection.commit()
-        return self.cursor.lastrowid
-
-    # Add test results for a patient
-    def add_test_result(self, id, patient_id, loinc_num, value, unit, valid_start_time, transaction_time):
-        self.cursor.execute(
-            "INSERT INTO test_results (id, patient_id, loinc_num, value, unit, valid_start_time, transaction_time) VALUES (%s, %s, %s, %s, %s, %s, %s)",
-            (id, patient_id, loinc_num, value, unit, valid_start_time, transaction_time)
-        )
-        self.db_connection.commit()
-
-    # Get patient test results
-    def get_test_results(self, patient_id):
-        self.cursor.execute(
-            "SELECT loinc_num, value, unit, valid_start_time, transaction_time FROM test_results WHERE patient_id = %s",
-            (patient_id,)
-        )
-        return self.cursor.fetchall()
-
-    def get_all_patients(self):
-        self.cursor.execute("SELECT DISTINCT first_name, last_name FROM patients")
-        patients = self.cursor.fetchall()
-        return patients
-
-    def get_all_loinc_numbers(self):
-        self.cursor.execute("SELECT DISTINCT loinc_num FROM test_results")
-        loincs = self.cursor.fetchall()
-        return loincs
-
-
-
-    def __del__(self):
-        self.cursor.close()
-        self.db_connection.close()
-
-# if __name__ == "__main__":
-#     patient_data = PatientData(host="localhost", user="root", password="q6rh3b", database="patient_data")
-
-    # data = patient_data.get_patient_data('Eyal', 'Rothman')
-    # for d in data:
-    #     print(d)
-
-    # abstracts_1, abstracts_2 = patient_data.time_interval_table('Eyal', 'Rothman')
-    # print(abstracts_1)
-    # print(abstracts_2)
-    # dict_ = patient_data.dictinary_of_time_interval(abstracts_1)
-
-    # data = pd.get_patient_data('Eyal', 'Rothman')
-    # print(type(data))
-    # for d in data:
-    #     print(d)
-
-    # Add patients
-    # idan_id = pd.add_patient(3, "Idan", "Gal")
-
-    # Add test results
-    # pd.add_test_result(51, 1, '11218-5', 4500, 'cells/ml', '2018-05-17 13:11:00', '2018-05-27 10:00:00')
-    # pd.add_test_result(23, 2, '11218-5', 5500, 'cells/ml', '2018-05-18 15:00:00', '2018-05-21 10:00:00')
-
-    # # Retrieve and print test results for Eyal
-    # test_results = kb.get_test_results(eyal_id)
-    # for result in test_results:
-    #     print(result)
-
+import pandas as pd
+import random
+import datetime
+import logging
+from connection_pool import get_pool
+from metrics import instrumented, phase
+from bitemporal_index import BitemporalIndex, DELETED_VALUE, RECORD_COLUMNS
+from temporal_abstraction import DEFAULT_SEX, abstract_intervals, abstract_states, build_intervals
+from trend_abstraction import TREND_SETTINGS, TrendAbstraction
+
+INSERT_TEST_RESULT = "INSERT INTO test_results (id, first_name, last_name, loinc_num, value, unit, valid_start_time, transaction_time) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)"
+
+# Insert of a test_results record, the database gives the id
+INSERT_TEST_RECORD = "INSERT INTO test_results (first_name, last_name, loinc_num, value, unit, valid_start_time, transaction_time) VALUES (%s, %s, %s, %s, %s, %s, %s)"
+
+# Skipping records already in the table (same patient, LOINC, value, valid and transaction time) is done
+# per batch: the records go to a temporary table of the connection, one anti-join finds the new ones.
+STAGE_TEST_RECORDS = [
+    "CREATE TEMPORARY TABLE IF NOT EXISTS incoming_test_results AS "
+    "SELECT 0 AS seq, first_name, last_name, loinc_num, value, unit, valid_start_time, transaction_time "
+    "FROM test_results WHERE 1 = 0",
+    "DELETE FROM incoming_test_results",
+]
+INSERT_STAGED_RECORD = "INSERT INTO incoming_test_results (seq, first_name, last_name, loinc_num, value, unit, valid_start_time, transaction_time) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)"
+NEW_STAGED_RECORDS = """
+    SELECT seq FROM incoming_test_results i
+    WHERE NOT EXISTS (
+        SELECT 1 FROM test_results t
+        WHERE t.first_name = i.first_name AND t.last_name = i.last_name AND t.loinc_num = i.loinc_num
+          AND t.valid_start_time = i.valid_start_time AND t.transaction_time = i.transaction_time
+          AND t.value = i.value
+    )
+    ORDER BY seq
+"""
+
+# Time bucket start and numeric value of a test_results row, per SQL dialect
+BUCKET_FORMATS = {
+    'mysql': {'minute': '%Y-%m-%d %H:%i:00', 'hour': '%Y-%m-%d %H:00:00', 'day': '%Y-%m-%d 00:00:00'},
+    'sqlite': {'minute': '%Y-%m-%d %H:%M:00', 'hour': '%Y-%m-%d %H:00:00', 'day': '%Y-%m-%d 00:00:00'},
+}
+BUCKET_EXPRESSIONS = {
+    'mysql': "DATE_FORMAT(valid_start_time, '{format}')",
+    'sqlite': "strftime('{format}', valid_start_time)",
+}
+NUMERIC_VALUE = {
+    'mysql': "CAST(value AS DECIMAL(20, 6))",
+    'sqlite': "CAST(value AS REAL)",
+}
+BUCKET_COLUMNS = ['bucket_start', 'measurements', 'min_value', 'mean_value', 'max_value']
+
+listener_log = logging.getLogger('dss.write_listeners')
+
+WBC_LOINC = '11218-5'
+HEMOGLOBIN_LOINCS = ['12181-4', '30313-1']
+
+# Create a new 'state' column with the state of each measurement, by its LOINC (and sex) ranges
+def abstract_data(measurements, sex=DEFAULT_SEX):
+    return abstract_states(measurements, sex)
+
+
+# Build a DataFrame of test_results rows with real datetime time columns
+def records_frame(records):
+    with phase('dataframe'):
+        df = pd.DataFrame(records, columns=RECORD_COLUMNS)
+        df['valid_start_time'] = pd.to_datetime(df['valid_start_time'])
+        df['transaction_time'] = pd.to_datetime(df['transaction_time'])
+    return df
+
+
+class PatientData:
+    # Connections come from the shared pool of the MySQL details, or from the given pool,
+    # e.g. storage.open_storage('sqlite', path) for the embedded backend
+    def __init__(self, host=None, user=None, password=None, database=None, pool=None):
+        self.pool = pool if pool is not None else get_pool(host, user, password, database)
+        self.index = BitemporalIndex()
+        self.listeners = []
+
+    # Datetimes are sent as text so both MySQL and SQLite compare them the same way
+    @staticmethod
+    def _param(value):
+        if isinstance(value, (datetime.datetime, datetime.date)):
+            return value.strftime('%Y-%m-%d %H:%M:%S')
+        return value
+
+    # Get patient by first name and last name
+    @instrumented()
+    def get_patient_data(self, first_name, last_name):
+        return self.pool.execute(
+            "SELECT first_name, last_name, loinc_num, value, unit, valid_start_time, transaction_time\
+            FROM test_results p\
+            WHERE first_name = %s AND last_name = %s",
+            (first_name, last_name,)
+        )
+
+    # Query of the test_results rows (id and RECORD_COLUMNS) that match the filters, done by the database:
+    # first_name, last_name - only this patient (None for all the patients)
+    # loinc_num - only this LOINC, or a list of LOINCs
+    # valid_from, valid_to - valid start time window (inclusive)
+    # as_of - only versions recorded until this transaction time
+    # latest_only - only the latest version (by transaction time) of each valid time,
+    #               measurements whose latest version is a delete are left out
+    # Returns (sql, params), to be used as a derived table.
+    def _results_query(self, first_name=None, last_name=None, loinc_num=None, valid_from=None, valid_to=None,
+                       as_of=None, latest_only=False):
+        conditions = ["1 = 1"]
+        params = []
+        if first_name is not None:
+            conditions.append("first_name = %s AND last_name = %s")
+            params.extend([first_name, last_name])
+        if isinstance(loinc_num, (list, tuple, set)):
+            conditions.append(f"loinc_num IN ({', '.join(['%s'] * len(loinc_num))})")
+            params.extend(loinc_num)
+        elif loinc_num is not None:
+            conditions.append("loinc_num = %s")
+            params.append(loinc_num)
+        if valid_from is not None:
+            conditions.append("valid_start_time >= %s")
+            params.append(self._param(valid_from))
+        if valid_to is not None:
+            conditions.append("valid_start_time <= %s")
+            params.append(self._param(valid_to))
+        if as_of is not None:
+            conditions.append("transaction_time <= %s")
+            params.append(self._param(as_of))
+
+        columns = ", ".join(['id'] + RECORD_COLUMNS)
+        where = " AND ".join(conditions)
+        if not latest_only:
+            return f"SELECT {columns} FROM test_results WHERE {where}", params
+        query = f"""
+            SELECT {columns}
+            FROM (
+                SELECT {columns},
+                       ROW_NUMBER() OVER (PARTITION BY first_name, last_name, loinc_num, valid_start_time
+                                          ORDER BY transaction_time DESC, id DESC) AS version_rank
+                FROM test_results
+                WHERE {where}
+            ) versions
+            WHERE version_rank = 1 AND value <> %s
+        """
+        return query, params + [DELETED_VALUE]
+
+    # Get patient results with the filters done by the database (see _results_query for the filters)
+    @instrumented()
+    def query_test_results(self, first_name=None, last_name=None, loinc_num=None, valid_from=None, valid_to=None,
+                           as_of=None, latest_only=False):
+        results, params = self._results_query(first_name, last_name, loinc_num, valid_from, valid_to, as_of, latest_only)
+        query = f"""
+            SELECT {", ".join(RECORD_COLUMNS)}
+            FROM ({results}) results
+            ORDER BY first_name, last_name, loinc_num, valid_start_time, transaction_time
+        """
+        return self.pool.execute(query, tuple(params))
+
+    # One page of query_test_results, ordered by valid start time. Keyset pagination:
+    # after is the next_page returned with the previous page (None for the first page),
+    # so every page is a cheap indexed range scan no matter how deep it is.
+    # Returns (rows, next_page), next_page is None after the last page.
+    @instrumented()
+    def query_test_results_page(self, first_name=None, last_name=None, loinc_num=None, valid_from=None, valid_to=None,
+                                as_of=None, latest_only=False, after=None, page_size=1000):
+        results, params = self._results_query(first_name, last_name, loinc_num, valid_from, valid_to, as_of, latest_only)
+        keyset = "1 = 1"
+        if after is not None:
+            after_time, after_id = after
+            keyset = "(valid_start_time > %s OR (valid_start_time = %s AND id > %s))"
+            params = params + [self._param(after_time), self._param(after_time), after_id]
+        query = f"""
+            SELECT id, {", ".join(RECORD_COLUMNS)}
+            FROM ({results}) results
+            WHERE {keyset}
+            ORDER BY valid_start_time, id
+            LIMIT {int(page_size)}
+        """
+        rows = self.pool.execute(query, tuple(params))
+        next_page = (rows[-1][6], rows[-1][0]) if len(rows) == page_size else None
+        return [row[1:] for row in rows], next_page
+
+    # Aggregate of the latest versions per time bucket ('minute', 'hour' or 'day'):
+    # rows of (bucket_start, measurements, min_value, mean_value, max_value), paged by bucket like
+    # query_test_results_page (after is the last bucket_start of the previous page).
+    @instrumented()
+    def query_test_result_buckets(self, first_name, last_name, loinc_num, valid_from=None, valid_to=None,
+                                  as_of=None, bucket='hour', after=None, page_size=1000):
+        results, params = self._results_query(first_name, last_name, loinc_num, valid_from, valid_to, as_of,
+                                              latest_only=True)
+        dialect = self.pool.dialect
+        bucket_start = BUCKET_EXPRESSIONS[dialect].format(format=BUCKET_FORMATS[dialect][bucket])
+        value = NUMERIC_VALUE[dialect]
+        having = "1 = 1"
+        if after is not None:
+            having = "bucket_start > %s"
+            params = params + [self._param(after)]
+        query = f"""
+            SELECT {bucket_start} AS bucket_start, COUNT(*), MIN({value}), AVG({value}), MAX({value})
+            FROM ({results}) results
+            GROUP BY bucket_start
+            HAVING {having}
+            ORDER BY bucket_start
+            LIMIT {int(page_size)}
+        """
+        rows = self.pool.execute(query, tuple(params))
+        next_page = rows[-1][0] if len(rows) == page_size else None
+        return rows, next_page
+
+    # Latest measurement of every (patient, LOINC) for the given LOINCs, as the database was at as_of:
+    # measured (valid start time) and recorded (transaction time) until as_of, latest version only,
+    # deleted measurements left out. One query for all the patients.
+    @instrumented()
+    def query_latest_results(self, loinc_nums, as_of):
+        results, params = self._results_query(loinc_num=list(loinc_nums), valid_to=as_of, as_of=as_of, latest_only=True)
+        columns = ", ".join(RECORD_COLUMNS)
+        query = f"""
+            SELECT {columns}
+            FROM (
+                SELECT {columns},
+                       ROW_NUMBER() OVER (PARTITION BY first_name, last_name, loinc_num
+                                          ORDER BY valid_start_time DESC) AS result_rank
+                FROM ({results}) versions
+            ) results
+            WHERE result_rank = 1
+            ORDER BY first_name, last_name, loinc_num
+        """
+        return self.pool.execute(query, tuple(params))
+
+    # Rows with their ids (id + RECORD_COLUMNS) recorded at or after recorded_from (all rows when None),
+    # for copies of the table such as the columnar snapshot.
+    # loinc_nums - only these LOINCs, after_id - only the rows with a higher id
+    @instrumented()
+    def query_test_result_rows(self, recorded_from=None, loinc_nums=None, after_id=None):
+        conditions = ["1 = 1"]
+        params = []
+        if recorded_from is not None:
+            conditions.append("transaction_time >= %s")
+            params.append(self._param(recorded_from))
+        if loinc_nums is not None:
+            conditions.append(f"loinc_num IN ({', '.join(['%s'] * len(loinc_nums))})")
+            params.extend(loinc_nums)
+        if after_id is not None:
+            conditions.append("id > %s")
+            params.append(after_id)
+        query = f"SELECT {', '.join(['id'] + RECORD_COLUMNS)} FROM test_results WHERE {' AND '.join(conditions)}"
+        return self.pool.execute(query + " ORDER BY id", tuple(params))
+
+    # All the versions of the LOINCs of many patients ((first_name, last_name) pairs) in one query,
+    # rows are id and RECORD_COLUMNS
+    @instrumented()
+    def query_patients_test_results(self, patients, loinc_nums):
+        patients, loinc_nums = list(patients), list(loinc_nums)
+        if not patients or not loinc_nums:
+            return []
+        query = f"""
+            SELECT {', '.join(['id'] + RECORD_COLUMNS)}
+            FROM test_results
+            WHERE ({' OR '.join(['(first_name = %s AND last_name = %s)'] * len(patients))})
+              AND loinc_num IN ({', '.join(['%s'] * len(loinc_nums))})
+        """
+        params = [name for patient in patients for name in patient] + loinc_nums
+        return self.pool.execute(query, tuple(params))
+
+    # All the versions (id and RECORD_COLUMNS) of a patient LOINC, only the ids after after_id when given
+    @instrumented()
+    def query_patient_result_rows(self, first_name, last_name, loinc_num, after_id=None):
+        query = f"""
+            SELECT {', '.join(['id'] + RECORD_COLUMNS)}
+            FROM test_results
+            WHERE first_name = %s AND last_name = %s AND loinc_num = %s AND id > %s
+            ORDER BY id
+        """
+        return self.pool.execute(query, (first_name, last_name, loinc_num, after_id or 0))
+
+    # Get the bitemporal index with the patient LOINC rows. All the rows are fetched on first use,
+    # after that only the rows with a newer id than the index has, so writes of other PatientData
+    # objects and processes are seen too.
+    @instrumented()
+    def get_patient_index(self, first_name, last_name, loinc_num):
+        patient = (first_name, last_name)
+        watermark = self.index.watermark(patient, loinc_num)
+        if watermark is None:
+            self.index.begin_load(patient, loinc_num)
+            self.index.load(patient, loinc_num, self.query_patient_result_rows(first_name, last_name, loinc_num))
+        else:
+            rows = self.query_patient_result_rows(first_name, last_name, loinc_num, after_id=watermark)
+            if rows:
+                self.index.catch_up(patient, loinc_num, rows)
+        return self.index
+
+    # Get patient by first name and last name until thw last relevant time
+    def get_patient_data_by_valid_end_time(self, first_name, last_name, end_datetime):
+        return self.pool.execute(
+            """
+            SELECT loinc_num, value, unit, valid_start_time, transaction_time
+            FROM patients p
+            JOIN test_results t ON p.id = t.patient_id
+            WHERE first_name = %s AND last_name = %s
+            AND valid_start_time <= %s
+            ORDER BY valid_start_time DESC
+            """,
+            (first_name, last_name, end_datetime)
+        )
+        
+        if result == []:
+            print("No data found for the given first name and last name.")
+            return None  # You can return None or any other indicator for no data found
+
+        return result
+
+
+
+
+
+
+
+
+
+
+    @instrumented()
+    def time_interval_table(self, first_name, last_name, sex=DEFAULT_SEX):
+        patient_data = self.query_test_results(first_name, last_name, [WBC_LOINC] + HEMOGLOBIN_LOINCS, latest_only=True)
+        df = records_frame(patient_data)
+
+        # Split the DataFrame to WBC and hemoglobin measurements
+        wbc = df[df['loinc_num'] == WBC_LOINC]
+        hemoglobin = df[df['loinc_num'].isin(HEMOGLOBIN_LOINCS)]
+
+        # Sort the DataFrame by valid_start_time
+        wbc = wbc.sort_values(by=['valid_start_time'])
+        hemoglobin = hemoglobin.sort_values(by=['valid_start_time'])
+        abstracts_1 = abstract_data(wbc, sex)
+        abstracts_2 = abstract_data(hemoglobin, sex)
+
+        return abstracts_1, abstracts_2
+
+    # State intervals of all the patients for the given LOINCs (None for every LOINC with ranges), in one pass.
+    # executor - optional parallel.ShardedExecutor, the patients are abstracted in shards on its processes
+    @instrumented()
+    def time_interval_tables(self, loinc_nums=None, sex=DEFAULT_SEX, executor=None):
+        patient_data = records_frame(self.query_test_results(loinc_num=loinc_nums, latest_only=True))
+        if executor is not None:
+            return executor.abstract_intervals(patient_data, sex)
+        return abstract_intervals(patient_data, sex)
+
+    # Trend intervals (increasing / decreasing / stable, see trend_abstraction) of the vital signs of all the patients
+    @instrumented()
+    def trend_interval_tables(self, settings=None):
+        settings = TREND_SETTINGS if settings is None else settings
+        patient_data = records_frame(self.query_test_results(loinc_num=list(settings), latest_only=True))
+        return TrendAbstraction.from_records(patient_data, settings).interval_table()
+
+    def dictinary_of_time_interval(self, measurements):
+        # Find the state intervals of the measurements (see temporal_abstraction.build_intervals)
+        intervals_table = build_intervals(measurements)
+        intervals = {}
+        for i, interval in enumerate(intervals_table.itertuples(index=False), start=1):
+            intervals[f'interval_{i}'] = [interval.start_time, interval.end_time]
+        return intervals
+
+
+    # Add a patient to the database
+    def add_patient(self, id, first_name, last_name):
+        with self.pool.session() as cursor:
+            cursor.execute(
+                self.pool.sql("INSERT INTO patients (id, first_name, last_name) VALUES (%s, %s, %s)"),
+                (id, first_name, last_name)
+            )
+            return cursor.lastrowid
+
+    # Add test results for a patient, and keep the index and the listeners up to date
+    @instrumented()
+    def add_test_result(self, id, first_name, last_name, loinc_num, value, unit, valid_start_time, transaction_time):
+        self.pool.execute(
+            INSERT_TEST_RESULT,
+            (id, first_name, last_name, loinc_num, value, unit, self._param(valid_start_time), self._param(transaction_time))
+        )
+        self._written([(first_name, last_name, loinc_num, value, unit, valid_start_time, transaction_time)])
+
+    # Add many test results (RECORD_COLUMNS order) in a single transaction, the database gives the ids.
+    # With skip_existing records already in the table (same patient, LOINC, value, valid and transaction time)
+    # are skipped, so loading the same rows again is safe. Returns the number of rows written.
+    @instrumented()
+    def add_test_results(self, records, skip_existing=True):
+        records = [tuple(record[:5]) + (self._param(record[5]), self._param(record[6])) for record in records]
+        if not records:
+            return 0
+        if skip_existing:
+            # The same record twice in the batch is written once
+            unique, keys = [], set()
+            for record in records:
+                if record[:4] + record[5:] not in keys:
+                    keys.add(record[:4] + record[5:])
+                    unique.append(record)
+            records = unique
+            with self.pool.session() as cursor:
+                for statement in STAGE_TEST_RECORDS:
+                    cursor.execute(statement)
+                cursor.executemany(self.pool.sql(INSERT_STAGED_RECORD),
+                                   [(seq,) + record for seq, record in enumerate(records)])
+                cursor.execute(NEW_STAGED_RECORDS)
+                records = [records[seq] for (seq,) in cursor.fetchall()]
+                if records:
+                    cursor.executemany(self.pool.sql(INSERT_TEST_RECORD), records)
+        else:
+            self.pool.execute(INSERT_TEST_RECORD, records, many=True)
+        if records:
+            self._written(records)
+        return len(records)
+
+    # listener(records) is called after every committed write with the new records (RECORD_COLUMNS order)
+    def on_write(self, listener):
+        self.listeners.append(listener)
+
+    # Keep the index and the listeners up to date with committed records
+    def _written(self, records):
+        for record in records:
+            self.index.add(record)
+        for listener in self.listeners:
+            try:
+                listener(records)
+            except Exception:
+                listener_log.exception("Write listener %r failed", listener)
+
+    def get_max_transaction_time(self):
+        rows = self.pool.execute("SELECT MAX(transaction_time) FROM test_results")
+        return pd.Timestamp(rows[0][0]) if rows[0][0] is not None else None
+
+    def get_max_test_result_id(self):
+        rows = self.pool.execute("SELECT MAX(id) FROM test_results")
+        return rows[0][0] or 0
+
+    # Get patient test results
+    def get_test_results(self, patient_id):
+        return self.pool.execute(
+            "SELECT loinc_num, value, unit, valid_start_time, transaction_time FROM test_results WHERE patient_id = %s",
+            (patient_id,)
+        )
+
+    def get_all_patients(self):
+        patients = self.pool.execute("SELECT DISTINCT first_name, last_name FROM test_results")
+        return patients
+
+    # Patients and LOINCs of the rows with an id above after_id, with the largest id of each
+    # (the ids are given by the database, unlike transaction_time they don't depend on the client clocks)
+    def get_patients_and_loincs_after(self, after_id):
+        return self.pool.execute(
+            "SELECT first_name, last_name, loinc_num, MAX(id) FROM test_results WHERE id > %s "
+            "GROUP BY first_name, last_name, loinc_num",
+            (after_id,)
+        )
+
+    def get_all_loinc_numbers(self):
+        loincs = self.pool.execute("SELECT DISTINCT loinc_num FROM test_results")
+        return loincs
+
+# if __name__ == "__main__":
+#     patient_data = PatientData(host="localhost", user="root", password="q6rh3b", database="patient_data")
+
+    # data = patient_data.get_patient_data('Eyal', 'Rothman')
+    # for d in data:
+    #     print(d)
+
+    # abstracts_1, abstracts_2 = patient_data.time_interval_table('Eyal', 'Rothman')
+    # print(abstracts_1)
+    # print(abstracts_2)
+    # dict_ = patient_data.dictinary_of_time_interval(abstracts_1)
+
+    # data = pd.get_patient_data('Eyal', 'Rothman')
+    # print(type(data))
+    # for d in data:
+    #     print(d)
+
+    # Add patients
+    # idan_id = pd.add_patient(3, "Idan", "Gal")
+
+    # Add test results
+    # pd.add_test_result(51, 'Eyal', 'Rothman', '11218-5', 4500, 'cells/ml', '2018-05-17 13:11:00', '2018-05-27 10:00:00')
+    # pd.add_test_result(23, 'Eli', 'Call', '11218-5', 5500, 'cells/ml', '2018-05-18 15:00:00', '2018-05-21 10:00:00')
+
+    # # Retrieve and print test results for Eyal
+    # test_results = kb.get_test_results(eyal_id)
+    # for result in test_results:
+    #     print(result)
+
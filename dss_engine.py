@@ -1,11 +1,14 @@
 
-import timeit
 from datetime import datetime
-from idlelib import query
-import re
 import pandas as pd
-from database import PatientData
+from bitemporal_index import DELETED_VALUE, RECORD_COLUMNS
+from bitemporal_writer import BitemporalWriter
+from database import BUCKET_COLUMNS, PatientData, records_frame
 from knowlege_base import KnowledgeBase
+from metrics import instrumented, phase
+from result_cache import ResultCache, cached_query
+from patient_state import PATIENT_STATE_LOINCS, SEX_LOINC, PatientStateView, latest_results_states
+from validity import ValidityIndex, validity_windows
 
 
 # CDSS_Project/
@@ -15,20 +18,94 @@ from knowlege_base import KnowledgeBase
 # ├── database.py          # Script to manage data storage and queries
 # └── user_interface.py         # Script to create the user interface
 
+# Patients whose rows retrieval_questions fetches in one query
+BATCH_PATIENTS = 200
+
+# Columns of the lookups of retrieval_questions
+LOOKUP_COLUMNS = ['position', 'first_name', 'last_name', 'loinc_num', 'valid_start_time', 'as_of', 'exact']
+
+
+# Cache tags and transaction time cutoff of the queries (see ResultCache)
+def _query_time(date, time):
+    try:
+        return pd.Timestamp(f'{date} {time}')
+    except (TypeError, ValueError):
+        return None
+
+
+def _record_query_cache(engine, query):
+    (first_name, last_name, loinc_num, _, _, physician_date, physician_time) = query
+    cutoff = _query_time(physician_date, physician_time)
+    return None if cutoff is None else ({((first_name, last_name), loinc_num)}, cutoff)
+
+
+def _history_query_cache(engine, query):
+    (first_name, last_name, loinc_num) = query[:3]
+    return {((first_name, last_name), loinc_num)}, None
+
+
+# Patient states also depend on the knowledge base, they are evicted when it changes
+KNOWLEDGE_BASE_TAG = ('knowledge_base',)
+
+
+def _patient_states_cache(engine, query, sex=None):
+    cutoff = _query_time(*query)
+    if cutoff is None:
+        return None
+    engine._check_knowledge_base()
+    loinc_nums = list(PATIENT_STATE_LOINCS.values()) + [SEX_LOINC]
+    return {('*', loinc_num) for loinc_num in loinc_nums} | {KNOWLEDGE_BASE_TAG}, cutoff
+
 
 class DSSEngine:
-    def __init__(self, patient_data, knowlege_base):
+    # snapshot - optional TestResultsSnapshot, population queries read it (and its delta) instead of test_results
+    # store - optional ResultStore (ResultStore.load), population and validity queries are filtered in memory
+    # cache - ResultCache of the retrieval and patient state queries (a default one when None)
+    # executor - optional parallel.ShardedExecutor, past population states are evaluated in shards on its processes
+    def __init__(self, patient_data, knowlege_base, writer=None, snapshot=None, store=None, cache=None,
+                 executor=None):
         self.db = patient_data
         self.kb = knowlege_base
+        self.snapshot = snapshot
+        self.store = store
+        self.cache = ResultCache() if cache is None else cache
+        self.executor = executor
+        self.newest_transaction = None
+        self.knowledge_base_version = None
+        patient_data.on_write(self._written)
+        # Corrections and deletes of all the clinicians go through one group committing writer
+        self.writer = BitemporalWriter(patient_data) if writer is None else writer
+        # Current patient states, kept up to date with the writes
+        self.states = PatientStateView(patient_data, knowlege_base)
+
+    # Newest transaction time in test_results, read once and then followed from the writes
+    def newest_transaction_time(self):
+        if self.newest_transaction is None:
+            self.newest_transaction = self.db.get_max_transaction_time() or pd.Timestamp.min
+        return self.newest_transaction
+
+    # Write listener: evict the cached results the new records could change
+    def _written(self, records):
+        for record in records:
+            transaction_time = pd.Timestamp(record[6])
+            self.cache.invalidate((record[0], record[1]), record[2], transaction_time)
+            if self.newest_transaction is not None and transaction_time > self.newest_transaction:
+                self.newest_transaction = transaction_time
+
+    def _check_knowledge_base(self):
+        version = self.kb.snapshot().version
+        if version != self.knowledge_base_version:
+            self.cache.invalidate_tag(KNOWLEDGE_BASE_TAG)
+            self.knowledge_base_version = version
 
     # This function recieve query (patient details)/
     # from user and get required record from DB
+    @instrumented()
+    @cached_query(_record_query_cache)
     def retrieval_question(self, query):
-        print('hey')
         DB = self.db
         (patient_first_name, patient_last_name, loinc_num,
          valid_date, valid_time, physician_date, physician_time) = query
-        print('query:   ', query)
         without_valid_time = False
 
         # Check if date and time are provided
@@ -48,58 +125,186 @@ class DSSEngine:
         # Determine date and time according to physician view
         physician_record_time = pd.Timestamp(f'{physician_date} {physician_time}')
 
-        # filter relevant record- name, physician view point and loinc
-        print('@!@')
-        patient_data = DB.get_patient_data(patient_first_name, patient_last_name)
-        if patient_data is None:
-            print('yes')
+        # Look up the record in the patient's bitemporal index (rows are fetched once per patient)
+        index = DB.get_patient_index(patient_first_name, patient_last_name, loinc_num)
+        patient = (patient_first_name, patient_last_name)
         patient_data_columns = ['first_name','last_name','loinc_num', 'value','unit','valid_start_time','transaction_time']
-        patient_data_df = pd.DataFrame(patient_data, columns=patient_data_columns)
-        patient_data_df_loinc = patient_data_df[(patient_data_df['loinc_num'] == loinc_num)]
-        patient_data_df_loinc_phys = patient_data_df_loinc[(patient_data_df_loinc['transaction_time'] <= physician_record_time)]
-        print(patient_data_df_loinc_phys)
 
         # retrieve records where match the user inserted date and time
         if without_valid_time:
-            data_patient = patient_data_df_loinc_phys.copy()
-            # Create a column with date only, user insert date but not excact time
-            data_patient['valid_date_start_time'] = patient_data['valid_start_time'].dt.date
-            required_records = data_patient[data_patient['valid_date_start_time'] == valid_date_record_time]
-            required_records = required_records.loc[required_records['valid_start_time'].idxmax()]
+            # User insert date but not excact time, take the latest record of that day
+            with phase('filtering'):
+                required_record = index.latest_on_day(patient, loinc_num, valid_date_record_time, physician_record_time)
+            if required_record is None:
+                return "No record found."
+            required_records = pd.Series(required_record, index=patient_data_columns)
         else:
             # If user insert both, date and time
-            required_records = patient_data_df_loinc_phys[(patient_data_df_loinc_phys['valid_start_time'] == valid_record_time)]
+            with phase('filtering'):
+                required_record = index.value_at(patient, loinc_num, valid_record_time, physician_record_time)
+            required_records = pd.DataFrame([required_record] if required_record is not None else [],
+                                            columns=patient_data_columns)
 
         return required_records
 
+    # Many retrieval_question queries at once, e.g. every vital sign of every patient at 08:00.
+    # The rows of all the patients are fetched together (one query per BATCH_PATIENTS patients) and
+    # all the lookups are resolved with vectorized merges instead of one index lookup per query.
+    # Returns the retrieval_question results in the order of the queries, a query that cannot be
+    # answered gets its error message without failing the others.
+    @instrumented()
+    def retrieval_questions(self, queries):
+        queries = list(queries)
+        results = [None] * len(queries)
+        lookups = []
+        for position, query in enumerate(queries):
+            try:
+                (patient_first_name, patient_last_name, loinc_num,
+                 valid_date, valid_time, physician_date, physician_time) = query
+                if valid_date is None:
+                    results[position] = "No record found, insert valid start time."
+                    continue
+                if physician_date is None or physician_time is None:
+                    results[position] = "No record found, insert valid physician view time."
+                    continue
+                exact = valid_time is not None
+                valid_record_time = pd.Timestamp(f'{valid_date} {valid_time}') if exact \
+                    else pd.Timestamp(f'{valid_date}').normalize()
+                physician_record_time = pd.Timestamp(f'{physician_date} {physician_time}')
+            except (TypeError, ValueError) as error:
+                results[position] = f"Invalid query: {error}"
+                continue
+            # Like retrieval_question: no match is an empty DataFrame for a valid time, a message for a day
+            results[position] = pd.DataFrame(columns=RECORD_COLUMNS) if exact else "No record found."
+            lookups.append((position, patient_first_name, patient_last_name, loinc_num,
+                            valid_record_time, physician_record_time, exact))
+        if not lookups:
+            return results
+
+        lookups = pd.DataFrame(lookups, columns=LOOKUP_COLUMNS)
+        lookups = lookups.astype({'valid_start_time': 'datetime64[ns]', 'as_of': 'datetime64[ns]'})
+        patients = list(lookups[['first_name', 'last_name']].drop_duplicates().itertuples(index=False, name=None))
+        rows = []
+        for start in range(0, len(patients), BATCH_PATIENTS):
+            rows.extend(self.db.query_patients_test_results(patients[start:start + BATCH_PATIENTS],
+                                                            lookups['loinc_num'].unique()))
+        with phase('dataframe'):
+            versions = pd.DataFrame(rows, columns=['id'] + RECORD_COLUMNS)
+            versions['valid_start_time'] = pd.to_datetime(versions['valid_start_time']).astype('datetime64[ns]')
+            versions['transaction_time'] = pd.to_datetime(versions['transaction_time']).astype('datetime64[ns]')
+
+        with phase('filtering'):
+            found = pd.concat([self._exact_lookups(lookups[lookups['exact']], versions),
+                               self._day_lookups(lookups[~lookups['exact']], versions)])
+        for position, exact, record in zip(found['position'], found['exact'],
+                                           found[RECORD_COLUMNS].itertuples(index=False, name=None)):
+            results[position] = pd.DataFrame([record], columns=RECORD_COLUMNS) if exact \
+                else pd.Series(record, index=RECORD_COLUMNS)
+        return results
+
+    # Version of every exact valid time lookup known at its as_of: a merge-asof on the transaction time
+    # by patient, LOINC and valid time (versions recorded at the same time are told apart by id)
+    @staticmethod
+    def _exact_lookups(lookups, versions):
+        keys = ['first_name', 'last_name', 'loinc_num', 'valid_start_time']
+        found = pd.merge_asof(lookups.sort_values('as_of'), versions.sort_values(['transaction_time', 'id']),
+                              left_on='as_of', right_on='transaction_time', by=keys, direction='backward')
+        return found[found['transaction_time'].notna() & (found['value'] != DELETED_VALUE)]
+
+    # Latest measurement of the day of every day lookup known at its as_of,
+    # measurements deleted by then are skipped
+    @staticmethod
+    def _day_lookups(lookups, versions):
+        candidates = lookups.merge(versions, on=['first_name', 'last_name', 'loinc_num'], suffixes=('_day', ''))
+        day_start = candidates['valid_start_time_day']
+        candidates = candidates[(candidates['valid_start_time'] >= day_start)
+                                & (candidates['valid_start_time'] < day_start + pd.Timedelta(days=1))
+                                & (candidates['transaction_time'] <= candidates['as_of'])]
+        candidates = candidates.sort_values(['position', 'valid_start_time', 'transaction_time', 'id'])
+        latest = candidates.drop_duplicates(['position', 'valid_start_time'], keep='last')
+        return latest[latest['value'] != DELETED_VALUE].drop_duplicates('position', keep='last')
+
+    @instrumented()
+    @cached_query(_history_query_cache)
     def retrieval_history_question(self, query):
         DB = self.db
         (patient_first_name, patient_last_name, loinc_num,
          valid_start_date, valid_start_time, valid_end_date, valid_end_time) = query
-        print(query)
         # Check if date and time are provided
         if valid_start_date is None:
             return "No record found, insert valid start time."
 
         valid_start_record_time = pd.Timestamp(f'{valid_start_date} {valid_start_time}')
         valid_end_record_time = pd.Timestamp(f'{valid_end_date} {valid_end_time}')
-        print(valid_start_record_time)
-        print(valid_end_record_time)
-        # Filter data to retrieve relevant records
-        patient_data = DB.get_patient_data(patient_first_name, patient_last_name)
-        patient_data_columns = ['loinc_num', 'value','unit','valid_start_time','transaction_time']
-        patient_data_df = pd.DataFrame(patient_data, columns=patient_data_columns)
-        patient_data_loinc = patient_data_df[(patient_data_df['loinc_num'] == loinc_num)]
-        patient_data_in_range = patient_data_loinc[(patient_data_loinc['valid_start_time'] >= valid_start_record_time)]
-        patient_data_in_range = patient_data_in_range[(patient_data_in_range['valid_start_time'] <= valid_end_record_time)]
+        # Retrieve relevant records, the LOINC and time range are filtered by the database
+        patient_data = DB.query_test_results(patient_first_name, patient_last_name, loinc_num,
+                                             valid_from=valid_start_record_time, valid_to=valid_end_record_time)
+        patient_data_in_range = records_frame(patient_data)
 
         return patient_data_in_range
 
-    def update_record(self, new_value, query):
+    # Streaming variant of retrieval_history_question, one page of page_size rows at a time.
+    # after is the next_page returned with the previous page (None for the first page).
+    # With bucket ('minute', 'hour' or 'day') the page holds the measurements count and
+    # min/mean/max value per bucket (BUCKET_COLUMNS) instead of the raw rows.
+    # Returns (page DataFrame, next_page), next_page is None on the last page.
+    @instrumented()
+    def retrieval_history_page(self, query, after=None, page_size=500, bucket=None):
         DB = self.db
+        (patient_first_name, patient_last_name, loinc_num,
+         valid_start_date, valid_start_time, valid_end_date, valid_end_time) = query
+        # Check if date and time are provided
+        if valid_start_date is None:
+            return "No record found, insert valid start time."
+
+        valid_start_record_time = pd.Timestamp(f'{valid_start_date} {valid_start_time}')
+        valid_end_record_time = pd.Timestamp(f'{valid_end_date} {valid_end_time}')
+        if bucket is None:
+            patient_data, next_page = DB.query_test_results_page(
+                patient_first_name, patient_last_name, loinc_num,
+                valid_from=valid_start_record_time, valid_to=valid_end_record_time,
+                after=after, page_size=page_size)
+            return records_frame(patient_data), next_page
+
+        buckets, next_page = DB.query_test_result_buckets(
+            patient_first_name, patient_last_name, loinc_num,
+            valid_from=valid_start_record_time, valid_to=valid_end_record_time,
+            bucket=bucket, after=after, page_size=page_size)
+        buckets = pd.DataFrame(buckets, columns=BUCKET_COLUMNS)
+        buckets['bucket_start'] = pd.to_datetime(buckets['bucket_start'])
+        return buckets, next_page
+
+    # All the pages of retrieval_history_page, fetched only when the caller iterates to them
+    def retrieval_history_pages(self, query, page_size=500, bucket=None):
+        after = None
+        while True:
+            page = self.retrieval_history_page(query, after, page_size, bucket)
+            if isinstance(page, str):
+                raise ValueError(page)
+            page_data, after = page
+            yield page_data
+            if after is None:
+                return
+
+    # The version of a measurement the user refers to by its valid and transaction time
+    def _find_version(self, query):
+        (patient_first_name, patient_last_name, loinc_num,
+         valid_date, valid_time, transaction_date, transaction_time) = query
+        valid_record_time = pd.Timestamp(f'{valid_date} {valid_time}')
+        transaction_record_time = pd.Timestamp(f'{transaction_date} {transaction_time}')
+
+        # retrieve relevant records, only the versions of this LOINC valid time are fetched
+        patient_data = self.db.query_test_results(patient_first_name, patient_last_name, loinc_num,
+                                                  valid_from=valid_record_time, valid_to=valid_record_time)
+        versions = records_frame(patient_data)
+        return versions[versions['transaction_time'] == transaction_record_time]
+
+    # Correct a measurement: the new value is stored as a new version with the current
+    # transaction time, the older versions stay for the as-of queries
+    @instrumented()
+    def update_record(self, new_value, query):
         (patient_first_name, patient_last_name, loinc_num,
          valid_date, valid_time, transaction_date, transaction_time) = query
-        print(query)
         # Check if date and time are provided
         if valid_date is None or valid_time is None:
             return "No record found, insert valid start time."
@@ -107,32 +312,19 @@ class DSSEngine:
         if transaction_date is None or transaction_time is None:
             return "No record found, insert valid transaction time."
 
-        valid_record_time = pd.Timestamp(f'{valid_date} {valid_time}')
-        transaction_record_time = pd.Timestamp(f'{transaction_date} {transaction_time}')
+        required_record = self._find_version(query)
+        if required_record.empty:
+            return "No record found in inserted valid time and transaction time."
+        record = required_record.iloc[0]
 
-        # filter data to retrieve relevant records
-        patient_data = DB.get_patient_data(patient_first_name, patient_last_name)
-        patient_data_columns = ['loinc_num', 'value','unit','valid_start_time','transaction_time']
-        patient_data_df = pd.DataFrame(patient_data, columns=patient_data_columns)
-        patient_data_loinc = patient_data_df[(patient_data_df['loinc_num'] == loinc_num)]
-        patient_data_valid_time = patient_data_loinc[(patient_data_loinc['valid_start_time'] == valid_record_time)]
-        required_record = patient_data_valid_time[(patient_data_valid_time['transaction_time'] == transaction_record_time)]
-
-        if not required_record.empty:
-            # Get the index of the matching record
-            index_to_update = required_record.index[0]
-
-            # Update the 'Value' column for this record
-            required_record.loc[index_to_update, 'value'] = new_value
-            print(f"Updated record at index {index_to_update}:")
-            print(required_record.loc[index_to_update])
-        else:
-            print("No matching record found.")
-        
-        return ("The update was successful.", required_record)
+        new_version = self.writer.correct(patient_first_name, patient_last_name, loinc_num,
+                                          record['valid_start_time'], new_value, record['unit']).result()
+        return ("The update was successful.", records_frame([new_version]))
 
+    # Delete a measurement: a delete version (tombstone) is stored with the current transaction time,
+    # from then on the measurement is not found, as-of queries before it still see it
+    @instrumented()
     def delete_record(self, query):
-        DB = self.db
         (patient_first_name, patient_last_name, loinc_num,
          valid_date, valid_time, transaction_date, transaction_time) = query
 
@@ -140,78 +332,92 @@ class DSSEngine:
         if valid_date is None or transaction_date is None:
             return "No record found, insert valid start time or transaction time."
 
-        valid_record_time = pd.Timestamp(f'{valid_date} {valid_time}')
-        transaction_record_time = pd.Timestamp(f'{transaction_date} {transaction_time}')
-
-        # filter data to retrieve relevant records
-        patient_data = DB.get_patient_data(patient_first_name, patient_last_name)
-        patient_data_columns = ['first_name', 'last_name', 'loinc_num', 'value', 'unit', 'valid_start_time', 'transaction_time']
-        # patient_data_columns = ['loinc_num', 'value','unit','valid_start_time','transaction_time']
-        patient_data_df = pd.DataFrame(patient_data, columns=patient_data_columns)
-        print("patient: ", patient_data_df)
-        patient_data_to_save = patient_data_df.copy()
-        # Check which record to drop, required record
-        patient_data_df_loinc = patient_data_df[(patient_data_df['loinc_num'] == loinc_num)]
-        patient_data_valid_time = patient_data_df_loinc[(patient_data_df_loinc['valid_start_time'] == valid_record_time)]
-        required_record = patient_data_valid_time[(patient_data_valid_time['transaction_time'] == transaction_record_time)]
-
-        if not required_record.empty:
-            # Get the index of the matching record
-            rows_to_drop = required_record.index[0]
-            print(patient_data_to_save)
-            patient_data_to_save = patient_data_to_save.drop(rows_to_drop)
-            print(f'Record {rows_to_drop} as been removed:')
+        required_record = self._find_version(query)
+        if required_record.empty:
+            return "No record found in inserted valid time and transaction time."
+        record = required_record.iloc[0]
+
+        self.writer.delete(patient_first_name, patient_last_name, loinc_num,
+                           record['valid_start_time'], record['unit']).result()
+        return ("The delete was successful.", required_record)
+
+    # Values in force (by the good-before/good-after windows of the knowledge base) for many
+    # (first_name, last_name, loinc_num, time) queries at once, as the database was at as_of.
+    # Only the rows of the queried patients are read (one query per BATCH_PATIENTS patients) and indexed.
+    # Returns a DataFrame of the queries in the same order with value, valid_start_time, good_from, good_until.
+    @instrumented()
+    def values_in_force(self, queries, as_of=None):
+        queries = pd.DataFrame(list(queries), columns=['first_name', 'last_name', 'loinc_num', 'time'])
+        patients = list(queries[['first_name', 'last_name']].drop_duplicates().itertuples(index=False, name=None))
+        loinc_nums = list(queries['loinc_num'].unique())
+        if self.store is not None:
+            self.store.refresh()
+            records = self.store.query_patients_test_results(patients, loinc_nums)
         else:
-            print('There is no records in inserted time')
-
-        return ("The update was successful.", required_record.iloc[0])
-
-    def patients_states_and_recommendations(self, query):
+            rows = []
+            for start in range(0, len(patients), BATCH_PATIENTS):
+                rows.extend(self.db.query_patients_test_results(patients[start:start + BATCH_PATIENTS], loinc_nums))
+            # In id order, versions recorded at the same time are told apart by it
+            records = [row[1:] for row in sorted(rows)]
+        with phase('filtering'):
+            records = records_frame(records)
+            if as_of is not None:
+                records = records[records['transaction_time'] <= pd.Timestamp(as_of)]
+            index = ValidityIndex(validity_windows(self.kb)).load(records)
+            return index.values_at(queries)
+
+    # Subscribe to patient state changes instead of polling patients_states_and_recommendations.
+    # Returns a StateSubscription, subscription.get(timeout) gives the next debounced event.
+    def subscribe(self, debounce=1.0, patients=None):
+        return self.states.subscribe(debounce, patients)
+
+    def unsubscribe(self, subscription):
+        self.states.unsubscribe(subscription)
+
+    # States and recommendations of all the patients as the database was at the query time.
+    # sex - the sex of all the patients, None for the sex result (SEX_LOINC) of each patient
+    @instrumented()
+    @cached_query(_patient_states_cache)
+    def patients_states_and_recommendations(self, query, sex=None):
         DB = self.db
         (valid_end_date, valid_end_time) = query
-        valid_record_time = pd.Timestamp(f'{valid_end_date} {valid_end_time}')
-        all_patients = DB.get_all_patients()
-        for patient in all_patients:
-            first_name, last_name = patient['first_name'], patient['last_name']
-            patient_data = DB.get_patient_data_by_valid_end_time(first_name, last_name, valid_record_time)
-            wanted_loincs = {
-                "hemoglobin": '12181-4',
-                "wbc": '11218-5',
-                "fever":  '39106-0',
-                "chills": 'chills',
-                "skin-look": 'skin-look',
-                "allergic-state": 'allergic-state'
-
-            }
-            most_recent_result = self.get_most_recent_results_in_patiant_date(patient_data, wanted_loincs.values())
-
-            hemoglobin_state = self.kb
-
-            # TODO:Finish function to get patient state and recommendations
-
-
-
-    def get_most_recent_results_in_patiant_date(self, patient_data, wanted_loincs):
-        # Dictionary to store the most recent result for each LOINC number
-        most_recent_results = {}
-
-        for loinc_num, value, unit, valid_start_time, transaction_time in patient_data:
-            # If this LOINC number hasn't been seen yet, or if this result is more recent
-            if loinc_num in wanted_loincs:
-                if loinc_num not in most_recent_results.keys() or valid_start_time > most_recent_results[loinc_num][1]:
-                    most_recent_results[loinc_num] = (value, transaction_time)
-
-        return most_recent_results
-
 
+        # Check if date and time are provided
+        if not valid_end_date or not valid_end_time:
+            return "No record found, insert database state date and time."
+        valid_record_time = pd.Timestamp(f'{valid_end_date} {valid_end_time}')
 
+        # The current state of the patients is kept up to date, only past times are computed
+        if sex is None:
+            current_states = self.states.current_states(valid_record_time)
+            if current_states is not None:
+                return current_states
+
+        # Latest result of every patient for each wanted LOINC, in one query (or one scan of the snapshot)
+        source = DB
+        if self.store is not None:
+            self.store.refresh()
+            source = self.store
+        elif self.snapshot is not None:
+            self.snapshot.apply_delta()
+            source = self.snapshot
+        loinc_nums = list(PATIENT_STATE_LOINCS.values()) + [SEX_LOINC]
+        patient_data = records_frame(source.query_latest_results(loinc_nums, valid_record_time))
+        if patient_data.empty:
+            return []
+        if self.executor is not None:
+            return self.executor.patient_states(self.kb.snapshot(), patient_data, sex, self.states.sex)
+
+        # Classify all the patients at once with the compiled knowledge base
+        return latest_results_states(self.kb.snapshot(), patient_data, sex, self.states.sex)
 
 
 if __name__ == "__main__":
 
 
     patient_data = PatientData(host="localhost", user="root", password="q6rh3b", database="patient_data")
-    engine = DSSEngine(patient_data)
+    knowlege_base = KnowledgeBase(host="localhost", user="root", password="q6rh3b", database="kb")
+    engine = DSSEngine(patient_data, knowlege_base)
 
     query = ['Eyal', 'Rothman', '11218-5', '17/05/2018', '17:00:00', '25/05/2018',  '10:00:00']
     result = engine.retrieval_question(query)
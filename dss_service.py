@@ -0,0 +1,269 @@
+import argparse
+import asyncio
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+
+import pandas as pd
+
+from database import PatientData
+from dss_engine import DSSEngine
+from knowlege_base import KnowledgeBase
+from metrics import REGISTRY
+from storage import open_storage
+
+
+# Largest request body accepted (bytes)
+MAX_BODY = 1024 * 1024
+
+
+# JSON rows of a retrieval result: DataFrame rows, or the one row of a Series
+def json_rows(records):
+    if isinstance(records, pd.Series):
+        records = records.to_frame().T
+    return json.loads(records.to_json(orient='records', date_format='iso', date_unit='s'))
+
+
+# Response of an engine call, like the results of gui_interface.query_database:
+# an error message of the engine is a result that was not successful, not a failed request
+def response(query_result, rows=json_rows, message=""):
+    if isinstance(query_result, str):
+        return {"successful": False, "results": [], "message": query_result}
+    return {"successful": True, "results": rows(query_result), "message": message}
+
+
+def _record_query(request, time_fields):
+    return (request['first_name'], request['last_name'], request['loinc_num'],
+            request.get('valid_date'), request.get('valid_time')) + tuple(request.get(field) for field in time_fields)
+
+
+# ************ Endpoints: (engine, request JSON) -> response JSON, run on the worker threads ***********
+def specific(engine, request):
+    return response(engine.retrieval_question(_record_query(request, ('physician_date', 'physician_time'))))
+
+
+# Many specific queries in one request: {"queries": [[first_name, last_name, loinc_num, valid_date,
+# valid_time, physician_date, physician_time], ...]}, one response per query in the same order
+def specific_batch(engine, request):
+    return {"responses": [response(result) for result in engine.retrieval_questions(request['queries'])]}
+
+
+def historical(engine, request):
+    query = (request['first_name'], request['last_name'], request['loinc_num'], request.get('from_date'),
+             request.get('from_time'), request.get('to_date'), request.get('to_time'))
+    after = request.get('after')
+    query_result = engine.retrieval_history_page(query, tuple(after) if isinstance(after, list) else after,
+                                                 int(request.get('page_size', 500)), request.get('bucket'))
+    if isinstance(query_result, str):
+        return response(query_result)
+    page, next_page = query_result
+    return dict(response(page), next_page=next_page)
+
+
+def update(engine, request):
+    query = _record_query(request, ('transaction_date', 'transaction_time'))
+    return response(engine.update_record(request['new_value'], query), lambda result: json_rows(result[1]),
+                    "Update was Successful")
+
+
+def delete(engine, request):
+    query = _record_query(request, ('transaction_date', 'transaction_time'))
+    return response(engine.delete_record(query), lambda result: json_rows(result[1]), "Delete was Successful")
+
+
+def patient_state(engine, request):
+    query = (request.get('db_state_date'), request.get('db_state_time'))
+    return response(engine.patients_states_and_recommendations(query), list)
+
+
+ENDPOINTS = {
+    '/specific': specific,
+    '/specific_batch': specific_batch,
+    '/historical': historical,
+    '/update': update,
+    '/delete': delete,
+    '/patient_state': patient_state,
+}
+
+# Fields an endpoint can't do without, a request missing one gets 400 Bad Request
+PATIENT_FIELDS = ('first_name', 'last_name', 'loinc_num')
+REQUIRED_FIELDS = {
+    '/specific': PATIENT_FIELDS,
+    '/specific_batch': ('queries',),
+    '/historical': PATIENT_FIELDS,
+    '/update': PATIENT_FIELDS + ('new_value',),
+    '/delete': PATIENT_FIELDS,
+    '/patient_state': (),
+}
+
+# Endpoints that change the database: they are not timed out, a client that got a timeout
+# would send the change again while the first one is still applied
+WRITE_ENDPOINTS = ('/update', '/delete')
+
+
+class DSSService:
+    # HTTP/JSON service of a DSSEngine on an asyncio server. Every endpoint is a POST of a JSON object
+    # (the fields of the matching GUI tab), GET /health and GET /metrics (Prometheus text) are also served.
+    # The engine calls block on the database, they run on a bounded pool of worker threads
+    # that share the pooled connections of the engine.
+    # workers - worker threads (give the connection pool at least as many connections)
+    # queue_size - requests waiting for a worker, more get 503 Service Unavailable
+    # timeout - seconds a query may take, slower ones get 504 Gateway Timeout (updates and deletes wait)
+    def __init__(self, engine, workers=8, queue_size=256, timeout=10.0):
+        self.engine = engine
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='dss-service')
+        self.max_pending = workers + queue_size
+        self.pending = 0
+        self.timeout = timeout
+        self.port = None
+        self.ready = threading.Event()
+
+    async def serve(self, host='127.0.0.1', port=8080):
+        server = await asyncio.start_server(self._handle_connection, host, port)
+        self.port = server.sockets[0].getsockname()[1]
+        self.ready.set()
+        async with server:
+            await server.serve_forever()
+
+    # Serve from a daemon thread with its own event loop, returns once the port is open
+    def start_in_thread(self, host='127.0.0.1', port=0):
+        threading.Thread(target=asyncio.run, args=(self.serve(host, port),), daemon=True).start()
+        self.ready.wait()
+        return self.port
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.engine.writer.close()
+
+    # HTTP/1.1 requests of one connection, kept alive until the client closes it
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get('content-length', 0))
+                if length > MAX_BODY:
+                    status, payload = HTTPStatus.REQUEST_ENTITY_TOO_LARGE, {"message": "Request body too large."}
+                    keep_alive = False
+                else:
+                    body = await reader.readexactly(length)
+                    status, payload = await self.dispatch(method, path.split('?')[0], body)
+                    keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                writer.write(self._response(status, payload, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def dispatch(self, method, path, body):
+        if method == 'GET' and path == '/health':
+            return HTTPStatus.OK, {"status": "ok", "pending": self.pending}
+        if method == 'GET' and path == '/metrics':
+            return HTTPStatus.OK, REGISTRY.to_prometheus()
+        endpoint = ENDPOINTS.get(path)
+        if endpoint is None:
+            return HTTPStatus.NOT_FOUND, {"message": f"Unknown endpoint {path}"}
+        if method != 'POST':
+            return HTTPStatus.METHOD_NOT_ALLOWED, {"message": "Use POST with a JSON body."}
+        try:
+            request = json.loads(body or b'{}')
+        except ValueError as error:
+            return HTTPStatus.BAD_REQUEST, {"message": f"Invalid JSON: {error}"}
+        if not isinstance(request, dict):
+            return HTTPStatus.BAD_REQUEST, {"message": "The request must be a JSON object."}
+        missing = [field for field in REQUIRED_FIELDS[path] if field not in request]
+        if missing:
+            return HTTPStatus.BAD_REQUEST, {"message": f"Missing field {', '.join(missing)}"}
+        if self.pending >= self.max_pending:
+            return HTTPStatus.SERVICE_UNAVAILABLE, {"message": "Too many requests waiting, try again later."}
+
+        # A request holds its slot until its worker is done, also after it timed out
+        self.pending += 1
+        future = asyncio.get_running_loop().run_in_executor(self.executor, endpoint, self.engine, request)
+        future.add_done_callback(self._release)
+        timeout = None if path in WRITE_ENDPOINTS else self.timeout
+        try:
+            return HTTPStatus.OK, await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            return HTTPStatus.GATEWAY_TIMEOUT, {"message": f"No answer in {self.timeout} seconds."}
+        except (TypeError, ValueError) as error:
+            return HTTPStatus.BAD_REQUEST, {"message": str(error)}
+        except Exception as error:
+            return HTTPStatus.INTERNAL_SERVER_ERROR, {"message": f"{type(error).__name__}: {error}"}
+
+    def _release(self, future):
+        self.pending -= 1
+
+    @staticmethod
+    def _response(status, payload, keep_alive):
+        if isinstance(payload, str):
+            body, content_type = payload.encode('utf-8'), 'text/plain; version=0.0.4'
+        else:
+            body, content_type = json.dumps(payload, default=str).encode('utf-8'), 'application/json'
+        head = (f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+        return head.encode('latin-1') + body
+
+
+# Engine of the MySQL databases, or of SQLite files (sqlite, kb_sqlite), with a connection per worker
+def open_engine(workers, sqlite=None, kb_sqlite=None, host="localhost", user="root", password="q6rh3b",
+                database="patient_data", kb_database="kb"):
+    if sqlite:
+        patient_data = PatientData(pool=open_storage('sqlite', sqlite, size=workers))
+    else:
+        patient_data = PatientData(pool=open_storage('mysql', host=host, user=user, password=password,
+                                                     database=database, size=workers))
+    if kb_sqlite:
+        knowlege_base = KnowledgeBase(pool=open_storage('sqlite', kb_sqlite, size=workers, knowledge_base=True))
+    else:
+        knowlege_base = KnowledgeBase(pool=open_storage('mysql', host=host, user=user, password=password,
+                                                        database=kb_database, size=workers))
+    return DSSEngine(patient_data, knowlege_base)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the DSS engine queries as HTTP/JSON endpoints.")
+    parser.add_argument('--bind', default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=8, help="worker threads and pooled connections")
+    parser.add_argument('--queue-size', type=int, default=256, help="requests waiting for a worker before 503")
+    parser.add_argument('--timeout', type=float, default=10.0, help="seconds before a request gets 504")
+    parser.add_argument('--host', default="localhost")
+    parser.add_argument('--user', default="root")
+    parser.add_argument('--password', default="q6rh3b")
+    parser.add_argument('--database', default="patient_data")
+    parser.add_argument('--kb-database', default="kb")
+    parser.add_argument('--sqlite', help="patient data SQLite file instead of MySQL")
+    parser.add_argument('--kb-sqlite', help="knowledge base SQLite file instead of MySQL")
+    args = parser.parse_args()
+
+    engine = open_engine(args.workers, args.sqlite, args.kb_sqlite, args.host, args.user, args.password,
+                         args.database, args.kb_database)
+    service = DSSService(engine, args.workers, args.queue_size, args.timeout)
+    print(f"Serving on http://{args.bind}:{args.port}")
+    try:
+        asyncio.run(service.serve(args.bind, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,39 @@
 import PySimpleGUI as sg
-import datetime
-from database import PatientData
-from dss_engine import DSSEngine
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-# ************** Utilities for GUI *****************
-patient_data = PatientData(host="localhost", user="root", password="q6rh3b", database="patient_data")
-engine = DSSEngine(patient_data)
-
-
-# Get all recorded patients in the database
-def get_patient_list():
-    return patient_data.get_all_patients()
+from pick_lists import PickLists
 
-
-# Get all recorded LOINC numbers in the database
-def get_loinc_list():
-    return patient_data.get_all_loinc_numbers()
+# ************** Utilities for GUI *****************
+# The engine is made on first use, on a worker thread: the window shows before pandas,
+# the database driver and the connections are loaded
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            from database import PatientData
+            from dss_engine import DSSEngine
+            from knowlege_base import KnowledgeBase
+            patient_data = PatientData(host="localhost", user="root", password="q6rh3b", database="patient_data")
+            knowlege_base = KnowledgeBase(host="localhost", user="root", password="q6rh3b", database="kb")
+            _engine = DSSEngine(patient_data, knowlege_base)
+        return _engine
+
+
+# Refresh the pick lists in the background, the window gets them with the -PICK_LISTS- event
+def refresh_pick_lists(window, pick_lists):
+    try:
+        pick_lists.refresh(get_engine().db)
+    except Exception as error:
+        print(f"Pick lists refresh failed: {error}")
+        return
+    window.write_event_value("-PICK_LISTS-", (pick_lists.patients, pick_lists.loinc_numbers))
 
 
 # Get a list of times of day in 15 min intervals
@@ -28,6 +46,11 @@ def get_time_list():
     return times
 
 
+# Historical query pages, and the aggregation choices of the Historical Query tab
+HISTORY_PAGE_SIZE = 500
+HISTORY_BUCKETS = {"Raw": None, "Per minute": 'minute', "Per hour": 'hour', "Per day": 'day'}
+
+
 # ************ Query managers ***********************
 # direct ech GUI query to the relevant engine function
 def query_database(query_type, **kwargs):
@@ -61,7 +84,7 @@ def query_database(query_type, **kwargs):
 
         result = query_patients_states(kwargs, result)
 
-    return result["Successful"], result["result_list"], result["message"]
+    return result["Successful"], result["result_list"], result["message"], result.get("next_page")
 
 
 def query_patients_states(kwargs, result):
@@ -71,7 +94,7 @@ def query_patients_states(kwargs, result):
 
     # Results
     result = {"Successful": True, "result_list": [], "message": ""}
-    query_result = engine.patient_states(query)
+    query_result = get_engine().patients_states_and_recommendations(query)
 
     if isinstance(query_result, str):  # Case an Error message is returned from query
         result["Successful"] = False
@@ -95,13 +118,13 @@ def query_delete_record(kwargs, result):
 
     # Results
     result = {"Successful": True, "result_list": [], "message": ""}
-    query_result = engine.delete_record(query)
+    query_result = get_engine().delete_record(query)
 
     if isinstance(query_result, str):  # Case an Error message is returned from query
         result["Successful"] = False
         result["message"] = query_result
     else:
-        result["result_list"] = query_result
+        result["result_list"] = record_rows(query_result[1])
         result["message"] = "Delete was Successful"
 
     return result
@@ -121,17 +144,49 @@ def query_update_record(kwargs):
 
     # Results
     result = {"Successful": True, "result_list": [], "message": ""}
-    query_result = engine.update_record(new_value, query)
+    query_result = get_engine().update_record(new_value, query)
     if isinstance(query_result, str):  # Case an Error message is returned from query
         result["Successful"] = False
         result["message"] = query_result
     else:
-        result["result_list"] = query_result
+        result["result_list"] = record_rows(query_result[1])
         result["message"] = "Update was Successful"
 
     return result
 
 
+# Table rows of test_results records (update and delete tabs)
+def record_rows(records):
+    return [{
+        "patient_name": f"{row.first_name} {row.last_name}",
+        "loinc_number": row.loinc_num,
+        "result": row.value,
+        "valid_date": row.valid_start_time.strftime('%Y-%m-%d'),
+        "valid_time": row.valid_start_time.strftime('%H:%M:%S'),
+        "transaction_date": row.transaction_time.strftime('%Y-%m-%d'),
+        "transaction_time": row.transaction_time.strftime('%H:%M:%S'),
+    } for row in records.itertuples()]
+
+
+# Table rows of a page of historical results, raw rows or per time bucket aggregates
+def history_rows(patient_name, loinc_number, page, bucket):
+    rows = []
+    if bucket is None:
+        for record in page.itertuples(index=False):
+            rows.append({"patient_name": patient_name, "loinc_number": loinc_number, "result": record.value,
+                         "date": record.valid_start_time.strftime("%Y-%m-%d"),
+                         "time": record.valid_start_time.strftime("%H:%M"),
+                         "db_state": str(record.transaction_time)})
+    else:
+        for record in page.itertuples(index=False):
+            rows.append({"patient_name": patient_name, "loinc_number": loinc_number,
+                         "result": f"min {record.min_value:g} / mean {record.mean_value:.2f} / max {record.max_value:g} ({record.measurements})",
+                         "date": record.bucket_start.strftime("%Y-%m-%d"),
+                         "time": record.bucket_start.strftime("%H:%M"),
+                         "db_state": ""})
+    return rows
+
+
 def query_retrieval_history(kwargs):
     full_name = str(kwargs['patient_name'])
     first_name, last_name = full_name.split(" ")
@@ -142,14 +197,18 @@ def query_retrieval_history(kwargs):
     to_db_state_time = kwargs['to_db_state_time']
     query = (first_name, last_name, loinc_number,
              from_db_state_date, from_db_state_time, to_db_state_date, to_db_state_time)
+    # Only one page is fetched, 'after' asks for the page after the previous one
+    bucket = HISTORY_BUCKETS.get(kwargs.get('bucket'))
+
     # Results
-    result = {"Successful": True, "result_list": [], "message": ""}
-    query_result = engine.retrieval_history_question(query)
+    result = {"Successful": True, "result_list": [], "message": "", "next_page": None}
+    query_result = get_engine().retrieval_history_page(query, kwargs.get('after'), HISTORY_PAGE_SIZE, bucket)
     if isinstance(query_result, str):  # Case an Error message is returned from query
         result["Successful"] = False
         result["message"] = query_result
     else:
-        result["result_list"] = query_result
+        page, result["next_page"] = query_result
+        result["result_list"] = history_rows(full_name, loinc_number, page, bucket)
 
     return result
 
@@ -168,7 +227,7 @@ def query_retrieval_question(kwargs):
 
     # Results
     result = {"Successful": True, "result_list": [], "message": ""}
-    query_result = engine.retrieval_question(query)
+    query_result = get_engine().retrieval_question(query)
     if isinstance(query_result, str):  # Case an Error message is returned from query
         result["Successful"] = False
         result["message"] = query_result
@@ -177,11 +236,103 @@ def query_retrieval_question(kwargs):
     return result
 
 
+# ************ Background queries *******************
+# Queries run on a worker pool so the window keeps responding while they run.
+# Every tab has at most one current query: starting a newer one or pushing Cancel
+# drops the older one (it is cancelled if it did not start yet, otherwise its result is ignored).
+# An update or delete that started can't be taken back: Cancel keeps it, and its result is shown when it ends,
+# a new update or delete of its tab is refused until then.
+# The workers only post the result back as a window event, all the GUI updates happen in the event loop.
+WRITE_PREFIXES = ("-UQ-", "-DQ-")
+WRITE_STILL_RUNNING = "The change before is still being applied, submit again when it is done."
+
+
+class QueryRunner:
+    def __init__(self, window, max_workers=4):
+        self.window = window
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.running = {}  # tab prefix -> (query id, future, start time)
+        self.cancel_requested = set()  # tab prefixes of started writes Cancel was pushed for
+        self.last_query_id = 0
+
+    # Run a query as the current query of its tab, the query before it is cancelled.
+    # A write of the tab that already started can't be cancelled: returns False and runs nothing until it ends.
+    def submit(self, prefix, query_type, **kwargs):
+        query = self.running.get(prefix)
+        if query is not None and prefix in WRITE_PREFIXES and not query[1].cancel():
+            return False
+        self.cancel(prefix)
+        self.cancel_requested.discard(prefix)
+        self.last_query_id += 1
+        query_id = self.last_query_id
+        future = self.executor.submit(self._run, prefix, query_id, query_type, kwargs)
+        self.running[prefix] = (query_id, future, time.monotonic())
+        return True
+
+    def _run(self, prefix, query_id, query_type, kwargs):
+        try:
+            result = query_database(query_type, **kwargs)
+        except Exception as error:
+            result = (False, [], f"Query failed: {error}", None)
+        self.window.write_event_value(f"{prefix}DONE-", (query_id, result))
+
+    # Cancel the current query of a tab. Returns "cancelled" when it is dropped, "applying" for a write
+    # that already started (it may still be applied, it stays the current query), None without a query
+    def cancel(self, prefix):
+        query = self.running.get(prefix)
+        if query is None:
+            return None
+        if not query[1].cancel() and prefix in WRITE_PREFIXES:
+            self.cancel_requested.add(prefix)
+            return "applying"
+        del self.running[prefix]
+        return "cancelled"
+
+    # True if the finished query is still the current query of its tab
+    def finish(self, prefix, query_id):
+        query = self.running.get(prefix)
+        if query is None or query[0] != query_id:
+            return False
+        del self.running[prefix]
+        self.cancel_requested.discard(prefix)
+        return True
+
+    # Seconds each running query has been running, by tab prefix
+    def progress(self):
+        now = time.monotonic()
+        return {prefix: now - start for prefix, (_, _, start) in self.running.items()}
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+# Show the result of a finished query in its tab
+def show_query_result(window, prefix, is_successful, results, message):
+    if prefix == "-PS-":
+        if is_successful:
+            window["-PS-RESULTS-"].update(values=[[r["patient_name"], r["hemoglobin_state"], r["hematological_state"], r["toxicity_grade"]] for r in results])
+            all_recommendations = ""
+            for patient in results:
+                patient_name = patient['patient_name']
+                recommendations = "\n  - ".join(patient['recommendations'])
+                all_recommendations += f"Recommendations for {patient_name}:\n  - {recommendations}\n\n"
+            # Update the GUI element with all patients' recommendations
+            window["-PS-RECOMMENDATIONS-"].update(all_recommendations)
+        window["-PS-MESSAGE-"].update(message)
+        return
+
+    if is_successful:
+        window[f"{prefix}RESULTS-"].update(values=[list(result.values()) for result in results])
+    if not is_successful or prefix in ("-UQ-", "-DQ-"):
+        window[f"{prefix}MESSAGE-"].update(message)
+
+
 # GUI Manager
 def create_gui():
-    # Relevant lists for GUI
-    patient_list = get_patient_list()
-    loinc_list = get_loinc_list()
+    # Relevant lists for GUI, the saved pick lists are refreshed once the window is up
+    pick_lists = PickLists()
+    patient_list = pick_lists.patients
+    loinc_list = pick_lists.loinc_numbers
     time_list = get_time_list()
 
     # The GUI layout - Each tab in the list is a query
@@ -196,7 +347,8 @@ def create_gui():
                 [sg.Text("Database State Date:"), sg.Input(key="-SQ-DB_STATE_DATE-"),
                  sg.CalendarButton("Select DB State Date", target="-SQ-DB_STATE_DATE-", format="%Y-%m-%d")],
                 [sg.Text("Database State Time:"), sg.Combo(time_list, key="-SQ-DB_STATE_TIME-", size=(30, 1))],
-                [sg.Button("Query Specific", key="-SQ-QUERY-"), sg.Button("Clear", key="-SQ-CLEAR-")],
+                [sg.Button("Query Specific", key="-SQ-QUERY-"), sg.Button("Clear", key="-SQ-CLEAR-"), sg.Button("Cancel", key="-SQ-CANCEL-"),
+                 sg.Text("", key="-SQ-PROGRESS-", text_color="blue")],
                 [sg.Table(values=[], headings=["Patient Name", "LOINC Number", "Result", "Date", "Time"],
                           auto_size_columns=True, justification="left", num_rows=10, key="-SQ-RESULTS-")],
                  [sg.Text("", key="-SQ-MESSAGE-", text_color="green")]
@@ -213,10 +365,13 @@ def create_gui():
                  [sg.Text("To DB State Date:"), sg.Input(key="-HQ-TO_DB_STATE_DATE-"),
                   sg.CalendarButton("Select To Date", target="-HQ-TO_DB_STATE_DATE-", format="%Y-%m-%d")],
                  [sg.Text("To DB State Time:"), sg.Combo(time_list, key="-HQ-TO_DB_STATE_TIME-", size=(30, 1))],
-                 [sg.Button("Query Historical", key="-HQ-QUERY-"), sg.Button("Clear", key="-HQ-CLEAR-")],
+                 [sg.Text("Show:"), sg.Combo(list(HISTORY_BUCKETS), default_value="Raw", key="-HQ-BUCKET-", readonly=True, size=(30, 1))],
+                 [sg.Button("Query Historical", key="-HQ-QUERY-"), sg.Button("Clear", key="-HQ-CLEAR-"), sg.Button("Cancel", key="-HQ-CANCEL-"),
+                  sg.Text("", key="-HQ-PROGRESS-", text_color="blue")],
                  [sg.Table(values=[], headings=["Patient Name", "LOINC Number", "Result", "Date", "Time", "DB State"],
                            auto_size_columns=True, justification="left", num_rows=10, key="-HQ-RESULTS-")],
-                 [sg.Text("", key="-HQ-MESSAGE-", text_color="green")]
+                 [sg.Button("More Results", key="-HQ-MORE-", disabled=True),
+                  sg.Text("", key="-HQ-MESSAGE-", text_color="green")]
              ]),
              sg.Tab('Update Query', [
                  [sg.Text("Patient Full Name:"), sg.Combo(patient_list, key="-UQ-PATIENT_NAME-", size=(30, 1))],
@@ -228,7 +383,8 @@ def create_gui():
                  [sg.Text("Transaction Date:"), sg.Input(key="-UQ-TRANSACTION_DATE-"),
                   sg.CalendarButton("Select Transaction Date", target="-UQ-TRANSACTION_DATE-", format="%Y-%m-%d")],
                  [sg.Text("Transaction Time:"), sg.Combo(time_list, key="-UQ-TRANSACTION_TIME-", size=(30, 1))],
-                 [sg.Button("Update Query", key="-UQ-QUERY-"), sg.Button("Clear", key="-UQ-CLEAR-")],
+                 [sg.Button("Update Query", key="-UQ-QUERY-"), sg.Button("Clear", key="-UQ-CLEAR-"), sg.Button("Cancel", key="-UQ-CANCEL-"),
+                  sg.Text("", key="-UQ-PROGRESS-", text_color="blue")],
                  [sg.Table(values=[], headings=["Patient Name", "LOINC Number", "Result", "Valid Date", "Valid Time",
                                                 "Transaction Date", "Transaction Time"],
                            auto_size_columns=True, justification="left", num_rows=10, key="-UQ-RESULTS-")],
@@ -243,7 +399,8 @@ def create_gui():
                  [sg.Text("Transaction Date:"), sg.Input(key="-DQ-TRANSACTION_DATE-"),
                   sg.CalendarButton("Select Transaction Date", target="-DQ-TRANSACTION_DATE-", format="%Y-%m-%d")],
                  [sg.Text("Transaction Time:"), sg.Combo(time_list, key="-DQ-TRANSACTION_TIME-", size=(30, 1))],
-                 [sg.Button("Delete Query", key="-DQ-QUERY-"), sg.Button("Clear", key="-DQ-CLEAR-")],
+                 [sg.Button("Delete Query", key="-DQ-QUERY-"), sg.Button("Clear", key="-DQ-CLEAR-"), sg.Button("Cancel", key="-DQ-CANCEL-"),
+                  sg.Text("", key="-DQ-PROGRESS-", text_color="blue")],
                  [sg.Table(values=[], headings=["Patient Name", "LOINC Number", "Result", "Valid Date", "Valid Time",
                                                 "Transaction Date", "Transaction Time"],
                            auto_size_columns=True, justification="left", num_rows=10, key="-DQ-RESULTS-")],
@@ -253,90 +410,117 @@ def create_gui():
                  [sg.Text("Database State Date:"), sg.Input(key="-PS-DB_STATE_DATE-"),
                   sg.CalendarButton("Select DB State Date", target="-PS-DB_STATE_DATE-", format="%Y-%m-%d")],
                  [sg.Text("Database State Time:"), sg.Combo(time_list, key="-PS-DB_STATE_TIME-", size=(30, 1))],
-                 [sg.Button("Query Patient State", key="-PS-QUERY-"), sg.Button("Clear", key="-PS-CLEAR-")],
+                 [sg.Button("Query Patient State", key="-PS-QUERY-"), sg.Button("Clear", key="-PS-CLEAR-"), sg.Button("Cancel", key="-PS-CANCEL-"),
+                  sg.Text("", key="-PS-PROGRESS-", text_color="blue")],
                  [sg.Table(values=[],
                            headings=["Patient Name", "Hemoglobin State", "Hematological State", "Toxicity Grade"],
                            auto_size_columns=True, justification="left", num_rows=10, key="-PS-RESULTS-")],
-                 [sg.Multiline(size=(60, 5), key="-PS-RECOMMENDATIONS-", disabled=True)]
+                 [sg.Multiline(size=(60, 5), key="-PS-RECOMMENDATIONS-", disabled=True)],
+                 [sg.Text("", key="-PS-MESSAGE-", text_color="green")]
              ])
             ]
         ])]
     ]
 
     # Opening the GUI window
-    window = sg.Window("Clinical DSS", layout, resizable=True)
+    window = sg.Window("Clinical DSS", layout, resizable=True, finalize=True)
+    runner = QueryRunner(window)
+    runner.executor.submit(refresh_pick_lists, window, pick_lists)
+    history = {"query": None, "rows": [], "next_page": None}
 
-    # Logical loop for directing each use button pushes / selections to a relevant function
+    # Logical loop for directing each use button pushes / selections to a relevant function.
+    # The timeout lets the loop refresh the progress of the running queries.
     while True:
-        event, values = window.read()
+        event, values = window.read(timeout=200)
         if event == sg.WINDOW_CLOSED:
             break
+        elif event == sg.TIMEOUT_EVENT:
+            for prefix, elapsed in runner.progress().items():
+                if prefix in runner.cancel_requested:
+                    window[f"{prefix}PROGRESS-"].update(
+                        f"Cancel requested, the change may still be applied... {elapsed:.0f}s")
+                else:
+                    window[f"{prefix}PROGRESS-"].update(f"Running query... {elapsed:.0f}s")
+        elif event == "-PICK_LISTS-":
+            patient_list, loinc_list = values[event]
+            for prefix in ("-SQ-", "-HQ-", "-UQ-", "-DQ-"):
+                window[f"{prefix}PATIENT_NAME-"].update(value=values[f"{prefix}PATIENT_NAME-"], values=patient_list)
+                window[f"{prefix}LOINC-"].update(value=values[f"{prefix}LOINC-"], values=loinc_list)
         elif event == "-SQ-QUERY-":
-            is_successful, results, message = query_database("specific",
-                                     patient_name=values["-SQ-PATIENT_NAME-"],
-                                     loinc_number=values["-SQ-LOINC-"],
-                                     date=values["-SQ-DATE-"],
-                                     time=values["-SQ-TIME-"],
-                                     db_state_date=values["-SQ-DB_STATE_DATE-"],
-                                     db_state_time=values["-SQ-DB_STATE_TIME-"])
-            if is_successful:
-                window["-SQ-RESULTS-"].update(values=[list(result.values()) for result in results])
-            else:
-                window["-SQ-MESSAGE-"].update(message)
+            runner.submit("-SQ-", "specific",
+                          patient_name=values["-SQ-PATIENT_NAME-"],
+                          loinc_number=values["-SQ-LOINC-"],
+                          date=values["-SQ-DATE-"],
+                          time=values["-SQ-TIME-"],
+                          db_state_date=values["-SQ-DB_STATE_DATE-"],
+                          db_state_time=values["-SQ-DB_STATE_TIME-"])
         elif event == "-HQ-QUERY-":
-            is_successful, results, message = query_database("historical",
-                                     patient_name=values["-HQ-PATIENT_NAME-"],
-                                     loinc_number=values["-HQ-LOINC-"],
-                                     date=values["-HQ-DATE-"],
-                                     time=values["-HQ-TIME-"],
-                                     from_db_state_date=values["-HQ-FROM_DB_STATE_DATE-"],
-                                     from_db_state_time=values["-HQ-FROM_DB_STATE_TIME-"],
-                                     to_db_state_date=values["-HQ-TO_DB_STATE_DATE-"],
-                                     to_db_state_time=values["-HQ-TO_DB_STATE_TIME-"])
-            if is_successful:
-                window["-HQ-RESULTS-"].update(values=[list(result.values()) for result in results])
-            else:
-                window["-HQ-MESSAGE-"].update(message)
+            # A new historical query starts from its first page
+            history["query"] = dict(patient_name=values["-HQ-PATIENT_NAME-"],
+                                    loinc_number=values["-HQ-LOINC-"],
+                                    date=values["-HQ-DATE-"],
+                                    time=values["-HQ-TIME-"],
+                                    from_db_state_date=values["-HQ-FROM_DB_STATE_DATE-"],
+                                    from_db_state_time=values["-HQ-FROM_DB_STATE_TIME-"],
+                                    to_db_state_date=values["-HQ-TO_DB_STATE_DATE-"],
+                                    to_db_state_time=values["-HQ-TO_DB_STATE_TIME-"],
+                                    bucket=values["-HQ-BUCKET-"])
+            history["rows"] = []
+            window["-HQ-MORE-"].update(disabled=True)
+            runner.submit("-HQ-", "historical", **history["query"])
+        elif event == "-HQ-MORE-":
+            if history["next_page"] is not None:
+                window["-HQ-MORE-"].update(disabled=True)
+                runner.submit("-HQ-", "historical", **history["query"], after=history["next_page"])
         elif event == "-UQ-QUERY-":
-            is_successful, results, message = query_database("update",
-                                              patient_name=values["-UQ-PATIENT_NAME-"],
-                                              loinc_number=values["-UQ-LOINC-"],
-                                              new_value=values['-UQ-VALUE-'],
-                                              valid_date=values["-UQ-VALID_DATE-"],
-                                              valid_time=values["-UQ-VALID_TIME-"],
-                                              transaction_date=values["-UQ-TRANSACTION_DATE-"],
-                                              transaction_time=values["-UQ-TRANSACTION_TIME-"])
-            if is_successful:
-                window["-UQ-RESULTS-"].update(values=[list(result.values()) for result in results])
-            window["-UQ-MESSAGE-"].update(message)
+            submitted = runner.submit("-UQ-", "update",
+                          patient_name=values["-UQ-PATIENT_NAME-"],
+                          loinc_number=values["-UQ-LOINC-"],
+                          new_value=values['-UQ-VALUE-'],
+                          valid_date=values["-UQ-VALID_DATE-"],
+                          valid_time=values["-UQ-VALID_TIME-"],
+                          transaction_date=values["-UQ-TRANSACTION_DATE-"],
+                          transaction_time=values["-UQ-TRANSACTION_TIME-"])
+            if not submitted:
+                window["-UQ-MESSAGE-"].update(WRITE_STILL_RUNNING)
         elif event == "-DQ-QUERY-":
-            is_successful, results, message = query_database("delete",
-                                              patient_name=values["-DQ-PATIENT_NAME-"],
-                                              loinc_number=values["-DQ-LOINC-"],
-                                              valid_date=values["-DQ-VALID_DATE-"],
-                                              valid_time=values["-DQ-VALID_TIME-"],
-                                              transaction_date=values["-DQ-TRANSACTION_DATE-"],
-                                              transaction_time=values["-DQ-TRANSACTION_TIME-"])
-            if is_successful:
-                window["-DQ-RESULTS-"].update(values=[list(result.values()) for result in results])
-            window["-DQ-MESSAGE-"].update(message)
+            submitted = runner.submit("-DQ-", "delete",
+                          patient_name=values["-DQ-PATIENT_NAME-"],
+                          loinc_number=values["-DQ-LOINC-"],
+                          valid_date=values["-DQ-VALID_DATE-"],
+                          valid_time=values["-DQ-VALID_TIME-"],
+                          transaction_date=values["-DQ-TRANSACTION_DATE-"],
+                          transaction_time=values["-DQ-TRANSACTION_TIME-"])
+            if not submitted:
+                window["-DQ-MESSAGE-"].update(WRITE_STILL_RUNNING)
         elif event == "-PS-QUERY-":
-            is_successful, results, message = query_database("patient_state",
-                                     db_state_date=values["-PS-DB_STATE_DATE-"],
-                                     db_state_time=values["-PS-DB_STATE_TIME-"])
-            if is_successful:
-                window["-PS-RESULTS-"].update(values=[[r["patient_name"], r["hemoglobin_state"], r["hematological_state"], r["toxicity_grade"]] for r in results])
-                all_recommendations = ""
-                for patient in results:
-                    patient_name = patient['patient_name']
-                    recommendations = "\n  - ".join(patient['recommendations'])
-                    all_recommendations += f"Recommendations for {patient_name}:\n  - {recommendations}\n\n"
-                # Update the GUI element with all patients' recommendations
-                window["-PS-RECOMMENDATIONS-"].update(all_recommendations)
+            runner.submit("-PS-", "patient_state",
+                          db_state_date=values["-PS-DB_STATE_DATE-"],
+                          db_state_time=values["-PS-DB_STATE_TIME-"])
+        elif event in ("-SQ-DONE-", "-HQ-DONE-", "-UQ-DONE-", "-DQ-DONE-", "-PS-DONE-"):
+            prefix = event[:4]
+            query_id, (is_successful, results, message, next_page) = values[event]
+            if runner.finish(prefix, query_id):
+                window[f"{prefix}PROGRESS-"].update("")
+                if prefix == "-HQ-" and is_successful:
+                    # Add the page to the rows shown so far
+                    history["rows"].extend(results)
+                    history["next_page"] = next_page
+                    results = history["rows"]
+                    window["-HQ-MORE-"].update(disabled=next_page is None)
+                show_query_result(window, prefix, is_successful, results, message)
+        elif event in ("-SQ-CANCEL-", "-HQ-CANCEL-", "-UQ-CANCEL-", "-DQ-CANCEL-", "-PS-CANCEL-"):
+            prefix = event[:4]
+            cancelled = runner.cancel(prefix)
+            if cancelled == "applying":
+                window[f"{prefix}PROGRESS-"].update("Cancel requested, the change may still be applied.")
+            elif cancelled == "cancelled":
+                window[f"{prefix}PROGRESS-"].update("Query cancelled.")
         elif event in ("-SQ-CLEAR-", "-HQ-CLEAR-", "-UQ-CLEAR-", "-DQ-CLEAR-", "-PS-CLEAR-"):
             prefix = event[:4]  # Either "-SQ-" or "-HQ-", or "-UQ-", or "-DQ-", or "-PS-"
             for key in values:
-                if key.startswith(prefix):
+                # Skip the query result events, they are not elements
+                if isinstance(key, str) and key.startswith(prefix) and not key.endswith("DONE-"):
                     if key.endswith("PATIENT_NAME-"):
                         window[key].update(value="")
                     else:
@@ -345,6 +529,9 @@ def create_gui():
             if prefix in ("-UQ-", "-DQ-"):
                 window[f"{prefix}MESSAGE-"].update("")
 
+    runner.shutdown()
+    if _engine is not None:
+        _engine.writer.close()
     window.close()
 
 
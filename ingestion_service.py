@@ -0,0 +1,308 @@
+import argparse
+import collections
+import datetime
+import json
+import os
+import queue
+import socketserver
+import sqlite3
+import threading
+import time
+
+import pandas as pd
+
+from bitemporal_index import RECORD_COLUMNS
+from connection_pool import STALE_CONNECTION_ERRORS, PoolExhaustedError
+from database import PatientData
+from metrics import REGISTRY
+from storage import open_storage
+
+
+# Key of a reading, a reading sent again with the same key is a retransmission.
+# Only fields of the source: the transaction time of a reading without one is the time it came in.
+DEDUP_COLUMNS = ['first_name', 'last_name', 'loinc_num', 'valid_start_time', 'value']
+
+# Errors of a batch that may pass when it is written again (connection lost, database locked or busy),
+# other errors come from the readings themselves
+TRANSIENT_ERRORS = STALE_CONNECTION_ERRORS + (sqlite3.OperationalError, PoolExhaustedError)
+
+
+# A reading (dict with RECORD_COLUMNS, transaction_time optional) as a test_results record,
+# raises ValueError when it is not a valid measurement
+def validate(reading, now=None):
+    if not isinstance(reading, dict):
+        raise ValueError("A reading must be a JSON object.")
+    missing = [column for column in RECORD_COLUMNS[:6] if reading.get(column) in (None, '')]
+    if missing:
+        raise ValueError(f"Missing {', '.join(missing)}")
+    try:
+        valid_start_time = pd.Timestamp(reading['valid_start_time']).to_pydatetime().replace(microsecond=0)
+        transaction_time = reading.get('transaction_time')
+        transaction_time = now if transaction_time in (None, '') else pd.Timestamp(transaction_time).to_pydatetime()
+        transaction_time = transaction_time.replace(microsecond=0)
+    except (TypeError, ValueError) as error:
+        raise ValueError(f"Invalid time: {error}")
+    if valid_start_time > transaction_time:
+        raise ValueError("valid_start_time is after transaction_time.")
+    return (str(reading['first_name']), str(reading['last_name']), str(reading['loinc_num']), str(reading['value']),
+            str(reading['unit']), valid_start_time, transaction_time)
+
+
+class Ingestor:
+    # Micro-batched loading of a stream of readings into test_results.
+    # submit validates a reading and queues it, the writer thread inserts the queued readings
+    # in batches of up to batch_size, or what came within flush_interval seconds of the first one,
+    # with one executemany in one transaction (PatientData.add_test_results, so the write listeners see them).
+    # The queue holds at most max_pending readings: when the database falls behind, submit blocks
+    # and the sources stop reading (backpressure to the socket clients or the file).
+    # Readings sent again (same DEDUP_COLUMNS) are dropped, the keys of the last dedup_size readings
+    # are kept, starting from the rows recorded in the last dedup_window.
+    # A batch that fails with a TRANSIENT_ERRORS error is tried again up to max_attempts times, waiting
+    # retry_seconds and twice as long after every attempt. A batch that fails for its readings is split
+    # in halves until the bad readings are found. Readings that can't be written go to the dead letters:
+    # counted, and appended to dead_letter_file (JSON lines with the error) when given.
+    def __init__(self, patient_data, batch_size=1000, flush_interval=0.2, max_pending=20000, dedup_size=1000000,
+                 dedup_window=datetime.timedelta(days=1), retry_seconds=1.0, max_attempts=5, dead_letter_file=None):
+        self.db = patient_data
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pending = queue.Queue(max_pending)
+        self.dedup_size = dedup_size
+        self.retry_seconds = retry_seconds
+        self.max_attempts = max_attempts
+        self.dead_letter_file = dead_letter_file
+        self.seen = collections.OrderedDict()
+        self.counts = collections.Counter()
+        self.lock = threading.Lock()
+        self.closed = False
+        self._load_seen(dedup_window)
+        self.thread = threading.Thread(target=self._run, name="ingestor", daemon=True)
+        self.thread.start()
+
+    def _load_seen(self, dedup_window):
+        if dedup_window is None:
+            return
+        recorded_from = datetime.datetime.now() - dedup_window
+        for row in self.db.query_test_result_rows(recorded_from=recorded_from):
+            self._remember(self._key(row[1:]))
+
+    @staticmethod
+    def _key(record):
+        return (record[0], record[1], record[2], pd.Timestamp(record[5]), record[3])
+
+    # Returns False when the key was seen already
+    def _remember(self, key):
+        if key in self.seen:
+            self.seen.move_to_end(key)
+            return False
+        self.seen[key] = None
+        if len(self.seen) > self.dedup_size:
+            self.seen.popitem(last=False)
+        return True
+
+    # Validate and queue a reading, raises ValueError for an invalid one.
+    # Blocks while the queue is full (raises queue.Full after timeout seconds, when given).
+    def submit(self, reading, timeout=None):
+        try:
+            record = validate(reading, datetime.datetime.now())
+        except ValueError:
+            self._count('rejected')
+            raise
+        if self.closed:
+            raise RuntimeError("The ingestor is closed.")
+        self.pending.put(record, timeout=timeout)
+        self._count('accepted')
+
+    def _count(self, name, value=1):
+        with self.lock:
+            self.counts[name] += value
+        REGISTRY.increment('ingested_readings_total', value, result=name)
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts, pending=self.pending.qsize())
+
+    # Wait until everything queued so far is written
+    def flush(self):
+        self.pending.join()
+
+    def close(self):
+        self.closed = True
+        self.pending.put(None)
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            record = self.pending.get()
+            if record is None:
+                self.pending.task_done()
+                return
+            batch = [record]
+            deadline = time.monotonic() + self.flush_interval
+            stop = False
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    record = self.pending.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if record is None:
+                    stop = True
+                    break
+                batch.append(record)
+            self._write(batch)
+            for _ in range(len(batch) + stop):
+                self.pending.task_done()
+            if stop:
+                return
+
+    def _write(self, batch):
+        records = [record for record in batch if self._remember(self._key(record))]
+        if len(records) < len(batch):
+            self._count('duplicates', len(batch) - len(records))
+        if records:
+            self._insert(records)
+
+    def _insert(self, records):
+        for attempt in range(self.max_attempts):
+            try:
+                start = time.perf_counter()
+                self.db.add_test_results(records, skip_existing=False)
+                REGISTRY.observe('ingest_batch_seconds', time.perf_counter() - start)
+                self._count('written', len(records))
+                return
+            except TRANSIENT_ERRORS as error:
+                print(f"Ingestion batch of {len(records)} readings failed, retrying: {error}")
+                self._count('failed_batches')
+                last_error = error
+                time.sleep(self.retry_seconds * 2 ** attempt)
+            except Exception as error:
+                self._count('failed_batches')
+                if len(records) == 1:
+                    self._dead_letter(records, error)
+                    return
+                # Find the bad readings, the others are written
+                middle = len(records) // 2
+                self._insert(records[:middle])
+                self._insert(records[middle:])
+                return
+        self._dead_letter(records, last_error)
+
+    # Readings that were not written, a retransmission of them is not a duplicate
+    def _dead_letter(self, records, error):
+        print(f"{len(records)} readings could not be written: {error}")
+        for record in records:
+            self.seen.pop(self._key(record), None)
+        self._count('dead_letters', len(records))
+        if self.dead_letter_file is None:
+            return
+        with open(self.dead_letter_file, 'a') as f:
+            for record in records:
+                f.write(json.dumps(dict(zip(RECORD_COLUMNS, record), error=str(error)), default=str) + '\n')
+
+
+# ************ Sources of readings: one JSON object per line ***********
+class _ReadingHandler(socketserver.StreamRequestHandler):
+    # Readings of one client connection, an invalid line gets an error line back
+    def handle(self):
+        for line in self.rfile:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                self.server.ingestor.submit(json.loads(line))
+            except ValueError as error:
+                self.wfile.write(f"ERROR {error}\n".encode('utf-8'))
+
+
+class ReadingServer(socketserver.ThreadingTCPServer):
+    # TCP server of reading lines, a client that sends faster than the database writes
+    # is slowed down by the blocked submit (its socket buffer fills up)
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, ingestor, host='127.0.0.1', port=9099):
+        self.ingestor = ingestor
+        super().__init__((host, port), _ReadingHandler)
+
+
+def read_offset(checkpoint_file):
+    if checkpoint_file is None or not os.path.exists(checkpoint_file):
+        return 0
+    with open(checkpoint_file) as f:
+        return json.load(f)['offset']
+
+
+def write_offset(checkpoint_file, path, offset):
+    if checkpoint_file is None:
+        return
+    with open(checkpoint_file + '.tmp', 'w') as f:
+        json.dump({'file': path, 'offset': offset}, f)
+    os.replace(checkpoint_file + '.tmp', checkpoint_file)
+
+
+# Follow a file of reading lines as it grows. Whenever the end of the file is reached and the readings
+# are written, the byte offset is saved in the checkpoint file, so a restarted tail continues there.
+def tail_file(ingestor, path, checkpoint_file=None, poll_interval=0.2, stop=None):
+    offset = read_offset(checkpoint_file)
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while stop is None or not stop.is_set():
+            line = f.readline()
+            if not line.endswith(b'\n'):
+                # Wait for the rest of a partly written line
+                f.seek(offset)
+                ingestor.flush()
+                write_offset(checkpoint_file, path, offset)
+                time.sleep(poll_interval)
+                continue
+            offset += len(line)
+            if line.strip():
+                try:
+                    ingestor.submit(json.loads(line))
+                except ValueError as error:
+                    print(f"Rejected reading at byte {offset - len(line)}: {error}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingest a stream of readings (JSON lines) into test_results.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--port', type=int, help="accept reading lines on this TCP port")
+    source.add_argument('--tail', help="follow this file of reading lines")
+    parser.add_argument('--bind', default="127.0.0.1")
+    parser.add_argument('--checkpoint', help="progress file of --tail")
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--flush-interval', type=float, default=0.2, help="seconds a reading may wait for a batch")
+    parser.add_argument('--max-pending', type=int, default=20000, help="queued readings before the sources block")
+    parser.add_argument('--dead-letter', help="append the readings that can't be written to this file")
+    parser.add_argument('--host', default="localhost")
+    parser.add_argument('--user', default="root")
+    parser.add_argument('--password', default="q6rh3b")
+    parser.add_argument('--database', default="patient_data")
+    parser.add_argument('--sqlite', help="write into this SQLite file instead of MySQL")
+    args = parser.parse_args()
+
+    if args.sqlite:
+        patient_data = PatientData(pool=open_storage('sqlite', args.sqlite))
+    else:
+        patient_data = PatientData(host=args.host, user=args.user, password=args.password, database=args.database)
+    ingestor = Ingestor(patient_data, args.batch_size, args.flush_interval, args.max_pending,
+                        dead_letter_file=args.dead_letter)
+    try:
+        if args.port:
+            with ReadingServer(ingestor, args.bind, args.port) as server:
+                print(f"Accepting readings on {args.bind}:{args.port}")
+                server.serve_forever()
+        else:
+            tail_file(ingestor, args.tail, args.checkpoint)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        ingestor.close()
+        print(f"Ingestion stopped: {ingestor.stats()}")
+
+
+if __name__ == "__main__":
+    main()
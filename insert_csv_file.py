@@ -1,46 +1,114 @@
+import argparse
+import json
+import os
+import time
 import pandas as pd
-import mysql.connector
-
-# Load the Excel data
-excel_file = "project_db.csv"
-df = pd.read_csv(excel_file)
-print(df)
-
-# Convert 'Valid start time' and 'Transaction time' to the correct datetime format
-df['Valid start time'] = pd.to_datetime(df['Valid start time'], format='%d/%m/%Y %H:%M').dt.strftime('%Y-%m-%d %H:%M:%S')
-df['Transaction time'] = pd.to_datetime(df['Transaction time'], format='%d/%m/%Y %H:%M').dt.strftime('%Y-%m-%d %H:%M:%S')
-
-# Connect to the MySQL database
-db_connection = mysql.connector.connect(
-    host="localhost",
-    user="root",
-    password="q6rh3b",
-    database="patient_data"
-)
-
-cursor = db_connection.cursor()
-
-# Insert the data into the database
-for idx, row in df.iterrows():
-    cursor.execute(
-        """
-        INSERT INTO test_results (id, first_name, last_name, loinc_num, value, unit, valid_start_time, transaction_time) 
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-        """,
-        (
-            idx + 1,
-            row['First name'],
-            row['Last name'],
-            row['LOINC-NUM'],
-            row['Value'],
-            row['Unit'],
-            row['Valid start time'],
-            row['Transaction time']
-        )
-    )
-
-db_connection.commit()
-cursor.close()
-db_connection.close()
-
-print("Data inserted successfully.")
+from database import PatientData
+from storage import open_storage
+
+# CSV header -> test_results column
+CSV_COLUMNS = {
+    'First name': 'first_name',
+    'Last name': 'last_name',
+    'LOINC-NUM': 'loinc_num',
+    'Value': 'value',
+    'Unit': 'unit',
+    'Valid start time': 'valid_start_time',
+    'Transaction time': 'transaction_time',
+}
+CSV_TIME_FORMAT = '%d/%m/%Y %H:%M'
+
+
+# Turn a chunk of the CSV into test_results records (RECORD_COLUMNS order), the database gives the ids
+def chunk_to_rows(chunk):
+    chunk = chunk.rename(columns=CSV_COLUMNS)
+
+    # Convert 'Valid start time' and 'Transaction time' to the database datetime format, whole column at once
+    for column in ('valid_start_time', 'transaction_time'):
+        chunk[column] = pd.to_datetime(chunk[column], format=CSV_TIME_FORMAT).dt.strftime('%Y-%m-%d %H:%M:%S')
+
+    return list(chunk[list(CSV_COLUMNS.values())].itertuples(index=False, name=None))
+
+
+# The CSV file a checkpoint is of: its path, size and modification time
+def csv_signature(csv_file):
+    stat = os.stat(csv_file)
+    return {'csv_file': os.path.abspath(csv_file), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+# Rows of csv_file done by the saved load, 0 when the checkpoint is of another file or the file changed since
+def read_checkpoint(checkpoint_file, csv_file):
+    if checkpoint_file is None or not os.path.exists(checkpoint_file):
+        return 0
+    with open(checkpoint_file) as f:
+        checkpoint = json.load(f)
+    if {key: checkpoint.get(key) for key in ('csv_file', 'size', 'mtime')} != csv_signature(csv_file):
+        print(f"Checkpoint {checkpoint_file} is not of {csv_file} as it is now, loading from the start.")
+        return 0
+    return checkpoint['rows_done']
+
+
+def write_checkpoint(checkpoint_file, csv_file, rows_done):
+    if checkpoint_file is None:
+        return
+    with open(checkpoint_file + '.tmp', 'w') as f:
+        json.dump(dict(csv_signature(csv_file), rows_done=rows_done), f)
+    os.replace(checkpoint_file + '.tmp', checkpoint_file)
+
+
+# Stream the CSV into test_results:
+# chunk_size - rows read from the file at a time
+# batch_size - rows written in one transaction
+# checkpoint_file - progress file, a stopped load continues after the last committed batch
+# Rows already in the table (loaded before, or the same row twice) are skipped.
+# Returns the number of rows written.
+def ingest_csv(patient_data, csv_file, chunk_size=50000, batch_size=5000, checkpoint_file=None):
+    rows_done = read_checkpoint(checkpoint_file, csv_file)
+    if rows_done:
+        print(f"Resuming after {rows_done} rows.")
+
+    start = time.perf_counter()
+    rows_inserted = 0
+    # Values are text as they are, 'None' is a chills value and not a missing one
+    chunks = pd.read_csv(csv_file, dtype=str, keep_default_na=False, chunksize=chunk_size,
+                         skiprows=range(1, rows_done + 1))
+    for chunk in chunks:
+        rows = chunk_to_rows(chunk)
+        for i in range(0, len(rows), batch_size):
+            batch = rows[i:i + batch_size]
+            rows_inserted += patient_data.add_test_results(batch)
+            rows_done += len(batch)
+            write_checkpoint(checkpoint_file, csv_file, rows_done)
+
+        elapsed = time.perf_counter() - start
+        print(f"{rows_done} rows read, {rows_inserted} new ({rows_done / elapsed:.0f} rows/s)")
+
+    elapsed = time.perf_counter() - start
+    rate = rows_inserted / elapsed if elapsed > 0 else 0
+    print(f"Data inserted successfully: {rows_inserted} rows in {elapsed:.1f}s ({rate:.0f} rows/s).")
+    return rows_inserted
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load a test results CSV into the test_results table.")
+    parser.add_argument('csv_file', nargs='?', default="project_db.csv")
+    parser.add_argument('--host', default="localhost")
+    parser.add_argument('--user', default="root")
+    parser.add_argument('--password', default="q6rh3b")
+    parser.add_argument('--database', default="patient_data")
+    parser.add_argument('--sqlite', help="load into this SQLite file instead of MySQL")
+    parser.add_argument('--chunk-size', type=int, default=50000)
+    parser.add_argument('--batch-size', type=int, default=5000)
+    parser.add_argument('--checkpoint', help="progress file for resuming a stopped load")
+    args = parser.parse_args()
+
+    if args.sqlite:
+        patient_data = PatientData(pool=open_storage('sqlite', args.sqlite))
+    else:
+        patient_data = PatientData(host=args.host, user=args.user, password=args.password, database=args.database)
+
+    ingest_csv(patient_data, args.csv_file, args.chunk_size, args.batch_size, args.checkpoint)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,202 @@
-import mysql.connector
+import re
+import threading
 import pandas as pd
 import numpy as np
+from connection_pool import get_pool
+from metrics import instrumented
+
+SEXES = ('male', 'female')
+GRADES = ['Grade I', 'Grade II', 'Grade III', 'Grade IV']
+RANGE_PATTERN = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*(?:(\+)|-\s*(\d+(?:\.\d+)?))?')
+
+# Compiled snapshot and write version of every knowledge base database (by its pool),
+# shared by all the KnowledgeBase objects of that database
+_snapshots = {}
+_versions = {}
+_snapshots_lock = threading.Lock()
+
+
+# Parse a range string of the knowledge base to (low, high) numbers:
+# '13-16' -> (13, 16), '16+' -> (16, inf), '0-8 mg/100cc' -> (0, 8), '40.0' -> (40, 40).
+# Returns None for categorical values like 'Shaking'.
+def parse_range(range_value):
+    match = RANGE_PATTERN.match(str(range_value))
+    if match is None:
+        return None
+    low = float(match.group(1))
+    if match.group(2):
+        return low, np.inf
+    if match.group(3):
+        return low, float(match.group(3))
+    return low, low
+
+
+class RangeTable:
+    # Numeric ranges ((low, high), label) compiled for binary search. A value is in a range when
+    # low <= value < high, a single value range (low == high) holds only that value, high None has no bound.
+    # A value in more than one range gets the label of the last of them in the given order,
+    # values in no range get None.
+    # The finite bounds split the numbers into the bounds themselves and the open intervals between them,
+    # every one of them is in the same ranges throughout: its label is found once here, and classify
+    # finds the piece of a value with np.searchsorted.
+    def __init__(self, ranges):
+        ranges = list(ranges)
+        self.lows = np.array([low for (low, high), label in ranges], dtype=float)
+        self.highs = np.array([np.inf if high is None else high for (low, high), label in ranges], dtype=float)
+        self.labels = np.array([label for bounds, label in ranges] + [None], dtype=object)
+        self.bounds = np.unique(np.r_[self.lows, self.highs[np.isfinite(self.highs)]])
+        # Open interval i is (bounds[i - 1], bounds[i]), the first and last ones are unbounded
+        edges = np.r_[-np.inf, self.bounds, np.inf]
+        middles = [(low + high) / 2 if np.isfinite(low) and np.isfinite(high) else
+                   (high - 1 if np.isfinite(high) else low + 1 if np.isfinite(low) else 0.0)
+                   for low, high in zip(edges[:-1], edges[1:])]
+        self.bound_labels = np.array([self._label(value) for value in self.bounds], dtype=object)
+        self.interval_labels = np.array([self._label(value) for value in middles], dtype=object)
+
+    def _label(self, value):
+        label = None
+        for low, high, range_label in zip(self.lows, self.highs, self.labels):
+            if low <= value < high or low == high == value:
+                label = range_label
+        return label
+
+    def classify(self, values):
+        scalar = np.ndim(values) == 0
+        values = np.atleast_1d(np.asarray(values, dtype=float))
+        positions = np.searchsorted(self.bounds, values, side='left')
+        on_bound = positions < len(self.bounds)
+        on_bound[on_bound] = self.bounds[positions[on_bound]] == values[on_bound]
+        labels = self.interval_labels[positions]
+        labels[on_bound] = self.bound_labels[positions[on_bound]]
+        # Not a number -> None
+        labels[np.isnan(values)] = None
+        return labels[0] if scalar else labels
+
+
+class KnowledgeSnapshot:
+    # The knowledge base loaded once and compiled for fast classification.
+    # Every method takes single values or arrays of values.
+    def __init__(self, version, concepts, hematological_states, systemic_toxicity, recommendations):
+        self.version = version
+
+        # sex -> RangeTable of the hemoglobin states
+        self.hemoglobin = {}
+        for sex, rows in concepts.items():
+            ranges = [(parse_range(range_value), category) for _, category, range_value in rows]
+            ranges = sorted([item for item in ranges if item[0] is not None], key=lambda item: item[0])
+            self.hemoglobin[sex] = RangeTable(ranges)
+
+        # sex -> (hemoglobin RangeTable, wbc RangeTable, state name matrix)
+        self.hematological = {}
+        for sex, rows in hematological_states.items():
+            hemoglobin_lows = sorted({parse_range(hemoglobin_range)[0] for _, hemoglobin_range, _ in rows})
+            wbc_lows = sorted({parse_range(wbc_range)[0] for _, _, wbc_range in rows})
+            matrix = np.full((len(hemoglobin_lows) + 1, len(wbc_lows) + 1), None, dtype=object)
+            for state_name, hemoglobin_range, wbc_range in rows:
+                matrix[hemoglobin_lows.index(parse_range(hemoglobin_range)[0]),
+                       wbc_lows.index(parse_range(wbc_range)[0])] = state_name
+            self.hematological[sex] = (
+                RangeTable([((low, None), i) for i, low in enumerate(hemoglobin_lows)]),
+                RangeTable([((low, None), i) for i, low in enumerate(wbc_lows)]),
+                matrix,
+            )
+
+        # symptom -> RangeTable for numeric symptoms (fever), {value: grade} for categorical ones
+        self.toxicity = {}
+        numeric = {}
+        for symptom_name, range_value, grade in systemic_toxicity:
+            symptom = symptom_name.lower()
+            bounds = parse_range(range_value)
+            if bounds is None:
+                # The first (lowest) grade of a repeated value wins
+                self.toxicity.setdefault(symptom, {}).setdefault(range_value.lower(), grade)
+            else:
+                numeric.setdefault(symptom, []).append((bounds, grade))
+        for symptom, ranges in numeric.items():
+            # Open ranges ('40.0+') before single values ('40.0') of the same lower bound
+            ranges = sorted(ranges, key=lambda item: (item[0][0], -item[0][1]))
+            self.toxicity[symptom] = RangeTable(ranges)
+
+        # sex -> {(hemoglobin state, hematological state, GRADE) -> [recommendations]}
+        self.recommendations = {}
+        for sex, rows in recommendations.items():
+            table = self.recommendations.setdefault(sex, {})
+            for hemoglobin_state, hematological_state, systemic_toxicity, recommendation in rows:
+                key = (hemoglobin_state, hematological_state, systemic_toxicity.upper())
+                table.setdefault(key, []).append(recommendation)
+
+    def hemoglobin_state(self, sex, values):
+        return self.hemoglobin[sex].classify(values)
+
+    def hematological_state(self, sex, hemoglobin_values, wbc_values):
+        hemoglobin_table, wbc_table, matrix = self.hematological[sex]
+        scalar = np.ndim(hemoglobin_values) == 0
+        rows = hemoglobin_table.classify(np.atleast_1d(hemoglobin_values))
+        columns = wbc_table.classify(np.atleast_1d(wbc_values))
+        # Unknown hemoglobin or WBC -> the last (empty) row or column of the matrix
+        rows = np.where(pd.isna(rows), matrix.shape[0] - 1, rows).astype(int)
+        columns = np.where(pd.isna(columns), matrix.shape[1] - 1, columns).astype(int)
+        states = matrix[rows, columns]
+        return states[0] if scalar else states
+
+    def toxicity_grade(self, symptom, values):
+        table = self.toxicity[symptom.lower()]
+        if isinstance(table, RangeTable):
+            return table.classify(values)
+        if np.ndim(values) == 0:
+            return table.get(str(values).lower())
+        return np.array([table.get(str(value).lower()) for value in values], dtype=object)
+
+    # Highest grade of the given grades per row (None when none is known)
+    @staticmethod
+    def max_grade(*grades):
+        ranks = [pd.Series(np.atleast_1d(np.asarray(grade, dtype=object))).map({g: i for i, g in enumerate(GRADES)})
+                 for grade in grades]
+        highest = pd.concat(ranks, axis=1).max(axis=1)
+        labels = np.array([None if pd.isna(rank) else GRADES[int(rank)] for rank in highest], dtype=object)
+        return labels if np.ndim(grades[0]) else labels[0]
+
+    def get_recommendations(self, sex, hemoglobin_state, hematological_state, toxicity_grade):
+        grade = toxicity_grade.upper() if toxicity_grade else toxicity_grade
+        return self.recommendations.get(sex, {}).get((hemoglobin_state, hematological_state, grade), [])
+
+    # Hemoglobin ranges in the form of temporal_abstraction.ABSTRACTION_RANGES
+    def abstraction_ranges(self, hemoglobin_loincs):
+        ranges = {}
+        for sex, table in self.hemoglobin.items():
+            bounds = (table.lows[1:].tolist(), table.labels[:-1].tolist())
+            for loinc_num in hemoglobin_loincs:
+                ranges.setdefault(loinc_num, {})[sex] = bounds
+        return ranges
+
 
 class KnowledgeBase:
-    def __init__(self, host, user, password, database):
-        self.db_connection = mysql.connector.connect(
-            host=host,
-            user=user,
-            password=password,
-            database=database
-        )
-        self.cursor = self.db_connection.cursor()
+    # Connections come from the shared pool of the MySQL details, or from the given pool
+    def __init__(self, host=None, user=None, password=None, database=None, pool=None):
+        self.pool = pool if pool is not None else get_pool(host, user, password, database)
+
+    # Every add_* method calls this after its commit, the next snapshot() compiles again
+    def _changed(self):
+        with _snapshots_lock:
+            _versions[self.pool] = _versions.get(self.pool, 0) + 1
+
+    # The compiled knowledge base, loaded from the database only on first use and after writes
+    @instrumented()
+    def snapshot(self):
+        with _snapshots_lock:
+            version = _versions.get(self.pool, 0)
+            snapshot = _snapshots.get(self.pool)
+            if snapshot is not None and snapshot.version == version:
+                return snapshot
+            snapshot = KnowledgeSnapshot(
+                version,
+                {sex: self.get_concepts(sex) for sex in SEXES},
+                {sex: self.get_hematological_states(sex) for sex in SEXES},
+                self.get_systemic_toxicity(),
+                {sex: self.get_treatment_recommendations(sex) for sex in SEXES},
+            )
+            _snapshots[self.pool] = snapshot
+            return snapshot
 
     def get_goodbefore_goodafter(self, param):
         #ההמוגלובין  תקף חודש לפני ושבוע אחרי 
@@ -25,20 +211,18 @@ class KnowledgeBase:
             FROM concepts 
             WHERE sex = %s
         """
-        self.cursor.execute(query, (sex,))
-        return self.cursor.fetchall()
+        return self.pool.execute(query, (sex,))
 
 
     def add_concept(self,id, data_dict):
-        for category, values in data_dict.items():
-            sex, range_value = values[0], values[1]
-            print(sex)
-            print(range_value)
-            self.cursor.execute(
-                "INSERT INTO concepts (id, sex, category, range_value) VALUES (%s, %s, %s, %s)",
-                (id, sex, category, range_value)
-            )
-        self.db_connection.commit()
+        with self.pool.session() as cursor:
+            for category, values in data_dict.items():
+                sex, range_value = values[0], values[1]
+                cursor.execute(
+                    self.pool.sql("INSERT INTO concepts (id, sex, category, range_value) VALUES (%s, %s, %s, %s)"),
+                    (id, sex, category, range_value)
+                )
+        self._changed()
 
 
     def get_hematological_states(self, gender):
@@ -48,22 +232,22 @@ class KnowledgeBase:
             JOIN hematological_ranges r ON s.id = r.state_id 
             WHERE s.gender = %s
         """
-        self.cursor.execute(query, (gender,))
-        return self.cursor.fetchall()
+        return self.pool.execute(query, (gender,))
 
     def add_hematological_state(self, gender, data_dict):
-        for ranges, state_name in data_dict.items():
-            hemoglobin_range, wbc_range = ranges
-            self.cursor.execute(
-                "INSERT INTO hematological_states (gender, state_name) VALUES (%s, %s)",
-                (gender, state_name)
-            )
-            state_id = self.cursor.lastrowid
-            self.cursor.execute(
-                "INSERT INTO hematological_ranges (state_id, hemoglobin_range, wbc_range) VALUES (%s, %s, %s)",
-                (state_id, hemoglobin_range[1], wbc_range[1])
-            )
-        self.db_connection.commit()
+        with self.pool.session() as cursor:
+            for ranges, state_name in data_dict.items():
+                hemoglobin_range, wbc_range = ranges
+                cursor.execute(
+                    self.pool.sql("INSERT INTO hematological_states (gender, state_name) VALUES (%s, %s)"),
+                    (gender, state_name)
+                )
+                state_id = cursor.lastrowid
+                cursor.execute(
+                    self.pool.sql("INSERT INTO hematological_ranges (state_id, hemoglobin_range, wbc_range) VALUES (%s, %s, %s)"),
+                    (state_id, hemoglobin_range[1], wbc_range[1])
+                )
+        self._changed()
 
     def get_systemic_toxicity(self):
         query = """
@@ -71,22 +255,22 @@ class KnowledgeBase:
             FROM systemic_toxicity_symptoms s 
             JOIN systemic_toxicity_grades g ON s.id = g.symptom_id
         """
-        self.cursor.execute(query)
-        return self.cursor.fetchall()
+        return self.pool.execute(query)
 
     def add_systemic_toxicity(self, data_dict):
-        for symptom, grades in data_dict.items():
-            self.cursor.execute(
-                "INSERT INTO systemic_toxicity_symptoms (symptom_name) VALUES (%s)",
-                (symptom,)
-            )
-            symptom_id = self.cursor.lastrowid
-            for range_value, grade in grades.items():
-                self.cursor.execute(
-                    "INSERT INTO systemic_toxicity_grades (symptom_id, range_value, grade) VALUES (%s, %s, %s)",
-                    (symptom_id, range_value, grade)
+        with self.pool.session() as cursor:
+            for symptom, grades in data_dict.items():
+                cursor.execute(
+                    self.pool.sql("INSERT INTO systemic_toxicity_symptoms (symptom_name) VALUES (%s)"),
+                    (symptom,)
                 )
-        self.db_connection.commit()
+                symptom_id = cursor.lastrowid
+                for range_value, grade in grades.items():
+                    cursor.execute(
+                        self.pool.sql("INSERT INTO systemic_toxicity_grades (symptom_id, range_value, grade) VALUES (%s, %s, %s)"),
+                        (symptom_id, range_value, grade)
+                    )
+        self._changed()
 
     def get_treatment_recommendations(self, gender):
         query = """
@@ -94,22 +278,18 @@ class KnowledgeBase:
             FROM treatment_recommendations 
             WHERE gender = %s
         """
-        self.cursor.execute(query, (gender,))
-        return self.cursor.fetchall()
+        return self.pool.execute(query, (gender,))
 
     def add_treatment_recommendations(self, gender, data_dict):
-        for states, recommendations in data_dict.items():
-            hemoglobin_state, hematological_state, systemic_toxicity = states
-            for recommendation in recommendations:
-                self.cursor.execute(
-                    "INSERT INTO treatment_recommendations (gender, hemoglobin_state, hematological_state, systemic_toxicity, recommendation) VALUES (%s, %s, %s, %s, %s)",
-                    (gender, hemoglobin_state[1], hematological_state[1], systemic_toxicity[1], recommendation)
-                )
-        self.db_connection.commit()
-
-    def __del__(self):
-        self.cursor.close()
-        self.db_connection.close()
+        with self.pool.session() as cursor:
+            for states, recommendations in data_dict.items():
+                hemoglobin_state, hematological_state, systemic_toxicity = states
+                for recommendation in recommendations:
+                    cursor.execute(
+                        self.pool.sql("INSERT INTO treatment_recommendations (gender, hemoglobin_state, hematological_state, systemic_toxicity, recommendation) VALUES (%s, %s, %s, %s, %s)"),
+                        (gender, hemoglobin_state[1], hematological_state[1], systemic_toxicity[1], recommendation)
+                    )
+        self._changed()
 
 
 if __name__ == "__main__":
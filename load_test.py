@@ -0,0 +1,150 @@
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import statistics
+import tempfile
+import time
+
+import numpy as np
+
+from benchmark import FIRST_VALID_TIME, generate_test_results, write_csv
+from dss_service import DSSService, open_engine
+from insert_csv_file import ingest_csv
+
+
+# Share of each endpoint in the generated requests
+DEFAULT_MIX = {'specific': 0.7, 'historical': 0.15, 'patient_state': 0.1, 'update': 0.05}
+
+
+# Request bodies of the endpoints about random rows of the generated test results
+def make_requests(test_results, count, mix, seed=0):
+    rng = np.random.default_rng(seed)
+    endpoints = rng.choice(list(mix), size=count, p=np.asarray(list(mix.values())) / sum(mix.values()))
+    rows = test_results.iloc[rng.integers(0, len(test_results), count)]
+    last_valid_time = test_results['valid_start_time'].max()
+    requests = []
+    for endpoint, row in zip(endpoints, rows.itertuples()):
+        patient = {'first_name': row.first_name, 'last_name': row.last_name, 'loinc_num': row.loinc_num}
+        valid = {'valid_date': row.valid_start_time.strftime('%Y-%m-%d'),
+                 'valid_time': row.valid_start_time.strftime('%H:%M:%S')}
+        if endpoint == 'specific':
+            physician_time = row.transaction_time + datetime.timedelta(days=1)
+            body = dict(patient, **valid, physician_date=physician_time.strftime('%Y-%m-%d'),
+                        physician_time=physician_time.strftime('%H:%M:%S'))
+        elif endpoint == 'historical':
+            body = dict(patient, from_date=FIRST_VALID_TIME.strftime('%Y-%m-%d'), from_time='00:00:00',
+                        to_date=last_valid_time.strftime('%Y-%m-%d'), to_time='23:59:59', page_size=100)
+        elif endpoint == 'update':
+            body = dict(patient, **valid, transaction_date=row.transaction_time.strftime('%Y-%m-%d'),
+                        transaction_time=row.transaction_time.strftime('%H:%M:%S'), new_value=str(row.value))
+        else:
+            state_time = row.valid_start_time
+            body = {'db_state_date': state_time.strftime('%Y-%m-%d'), 'db_state_time': state_time.strftime('%H:%M:%S')}
+        requests.append((f'/{endpoint}', body))
+    return requests
+
+
+async def _post(reader, writer, path, body, host):
+    data = json.dumps(body).encode('utf-8')
+    writer.write(f"POST {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+                 f"Content-Length: {len(data)}\r\n\r\n".encode('latin-1') + data)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.strip().lower() == 'content-length':
+            length = int(value)
+    await reader.readexactly(length)
+    return status
+
+
+# Clients on kept-alive connections, each sends its share of the requests one after the other
+async def run_clients(host, port, requests, concurrency):
+    latencies = {}
+    statuses = {}
+
+    async def client(share):
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            for path, body in share:
+                start = time.perf_counter()
+                status = await _post(reader, writer, path, body, host)
+                latencies.setdefault(path, []).append(time.perf_counter() - start)
+                statuses[status] = statuses.get(status, 0) + 1
+        finally:
+            writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client(requests[i::concurrency]) for i in range(concurrency)))
+    return time.perf_counter() - start, latencies, statuses
+
+
+def percentiles(latencies):
+    latencies = sorted(latencies)
+    pick = lambda share: latencies[min(len(latencies) - 1, int(share * len(latencies)))] * 1000
+    return {'requests': len(latencies), 'mean_ms': statistics.mean(latencies) * 1000,
+            'p50_ms': pick(0.5), 'p95_ms': pick(0.95), 'p99_ms': pick(0.99)}
+
+
+# Load test of the HTTP service on a local SQLite stand-in of the databases with synthetic test results
+def run_load_test(patients=100, measurements=10, requests=5000, concurrency=32, workers=8, mix=None, seed=0,
+                  workdir=None):
+    workdir = workdir or tempfile.mkdtemp(prefix='dss-load-test-')
+    csv_file = os.path.join(workdir, 'test_results.csv')
+    database_file = os.path.join(workdir, 'patient_data.db')
+    knowledge_base_file = os.path.join(workdir, 'kb.db')
+    for path in (database_file, knowledge_base_file):
+        if os.path.exists(path):
+            os.remove(path)
+
+    test_results = generate_test_results(patients, 11, 2, measurements, seed)
+    write_csv(test_results, csv_file)
+    engine = open_engine(workers, database_file, knowledge_base_file)
+    ingest_csv(engine.db, csv_file)
+    service = DSSService(engine, workers)
+    port = service.start_in_thread()
+
+    elapsed, latencies, statuses = asyncio.run(
+        run_clients('127.0.0.1', port, make_requests(test_results, requests, mix or DEFAULT_MIX, seed), concurrency))
+    service.close()
+    return {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'parameters': {'patients': patients, 'measurements': measurements, 'rows': len(test_results),
+                       'requests': requests, 'concurrency': concurrency, 'workers': workers, 'seed': seed},
+        'elapsed_s': elapsed,
+        'requests_per_s': requests / elapsed,
+        'statuses': statuses,
+        'endpoints': {path: percentiles(values) for path, values in sorted(latencies.items())},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the DSS HTTP service on a local SQLite stand-in.")
+    parser.add_argument('--patients', type=int, default=100)
+    parser.add_argument('--measurements', type=int, default=10, help="measurements per patient and LOINC")
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=32, help="clients sending requests at the same time")
+    parser.add_argument('--workers', type=int, default=8, help="worker threads of the service")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', help="directory for the generated CSV and databases (default: a new temp dir)")
+    parser.add_argument('--output', default="load_test_results.json")
+    args = parser.parse_args()
+
+    results = run_load_test(args.patients, args.measurements, args.requests, args.concurrency, args.workers,
+                            seed=args.seed, workdir=args.workdir)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"{results['requests_per_s']:.0f} requests/s, statuses {results['statuses']}")
+    for path, endpoint in results['endpoints'].items():
+        print(f"{path}: p50 {endpoint['p50_ms']:.1f} ms, p95 {endpoint['p95_ms']:.1f} ms, p99 {endpoint['p99_ms']:.1f} ms")
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
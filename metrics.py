@@ -0,0 +1,139 @@
+import contextlib
+import contextvars
+import functools
+import json
+import logging
+import threading
+import time
+
+
+# Phases the wall time of an operation is split into
+PHASES = ('sql_execute', 'fetch', 'dataframe', 'filtering', 'rule_evaluation')
+
+slow_query_log = logging.getLogger('dss.slow_queries')
+
+# Entry operation (outermost instrumented call) of the current thread or task
+_current_operation = contextvars.ContextVar('operation', default=None)
+
+
+class MetricsRegistry:
+    # In-process metrics of the engine, safe to share between threads.
+    # Timings are summaries (count, sum, max) and counters are totals, both keyed by metric name and labels.
+    # slow_query_seconds - SQL statements slower than this go to the 'dss.slow_queries' log (None = off)
+    def __init__(self, slow_query_seconds=None):
+        self.slow_query_seconds = slow_query_seconds
+        self.timings = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _key(metric, labels):
+        return metric, tuple(sorted(labels.items()))
+
+    def observe(self, metric, seconds, **labels):
+        key = self._key(metric, labels)
+        with self.lock:
+            count, total, highest = self.timings.get(key, (0, 0.0, 0.0))
+            self.timings[key] = (count + 1, total + seconds, max(highest, seconds))
+
+    def increment(self, metric, value=1, **labels):
+        key = self._key(metric, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def reset(self):
+        with self.lock:
+            self.timings.clear()
+            self.counters.clear()
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                'timings': [dict(labels, metric=metric, count=count, sum_s=total, max_s=highest)
+                            for (metric, labels), (count, total, highest) in sorted(self.timings.items())],
+                'counters': [dict(labels, metric=metric, value=value)
+                             for (metric, labels), value in sorted(self.counters.items())],
+            }
+
+    def to_json(self):
+        return json.dumps(self.as_dict(), indent=2)
+
+    # Prometheus text exposition format, timings as summaries without quantiles
+    def to_prometheus(self, prefix='dss_'):
+        def label_text(labels):
+            if not labels:
+                return ''
+            return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+        lines = []
+        with self.lock:
+            timings, counters = sorted(self.timings.items()), sorted(self.counters.items())
+        for metric in sorted({metric for (metric, _) in self.timings}):
+            lines.append(f'# TYPE {prefix}{metric} summary')
+            for (name, labels), (count, total, _) in timings:
+                if name == metric:
+                    lines.append(f'{prefix}{metric}_sum{label_text(labels)} {total}')
+                    lines.append(f'{prefix}{metric}_count{label_text(labels)} {count}')
+        for metric in sorted({metric for (metric, _) in self.counters}):
+            lines.append(f'# TYPE {prefix}{metric} counter')
+            for (name, labels), value in counters:
+                if name == metric:
+                    lines.append(f'{prefix}{metric}{label_text(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+
+def current_operation():
+    return _current_operation.get() or 'other'
+
+
+# Time a whole operation. Nested operations are timed too, but their phases, rows and
+# round trips are counted for the outermost (entry) operation.
+@contextlib.contextmanager
+def operation(name, registry=REGISTRY):
+    token = _current_operation.set(name) if _current_operation.get() is None else None
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        registry.observe('operation_seconds', time.perf_counter() - start, operation=name)
+        registry.increment('operations_total', operation=name)
+        if token is not None:
+            _current_operation.reset(token)
+
+
+# Method decorator, the operation name defaults to Class.method
+def instrumented(name=None):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(self, *args, **kwargs):
+            with operation(name or f'{type(self).__name__}.{function.__name__}'):
+                return function(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# Time one phase of the current operation
+@contextlib.contextmanager
+def phase(name, registry=REGISTRY):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        registry.observe('phase_seconds', time.perf_counter() - start, operation=current_operation(), phase=name)
+
+
+def count_rows(rows, kind='fetched', registry=REGISTRY):
+    registry.increment('rows_total', rows, operation=current_operation(), kind=kind)
+
+
+def count_round_trip(registry=REGISTRY):
+    registry.increment('round_trips_total', operation=current_operation())
+
+
+# Log a statement that took longer than the registry slow query threshold
+def check_slow_query(query, params, seconds, registry=REGISTRY):
+    if registry.slow_query_seconds is not None and seconds >= registry.slow_query_seconds:
+        slow_query_log.warning("%.3fs in %s: %s %r", seconds, current_operation(), ' '.join(query.split()), params)
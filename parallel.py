@@ -0,0 +1,104 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from bitemporal_index import RECORD_COLUMNS
+from metrics import instrumented, phase
+from patient_state import latest_results_states
+from temporal_abstraction import DEFAULT_SEX, INTERVAL_COLUMNS, PATIENT_KEYS, abstract_intervals
+
+
+# Columnar form of a DataFrame sent to and from the worker processes: numbers and datetimes are
+# their numpy arrays, text columns are (int32 codes, labels) with -1 for missing values.
+# Arrays are pickled as one buffer each, instead of a Python object per cell.
+def pack(frame):
+    columns = {}
+    for name in frame.columns:
+        column = frame[name]
+        if pd.api.types.is_numeric_dtype(column) or pd.api.types.is_datetime64_any_dtype(column):
+            columns[name] = column.to_numpy()
+        else:
+            codes, labels = pd.factorize(column)
+            columns[name] = (codes.astype(np.int32), list(labels))
+    return columns
+
+
+def unpack(columns):
+    return pd.DataFrame({name: np.asarray(column[1] + [None], dtype=object)[column[0]] if isinstance(column, tuple)
+                         else column for name, column in columns.items()})
+
+
+# Split the rows (sorted by patient) into about shards slices of whole patients with about the same rows.
+# Slices are in patient order, so concatenating their results in order gives the serial order.
+def shard(frame, shards):
+    frame = frame.sort_values(PATIENT_KEYS, kind='stable').reset_index(drop=True)
+    if frame.empty:
+        return []
+    new_patient = np.r_[True, (frame['first_name'].to_numpy()[1:] != frame['first_name'].to_numpy()[:-1])
+                        | (frame['last_name'].to_numpy()[1:] != frame['last_name'].to_numpy()[:-1])]
+    starts = np.flatnonzero(new_patient)
+    # Cut at the first patient starting after every 1/shards of the rows
+    targets = np.arange(1, shards) * len(frame) / shards
+    cuts = np.unique(starts[np.minimum(np.searchsorted(starts, targets), len(starts) - 1)])
+    bounds = np.r_[0, cuts[cuts > 0], len(frame)]
+    return [frame.iloc[start:stop] for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+
+# ************ Work of one shard, run in the worker processes ***********
+def _interval_shard(columns, sex):
+    return pack(abstract_intervals(unpack(columns), sex))
+
+
+def _patient_state_shard(columns, kb, sex, default_sex):
+    return latest_results_states(kb, unpack(columns), sex, default_sex)
+
+
+class ShardedExecutor:
+    # Population computations (patient states, interval abstraction) over a process pool.
+    # The rows are split by patient into shards, every shard is sent as packed columns to a worker,
+    # and the shard results are put together in patient order: the result is the same as the serial one.
+    # processes - worker processes (default: the CPU count)
+    # shards_per_process - shards per worker, more shards balance uneven patients better
+    # min_rows - inputs smaller than this are computed in this process, the pool is not worth it
+    def __init__(self, processes=None, shards_per_process=4, min_rows=10000):
+        self.processes = processes or os.cpu_count() or 1
+        self.shards = self.processes * shards_per_process
+        self.min_rows = min_rows
+        self.pool = None
+
+    def _map(self, function, frame, *args):
+        if len(frame) < self.min_rows or self.processes == 1:
+            return [function(pack(frame), *args)] if len(frame) else []
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(self.processes)
+        with phase('dataframe'):
+            slices = [pack(part) for part in shard(frame, self.shards)]
+        futures = [self.pool.submit(function, columns, *args) for columns in slices]
+        return [future.result() for future in futures]
+
+    # Same table as temporal_abstraction.abstract_intervals of the rows
+    @instrumented('ShardedExecutor.abstract_intervals')
+    def abstract_intervals(self, measurements, sex=DEFAULT_SEX):
+        parts = [unpack(columns) for columns in self._map(_interval_shard, measurements[RECORD_COLUMNS], sex)]
+        if not parts:
+            return pd.DataFrame(columns=INTERVAL_COLUMNS)
+        with phase('dataframe'):
+            intervals = pd.concat(parts, ignore_index=True)
+            intervals['measurements'] = intervals['measurements'].astype(np.int64)
+            return intervals[INTERVAL_COLUMNS]
+
+    # States and recommendations of the patients of the latest results (one row per patient and LOINC,
+    # as query_latest_results gives), in patient order like patient_state.latest_results_states
+    @instrumented('ShardedExecutor.patient_states')
+    def patient_states(self, kb, latest, sex=None, default_sex=DEFAULT_SEX):
+        states = []
+        for part in self._map(_patient_state_shard, latest[RECORD_COLUMNS], kb, sex, default_sex):
+            states.extend(part)
+        return states
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
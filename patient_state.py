@@ -0,0 +1,346 @@
+import bisect
+import queue
+import threading
+
+import numpy as np
+import pandas as pd
+
+from bitemporal_index import DELETED_VALUE
+from metrics import phase
+from temporal_abstraction import DEFAULT_SEX, PATIENT_KEYS
+
+
+# LOINC codes of the results the patient state is made of
+PATIENT_STATE_LOINCS = {
+    "hemoglobin": '12181-4',
+    "wbc": '11218-5',
+    "fever": '39106-0',
+    "chills": 'chills',
+    "skin-look": 'skin-look',
+    "allergic-state": 'allergic-state'
+}
+TOXICITY_SYMPTOMS = ["fever", "chills", "skin-look", "allergic-state"]
+
+# LOINC of the sex of a patient ('male' / 'female', or 'M' / 'F'), patients without one get the default sex
+SEX_LOINC = '46098-0'
+SEX_VALUES = {'male': 'male', 'm': 'male', 'female': 'female', 'f': 'female'}
+
+
+# Rules of the patient state and the results (PATIENT_STATE_LOINCS names) each one depends on.
+# The recommendations depend on the outcome of all three.
+RULE_INPUTS = {
+    "hemoglobin_state": {"hemoglobin"},
+    "hematological_state": {"hemoglobin", "wbc"},
+    "toxicity_grade": set(TOXICITY_SYMPTOMS),
+}
+
+
+def _numeric(values):
+    return pd.to_numeric(pd.Series(np.asarray(values, dtype=object)), errors='coerce').to_numpy()
+
+
+# Sex of a SEX_LOINC value, default_sex for a missing or unknown one
+def patient_sex(value, default_sex=DEFAULT_SEX):
+    if not isinstance(value, str):
+        return default_sex
+    return SEX_VALUES.get(value.strip().lower(), default_sex)
+
+
+# Outcome of one rule for many patients at once with the compiled knowledge base.
+# values - {PATIENT_STATE_LOINCS name: values of the patients, None when unknown}
+def evaluate_rule(kb, sex, rule, values):
+    with phase('rule_evaluation'):
+        return _evaluate_rule(kb, sex, rule, values)
+
+
+def _evaluate_rule(kb, sex, rule, values):
+    if rule == "hemoglobin_state":
+        return kb.hemoglobin_state(sex, _numeric(values['hemoglobin']))
+    if rule == "hematological_state":
+        return kb.hematological_state(sex, _numeric(values['hemoglobin']), _numeric(values['wbc']))
+    if rule == "toxicity_grade":
+        return kb.max_grade(*[kb.toxicity_grade(symptom, np.asarray(values[symptom], dtype=object))
+                              for symptom in TOXICITY_SYMPTOMS])
+    raise ValueError(f"Unknown rule {rule}")
+
+
+def patient_state(kb, sex, patient, hemoglobin_state, hematological_state, toxicity_grade):
+    first_name, last_name = patient
+    return {
+        "patient_name": f"{first_name} {last_name}",
+        "hemoglobin_state": hemoglobin_state,
+        "hematological_state": hematological_state,
+        "toxicity_grade": toxicity_grade,
+        "recommendations": kb.get_recommendations(sex, hemoglobin_state, hematological_state, toxicity_grade)
+    }
+
+
+# Outcome of one rule for many patients, sexes is the sex of every patient
+def evaluate_rule_by_sex(kb, sexes, rule, values):
+    sexes = np.asarray(sexes, dtype=object)
+    outcomes = np.full(len(sexes), None, dtype=object)
+    for sex in pd.unique(sexes):
+        rows = np.flatnonzero(sexes == sex)
+        outcomes[rows] = evaluate_rule(kb, sex, rule, {name: np.asarray(column, dtype=object)[rows]
+                                                       for name, column in values.items()})
+    return outcomes
+
+
+# States and recommendations of many patients at once with the compiled knowledge base.
+# sex - the sex of all the patients, or a list with the sex of every patient
+# patients - list of (first_name, last_name)
+# values - {PATIENT_STATE_LOINCS name: values of the patients in the same order, None when unknown}
+def evaluate_patient_states(kb, sex, patients, values):
+    sexes = [sex] * len(patients) if isinstance(sex, str) else list(sex)
+    outcomes = [evaluate_rule_by_sex(kb, sexes, rule, values) for rule in RULE_INPUTS]
+    return [patient_state(kb, sex, patient, *patient_outcomes)
+            for patient, sex, patient_outcomes in zip(patients, sexes, zip(*outcomes))]
+
+
+# States of the patients of latest results (RECORD_COLUMNS, one row per patient and LOINC, as
+# query_latest_results gives for PATIENT_STATE_LOINCS and SEX_LOINC), in patient order.
+# sex - the sex of all the patients, None for the SEX_LOINC result of each (default_sex without one)
+def latest_results_states(kb, latest, sex=None, default_sex=DEFAULT_SEX):
+    with phase('dataframe'):
+        results = latest.pivot(index=PATIENT_KEYS, columns='loinc_num', values='value')
+        results = results.reindex(columns=list(PATIENT_STATE_LOINCS.values()) + [SEX_LOINC])
+        # Patients with only a sex have no state
+        results = results[results[list(PATIENT_STATE_LOINCS.values())].notna().any(axis=1)]
+        values = {name: results[loinc_num].to_numpy(dtype=object) for name, loinc_num in PATIENT_STATE_LOINCS.items()}
+        if sex is None:
+            sex = [patient_sex(value, default_sex) for value in results[SEX_LOINC]]
+    return evaluate_patient_states(kb, sex, list(results.index), values)
+
+
+class StateSubscription:
+    # State change events of one subscriber, in an in-process queue.
+    # Changes of a patient that come within debounce seconds of the first one are merged
+    # into one event: {"patient_name", "changes": {field: (old, new)}, "state": new state},
+    # a change that is undone within the window gives no event.
+    # patients - patient names ("First Last") to get events of, None for all.
+    def __init__(self, debounce=1.0, patients=None):
+        self.debounce = debounce
+        self.patients = set(patients) if patients is not None else None
+        self.events = queue.Queue()
+        self.pending = {}
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def publish(self, old_state, new_state):
+        patient_name = (new_state or old_state)["patient_name"]
+        if self.patients is not None and patient_name not in self.patients:
+            return
+        with self.lock:
+            first_old = self.pending[patient_name][0] if patient_name in self.pending else old_state
+            self.pending[patient_name] = (first_old, new_state)
+            if self.debounce <= 0:
+                self._flush_pending()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.debounce, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            self._flush_pending()
+
+    def _flush_pending(self):
+        self.timer = None
+        for patient_name, (old_state, new_state) in self.pending.items():
+            old_state, new_state = old_state or {}, new_state or {}
+            changes = {field: (old_state.get(field), new_state.get(field))
+                       for field in ("hemoglobin_state", "hematological_state", "toxicity_grade", "recommendations")
+                       if old_state.get(field) != new_state.get(field)}
+            if changes:
+                self.events.put({"patient_name": patient_name, "changes": changes, "state": new_state or None})
+        self.pending.clear()
+
+    # Next event, blocks up to timeout seconds (None for ever), None when there is none
+    def get(self, timeout=None):
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def cancel(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            self.pending.clear()
+
+
+class _LatestValue:
+    # Latest version of every measurement of one (patient, LOINC): valid time -> (transaction time, value)
+    def __init__(self):
+        self.valid_times = []
+        self.versions = {}
+
+    def add(self, valid_time, transaction_time, value):
+        known = self.versions.get(valid_time)
+        if known is None:
+            bisect.insort(self.valid_times, valid_time)
+        elif known[0] > transaction_time:
+            return
+        self.versions[valid_time] = (transaction_time, value)
+
+    # Value of the latest measurement that was not deleted
+    def value(self):
+        for valid_time in reversed(self.valid_times):
+            value = self.versions[valid_time][1]
+            if value != DELETED_VALUE:
+                return value
+        return None
+
+
+class PatientStateView:
+    # Current state of every patient, kept up to date with the writes instead of recomputed per query.
+    # Loaded once from test_results (on first use), then every committed record of a patient state LOINC
+    # (PatientData.add_test_result, add_test_results, corrections) re-evaluates only the rules that
+    # depend on that LOINC, for its patient only, and the subscribers get the state changes.
+    # Before answering, the rows other writers (processes) added since (ids after the highest one read)
+    # are read from test_results. Each patient is evaluated with its SEX_LOINC result, sex without one.
+    # It answers "now" only: as-of times before the newest known valid or transaction time get None,
+    # the caller queries test_results for them.
+    def __init__(self, patient_data, knowlege_base, sex=DEFAULT_SEX):
+        self.db = patient_data
+        self.kb = knowlege_base
+        self.sex = sex
+        self.loinc_names = {loinc_num: name for name, loinc_num in PATIENT_STATE_LOINCS.items()}
+        self.latest = {}
+        self.sexes = {}
+        self.states = {}
+        self.watermark = 0
+        self.subscriptions = []
+        self.kb_version = None
+        self.horizon = None
+        self.loaded = False
+        self.lock = threading.RLock()
+        patient_data.on_write(self.apply)
+
+    def load(self):
+        # Rows written from here on are read again by the next refresh, adding a version twice is harmless
+        watermark = self.db.get_max_test_result_id()
+        rows = self.db.query_test_result_rows(loinc_nums=list(self.loinc_names) + [SEX_LOINC])
+        with self.lock:
+            if self.loaded:
+                return
+            # Writes that came in meanwhile are already in self.latest
+            self._add([row[1:] for row in rows])
+            self.watermark = watermark
+            self._evaluate({patient: set(PATIENT_STATE_LOINCS) for patient in self.latest}, publish=False)
+            self.loaded = True
+
+    # Add the rows written after the highest id read, also the ones of other writers.
+    # All the LOINCs are read (a range of the primary key), the others are skipped by _add.
+    def refresh(self):
+        rows = self.db.query_test_result_rows(after_id=self.watermark)
+        if rows:
+            with self.lock:
+                self.apply([row[1:] for row in rows])
+                self.watermark = max([self.watermark] + [row[0] for row in rows])
+
+    def subscribe(self, debounce=1.0, patients=None):
+        if not self.loaded:
+            self.load()
+        subscription = StateSubscription(debounce, patients)
+        with self.lock:
+            self.subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        subscription.cancel()
+        with self.lock:
+            if subscription in self.subscriptions:
+                self.subscriptions.remove(subscription)
+
+    # Write listener of PatientData
+    def apply(self, records):
+        with self.lock:
+            changed = self._add(records)
+            if self.loaded and changed:
+                self._evaluate(changed)
+
+    # Add records to the latest values, returns {patient: names of the changed results}
+    def _add(self, records):
+        changed = {}
+        for record in records:
+            name = self.loinc_names.get(record[2])
+            if name is None and record[2] != SEX_LOINC:
+                continue
+            patient = (record[0], record[1])
+            valid_time, transaction_time = pd.Timestamp(record[5]), pd.Timestamp(record[6])
+            if name is None:
+                # Every rule of the patient depends on the sex
+                self.sexes.setdefault(patient, _LatestValue()).add(valid_time, transaction_time, record[3])
+                changed.setdefault(patient, set()).update(PATIENT_STATE_LOINCS)
+            else:
+                self.latest.setdefault(patient, {}).setdefault(name, _LatestValue()).add(
+                    valid_time, transaction_time, record[3])
+                changed.setdefault(patient, set()).add(name)
+            newest = max(valid_time, transaction_time)
+            if self.horizon is None or newest > self.horizon:
+                self.horizon = newest
+        return changed
+
+    def _sex(self, patient):
+        sex = self.sexes.get(patient)
+        return patient_sex(sex.value() if sex is not None else None, self.sex)
+
+    # Re-evaluate the rules that depend on the changed results, changed is {patient: changed names}
+    def _evaluate(self, changed, publish=True):
+        kb = self.kb.snapshot()
+        kb_changed = kb.version != self.kb_version
+        if kb_changed:
+            # The knowledge base changed, every rule of every patient has to be evaluated again
+            self.kb_version = kb.version
+            changed = {patient: set(PATIENT_STATE_LOINCS) for patient in self.latest}
+
+        latest = {}
+        for patient in changed:
+            values = {name: latest_value.value() for name, latest_value in self.latest.get(patient, {}).items()}
+            if all(value is None for value in values.values()):
+                # Every result of the patient was deleted
+                old_state = self.states.pop(patient, None)
+                if publish and old_state is not None:
+                    self._publish(old_state, None)
+                continue
+            latest[patient] = values
+
+        outcomes = {patient: dict(self.states.get(patient, {})) for patient in latest}
+        for rule, inputs in RULE_INPUTS.items():
+            patients = [patient for patient in latest if patient not in self.states or changed[patient] & inputs]
+            if not patients:
+                continue
+            values = {name: [latest[patient].get(name) for patient in patients] for name in PATIENT_STATE_LOINCS}
+            sexes = [self._sex(patient) for patient in patients]
+            for patient, outcome in zip(patients, evaluate_rule_by_sex(kb, sexes, rule, values)):
+                outcomes[patient][rule] = outcome
+
+        for patient, outcome in outcomes.items():
+            old_state = self.states.get(patient)
+            if (not kb_changed and old_state is not None
+                    and all(outcome[rule] == old_state[rule] for rule in RULE_INPUTS)):
+                continue
+            # Recommendations are looked up again only when one of their inputs or the knowledge base changed
+            new_state = patient_state(kb, self._sex(patient), patient, *[outcome[rule] for rule in RULE_INPUTS])
+            self.states[patient] = new_state
+            if publish and new_state != old_state:
+                self._publish(old_state, new_state)
+
+    def _publish(self, old_state, new_state):
+        for subscription in self.subscriptions:
+            subscription.publish(old_state, new_state)
+
+    # States of all the patients sorted by name, None when as_of is before the newest known change
+    def current_states(self, as_of=None):
+        if not self.loaded:
+            self.load()
+        else:
+            self.refresh()
+        with self.lock:
+            if as_of is not None and self.horizon is not None and pd.Timestamp(as_of) < self.horizon:
+                return None
+            if self.kb.snapshot().version != self.kb_version:
+                self._evaluate({})
+            return [self.states[patient] for patient in sorted(self.states)]
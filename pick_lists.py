@@ -0,0 +1,50 @@
+import datetime
+import json
+import os
+
+
+# Patient and LOINC pick lists, saved in a local file so the GUI starts with them at once
+PICK_LIST_FILE = os.path.join(os.path.expanduser("~"), ".clinical_dss", "pick_lists.json")
+# A refresh only reads the rows added since the last one (ids above the last id it saw),
+# and everything again after this long
+PICK_LIST_FULL_REFRESH = datetime.timedelta(days=1)
+
+
+class PickLists:
+    def __init__(self, path=PICK_LIST_FILE):
+        self.path = path
+        self.patients = []
+        self.loinc_numbers = []
+        self.last_id = None
+        self.full_refresh = None
+        try:
+            with open(path) as f:
+                saved = json.load(f)
+            self.patients, self.loinc_numbers = saved["patients"], saved["loinc_numbers"]
+            self.last_id = int(saved["last_id"])
+            self.full_refresh = datetime.datetime.fromisoformat(saved["full_refresh"])
+        except (OSError, ValueError, KeyError):
+            pass
+
+    # Bring the lists up to date with the PatientData (run it on a worker thread).
+    # A full refresh reads the patients and LOINCs of all the rows (ids above 0).
+    def refresh(self, patient_data):
+        started = datetime.datetime.now()
+        if self.last_id is None or started - self.full_refresh >= PICK_LIST_FULL_REFRESH:
+            patients, loinc_numbers, last_id = set(), set(), 0
+            self.full_refresh = started
+        else:
+            patients, loinc_numbers, last_id = set(self.patients), set(self.loinc_numbers), self.last_id
+        for first_name, last_name, loinc_num, max_id in patient_data.get_patients_and_loincs_after(last_id):
+            patients.add(f"{first_name} {last_name}")
+            loinc_numbers.add(loinc_num)
+            last_id = max(last_id, max_id)
+        self.patients, self.loinc_numbers, self.last_id = sorted(patients), sorted(loinc_numbers), last_id
+        self.save()
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + ".tmp", "w") as f:
+            json.dump({"patients": self.patients, "loinc_numbers": self.loinc_numbers,
+                       "last_id": self.last_id, "full_refresh": self.full_refresh.isoformat()}, f)
+        os.replace(self.path + ".tmp", self.path)
@@ -0,0 +1,120 @@
+import collections
+import copy
+import functools
+import threading
+import time
+
+import pandas as pd
+
+
+class ResultCache:
+    # Bounded LRU cache of query results with a TTL and write-aware invalidation.
+    # Every entry has tags (the (patient, LOINC) pairs, or ('*', LOINC) for all the patients, it depends on)
+    # and the transaction time cutoff it was asked at (None when it sees every version).
+    # A write of (patient, LOINC) recorded at t evicts only the tagged entries with no cutoff or a cutoff >= t.
+    # Entries asked at a cutoff before the newest transaction time cannot be changed by new writes,
+    # they are kept without a TTL (until the LRU pushes them out).
+    # max_entries - entries kept, the least recently used go first
+    # ttl - seconds an entry that new writes could change is trusted (writes of other processes are not seen)
+    def __init__(self, max_entries=1024, ttl=60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.tagged = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # Counts invalidations, a result computed while a write came in is not stored
+        self.generation = 0
+
+    # (True, result) for a cached result, (False, None) otherwise
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or (entry[1] is not None and entry[1] < time.monotonic()):
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return False, None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True, self._copy(entry[0])
+
+    def put(self, key, result, tags, cutoff=None, permanent=False, generation=None):
+        expires = None if permanent else time.monotonic() + self.ttl
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (self._copy(result), expires, frozenset(tags), cutoff)
+            for tag in tags:
+                self.tagged.setdefault(tag, set()).add(key)
+            while len(self.entries) > self.max_entries:
+                self._remove(next(iter(self.entries)))
+
+    # A write of (patient, loinc_num) recorded at transaction_time
+    def invalidate(self, patient, loinc_num, transaction_time):
+        transaction_time = pd.Timestamp(transaction_time)
+        with self.lock:
+            self.generation += 1
+            for tag in ((patient, loinc_num), ('*', loinc_num)):
+                for key in list(self.tagged.get(tag, ())):
+                    cutoff = self.entries[key][3]
+                    if cutoff is None or cutoff >= transaction_time:
+                        self._remove(key)
+
+    # Evict every entry with the tag, whatever its cutoff
+    def invalidate_tag(self, tag):
+        with self.lock:
+            self.generation += 1
+            for key in list(self.tagged.get(tag, ())):
+                self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.tagged.clear()
+
+    def _remove(self, key):
+        _, _, tags, _ = self.entries.pop(key)
+        for tag in tags:
+            keys = self.tagged.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tagged[tag]
+
+    # Callers get their own copy of DataFrames, Series and lists of patient states
+    @staticmethod
+    def _copy(result):
+        if isinstance(result, (pd.DataFrame, pd.Series)):
+            return result.copy()
+        if isinstance(result, (list, dict)):
+            return copy.deepcopy(result)
+        return result
+
+
+# Decorator of the query methods of an object with a cache (ResultCache) and a
+# newest_transaction_time() method. describe(self, *args, **kwargs) gives the (tags, cutoff)
+# of a call, or None when the call is not cached.
+def cached_query(describe):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(self, *args, **kwargs):
+            description = describe(self, *args, **kwargs)
+            if self.cache is None or description is None:
+                return function(self, *args, **kwargs)
+            key = (function.__name__, tuple(tuple(arg) if isinstance(arg, list) else arg for arg in args),
+                   tuple(sorted(kwargs.items())))
+            found, result = self.cache.get(key)
+            if found:
+                return result
+            tags, cutoff = description
+            generation = self.cache.generation
+            permanent = cutoff is not None and cutoff < self.newest_transaction_time()
+            result = function(self, *args, **kwargs)
+            self.cache.put(key, result, tags, cutoff, permanent, generation)
+            return result
+        return wrapper
+    return decorator
@@ -0,0 +1,211 @@
+import threading
+
+import numpy as np
+import pandas as pd
+
+from bitemporal_index import DELETED_VALUE
+from metrics import instrumented, phase
+
+
+# Columns of the store: patient, LOINC, text and unit are interned ids (text is the value as it was written),
+# value is the numeric value (NaN for categorical values),
+# times are int64 nanoseconds since the epoch. Rows are kept in the order they were added.
+STORE_COLUMNS = {
+    'patient': np.int32,
+    'loinc_num': np.int32,
+    'value': np.float64,
+    'text': np.int32,
+    'unit': np.int32,
+    'valid_start_time': np.int64,
+    'transaction_time': np.int64,
+}
+
+
+class Interner:
+    # Small integer ids of repeated labels, id i is labels[i]
+    def __init__(self, labels=()):
+        self.labels = list(labels)
+        self.codes = {label: code for code, label in enumerate(self.labels)}
+
+    def encode(self, values):
+        codes = np.empty(len(values), dtype=np.int32)
+        for i, value in enumerate(values):
+            code = self.codes.get(value)
+            if code is None:
+                code = self.codes[value] = len(self.labels)
+                self.labels.append(value)
+            codes[i] = code
+        return codes
+
+    # Labels of the ids, -1 is None
+    def decode(self, codes):
+        return np.asarray(self.labels + [None], dtype=object)[codes]
+
+
+def _nanoseconds(value):
+    return pd.Timestamp(value).value
+
+
+class ResultStore:
+    # Compact in-memory copy of test_results: about 40 bytes a row in contiguous typed arrays
+    # instead of a tuple of Python strings and datetimes. Values are parsed once when rows are added,
+    # their text is kept (interned) to answer with it.
+    # query_test_results and query_latest_results answer like the PatientData methods,
+    # with vectorized filters over the arrays.
+    # patient_data - the PatientData of refresh, which adds the rows with ids after the highest one read
+    def __init__(self, capacity=1024, patient_data=None):
+        self.db = patient_data
+        self.watermark = 0
+        self.patients = Interner()
+        self.loinc_nums = Interner()
+        self.texts = Interner()
+        self.units = Interner()
+        self.size = 0
+        self.columns = {name: np.empty(capacity, dtype=dtype) for name, dtype in STORE_COLUMNS.items()}
+        self.lock = threading.RLock()
+        # One refresh at a time, the database is read outside of lock so the queries go on meanwhile
+        self.refresh_lock = threading.Lock()
+
+    # Store of all of test_results, kept up to date with the writes of patient_data:
+    # every write of it refreshes the store, refresh also reads the rows of other writers
+    @classmethod
+    def load(cls, patient_data):
+        store = cls(patient_data=patient_data)
+        patient_data.on_write(lambda records: store.refresh())
+        store.refresh()
+        return store
+
+    # Add the rows written after the highest id read (by any writer), returns how many were new
+    def refresh(self):
+        if self.db is None:
+            return 0
+        with self.refresh_lock:
+            rows = self.db.query_test_result_rows(after_id=self.watermark)
+            if not rows:
+                return 0
+            self.add([row[1:] for row in rows])
+            self.watermark = rows[-1][0]
+            return len(rows)
+
+    @property
+    def nbytes(self):
+        return sum(column[:self.size].nbytes for column in self.columns.values())
+
+    def _reserve(self, rows):
+        capacity = len(self.columns['patient'])
+        if self.size + rows <= capacity:
+            return
+        while capacity < self.size + rows:
+            capacity *= 2
+        for name, column in self.columns.items():
+            grown = np.empty(capacity, dtype=column.dtype)
+            grown[:self.size] = column[:self.size]
+            self.columns[name] = grown
+
+    # Add records (RECORD_COLUMNS order)
+    def add(self, records):
+        records = list(records)
+        if not records:
+            return
+        first_names, last_names, loinc_nums, values, units, valid_times, transaction_times = zip(*records)
+        numbers = pd.to_numeric(pd.Series(values, dtype=object), errors='coerce').to_numpy(dtype=np.float64)
+        valid_times = pd.to_datetime(pd.Series(valid_times)).to_numpy('datetime64[ns]').astype(np.int64)
+        transaction_times = pd.to_datetime(pd.Series(transaction_times)).to_numpy('datetime64[ns]').astype(np.int64)
+        # The interners are shared with the queries (and other writers), they are changed under lock
+        with self.lock:
+            new = {
+                'patient': self.patients.encode(list(zip(first_names, last_names))),
+                'loinc_num': self.loinc_nums.encode(loinc_nums),
+                'value': numbers,
+                'text': self.texts.encode([str(value) for value in values]),
+                'unit': self.units.encode(units),
+                'valid_start_time': valid_times,
+                'transaction_time': transaction_times,
+            }
+            self._reserve(len(records))
+            for name, column in new.items():
+                self.columns[name][self.size:self.size + len(records)] = column
+            self.size += len(records)
+
+    # Positions of the rows that pass the filters, in patient, LOINC, valid time, transaction time order
+    def _select(self, first_name=None, last_name=None, loinc_num=None, valid_from=None, valid_to=None, as_of=None):
+        columns = {name: column[:self.size] for name, column in self.columns.items()}
+        keep = np.ones(self.size, dtype=bool)
+        if first_name is not None:
+            keep &= columns['patient'] == self.patients.codes.get((first_name, last_name), -1)
+        if loinc_num is not None:
+            loinc_nums = loinc_num if isinstance(loinc_num, (list, tuple, set)) else [loinc_num]
+            keep &= np.isin(columns['loinc_num'], [self.loinc_nums.codes.get(code, -1) for code in loinc_nums])
+        if valid_from is not None:
+            keep &= columns['valid_start_time'] >= _nanoseconds(valid_from)
+        if valid_to is not None:
+            keep &= columns['valid_start_time'] <= _nanoseconds(valid_to)
+        if as_of is not None:
+            keep &= columns['transaction_time'] <= _nanoseconds(as_of)
+        positions = np.flatnonzero(keep)
+        # Positions break transaction time ties: the row added last is the latest version
+        order = np.lexsort((positions, columns['transaction_time'][positions], columns['valid_start_time'][positions],
+                            columns['loinc_num'][positions], columns['patient'][positions]))
+        return positions[order]
+
+    # Keep the last row of every group of equal keys (positions are sorted by the keys)
+    def _last_of_groups(self, positions, keys):
+        if not len(positions):
+            return positions
+        changes = np.zeros(len(positions) - 1, dtype=bool)
+        for key in keys:
+            column = self.columns[key][positions]
+            changes |= column[1:] != column[:-1]
+        return positions[np.r_[changes, True]]
+
+    # Latest version of every measurement, deleted measurements left out
+    def _latest_versions(self, positions):
+        positions = self._last_of_groups(positions, ('patient', 'loinc_num', 'valid_start_time'))
+        deleted = self.texts.codes.get(DELETED_VALUE, -1)
+        return positions[self.columns['text'][positions] != deleted]
+
+    def _records(self, positions):
+        columns = {name: column[positions] for name, column in self.columns.items()}
+        values = self.texts.decode(columns['text'])
+        patients = self.patients.decode(columns['patient'])
+        valid_times = pd.to_datetime(columns['valid_start_time'])
+        transaction_times = pd.to_datetime(columns['transaction_time'])
+        return list(zip([patient[0] for patient in patients], [patient[1] for patient in patients],
+                        self.loinc_nums.decode(columns['loinc_num']), values, self.units.decode(columns['unit']),
+                        valid_times, transaction_times))
+
+    # Same rows as PatientData.query_test_results
+    @instrumented('ResultStore.query_test_results')
+    def query_test_results(self, first_name=None, last_name=None, loinc_num=None, valid_from=None, valid_to=None,
+                           as_of=None, latest_only=False):
+        with self.lock:
+            with phase('filtering'):
+                positions = self._select(first_name, last_name, loinc_num, valid_from, valid_to, as_of)
+                if latest_only:
+                    positions = self._latest_versions(positions)
+            with phase('dataframe'):
+                return self._records(positions)
+
+    # All the versions of the LOINCs of many patients ((first_name, last_name) pairs), in the order they were
+    # added: the rows of PatientData.query_patients_test_results without their ids
+    @instrumented('ResultStore.query_patients_test_results')
+    def query_patients_test_results(self, patients, loinc_nums):
+        with self.lock:
+            with phase('filtering'):
+                keep = np.isin(self.columns['patient'][:self.size],
+                               [self.patients.codes.get(tuple(patient), -1) for patient in patients])
+                keep &= np.isin(self.columns['loinc_num'][:self.size],
+                                [self.loinc_nums.codes.get(code, -1) for code in loinc_nums])
+            with phase('dataframe'):
+                return self._records(np.flatnonzero(keep))
+
+    # Same rows as PatientData.query_latest_results
+    @instrumented('ResultStore.query_latest_results')
+    def query_latest_results(self, loinc_nums, as_of):
+        with self.lock:
+            with phase('filtering'):
+                positions = self._latest_versions(self._select(loinc_num=list(loinc_nums), valid_to=as_of, as_of=as_of))
+                positions = self._last_of_groups(positions, ('patient', 'loinc_num'))
+            with phase('dataframe'):
+                records = self._records(positions)
+        return sorted(records, key=lambda record: (record[0], record[1], record[2]))
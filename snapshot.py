@@ -0,0 +1,246 @@
+import argparse
+import datetime
+import json
+import os
+import shutil
+import threading
+
+import numpy as np
+import pandas as pd
+
+from bitemporal_index import DELETED_VALUE, RECORD_COLUMNS
+from database import PatientData
+from metrics import instrumented, phase
+from result_store import Interner
+from storage import open_storage
+
+
+# Column files of a snapshot: name -> dtype. Text columns are dictionary codes (labels in meta.json),
+# times are int64 nanoseconds since the epoch and value_number is the value as a number (NaN for text)
+SNAPSHOT_COLUMNS = {
+    'id': np.int64,
+    'patient': np.int32,
+    'loinc_num': np.int32,
+    'value': np.int32,
+    'value_number': np.float64,
+    'unit': np.int32,
+    'valid_start_time': np.int64,
+    'transaction_time': np.int64,
+}
+DICTIONARIES = ('patient', 'loinc_num', 'value', 'unit')
+META_FILE = 'meta.json'
+
+
+def _nanoseconds(times):
+    return pd.to_datetime(pd.Series(times)).to_numpy('datetime64[ns]').astype(np.int64)
+
+
+# Rows (id + RECORD_COLUMNS) -> column arrays, text encoded with the dictionaries
+def _encode(rows, dictionaries):
+    rows = list(rows)
+    columns = list(zip(*rows)) if rows else [[] for _ in range(len(RECORD_COLUMNS) + 1)]
+    ids, first_names, last_names, loinc_nums, values, units, valid_times, transaction_times = columns
+    return {
+        'id': np.asarray(ids, dtype=np.int64),
+        'patient': dictionaries['patient'].encode(list(zip(first_names, last_names))),
+        'loinc_num': dictionaries['loinc_num'].encode(loinc_nums),
+        'value': dictionaries['value'].encode([str(value) for value in values]),
+        'value_number': pd.to_numeric(pd.Series(values, dtype=object), errors='coerce').to_numpy(dtype=np.float64),
+        'unit': dictionaries['unit'].encode(units),
+        'valid_start_time': _nanoseconds(valid_times),
+        'transaction_time': _nanoseconds(transaction_times),
+    }
+
+
+def _sort_order(columns):
+    return np.lexsort((columns['id'], columns['transaction_time'], columns['valid_start_time'],
+                       columns['loinc_num'], columns['patient']))
+
+
+# Export test_results to a columnar snapshot directory: one .npy file per column, rows sorted by
+# patient, LOINC, valid time and transaction time, with the row range of every (patient, LOINC)
+# partition. The new snapshot replaces the old one only once it is complete.
+@instrumented('snapshot.write_snapshot')
+def write_snapshot(patient_data, directory):
+    rows = patient_data.query_test_result_rows()
+    dictionaries = {name: Interner() for name in DICTIONARIES}
+    with phase('dataframe'):
+        columns = _encode(rows, dictionaries)
+        order = _sort_order(columns)
+        columns = {name: column[order] for name, column in columns.items()}
+
+    patients, loinc_nums = columns['patient'], columns['loinc_num']
+    starts = np.flatnonzero(np.r_[True, (patients[1:] != patients[:-1]) | (loinc_nums[1:] != loinc_nums[:-1])]) \
+        if len(patients) else np.array([], dtype=np.int64)
+    stops = np.r_[starts[1:], len(patients)].astype(np.int64)
+    partitions = np.column_stack([patients[starts], loinc_nums[starts], starts, stops]).astype(np.int64)
+
+    meta = {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'rows': len(order),
+        # Largest id in the snapshot, rows with a higher id are the delta
+        'max_id': int(columns['id'].max()) if len(order) else 0,
+        'dictionaries': {name: [list(label) if name == 'patient' else label for label in dictionaries[name].labels]
+                         for name in DICTIONARIES},
+    }
+
+    temporary = directory.rstrip(os.sep) + '.tmp'
+    shutil.rmtree(temporary, ignore_errors=True)
+    os.makedirs(temporary)
+    for name, dtype in SNAPSHOT_COLUMNS.items():
+        np.save(os.path.join(temporary, f'{name}.npy'), columns[name].astype(dtype))
+    np.save(os.path.join(temporary, 'partitions.npy'), partitions)
+    with open(os.path.join(temporary, META_FILE), 'w') as f:
+        json.dump(meta, f)
+
+    previous = directory.rstrip(os.sep) + '.old'
+    shutil.rmtree(previous, ignore_errors=True)
+    if os.path.exists(directory):
+        os.replace(directory, previous)
+    os.replace(temporary, directory)
+    shutil.rmtree(previous, ignore_errors=True)
+    return meta['rows']
+
+
+class TestResultsSnapshot:
+    # Reader of a snapshot directory. The column files are memory mapped, not read, and
+    # apply_delta adds the rows recorded in the database after the snapshot was written.
+    # query_latest_results and query_test_results answer like the PatientData methods.
+    # Thread safe: the delta and the dictionaries are changed and read under lock.
+    def __init__(self, directory, patient_data=None):
+        self.directory = directory
+        self.db = patient_data
+        with open(os.path.join(directory, META_FILE)) as f:
+            meta = json.load(f)
+        self.columns = {name: np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r')
+                        for name in SNAPSHOT_COLUMNS}
+        self.dictionaries = {name: Interner(tuple(label) if name == 'patient' else label for label in labels)
+                             for name, labels in meta['dictionaries'].items()}
+        self.partitions = {(int(patient), int(loinc_num)): (int(start), int(stop))
+                           for patient, loinc_num, start, stop in np.load(os.path.join(directory, 'partitions.npy'))}
+        # Snapshots written before max_id was kept: the largest id of the id column
+        self.max_id = meta['max_id'] if 'max_id' in meta else int(np.max(self.columns['id'], initial=0))
+        self.delta = _encode([], self.dictionaries)
+        self.lock = threading.RLock()
+        # One apply_delta at a time, the database is read outside of lock so the queries go on meanwhile
+        self.delta_lock = threading.Lock()
+
+    # Add the rows added to the database since the snapshot (or the last delta), by id: unlike the
+    # transaction time it is given by the database, rows recorded late with an old transaction time are added too.
+    # Returns how many rows were new. A snapshot without a PatientData is only what was written.
+    @instrumented('TestResultsSnapshot.apply_delta')
+    def apply_delta(self):
+        if self.db is None:
+            return 0
+        with self.delta_lock:
+            rows = self.db.query_test_result_rows(after_id=self.max_id)
+            if not rows:
+                return 0
+            with self.lock:
+                new = _encode(rows, self.dictionaries)
+                self.delta = {name: np.concatenate([self.delta[name], new[name]]) for name in SNAPSHOT_COLUMNS}
+                self.max_id = rows[-1][0]
+            return len(rows)
+
+    # Snapshot rows of the partitions of the given patient and LOINCs (codes, None for all),
+    # together with the matching delta rows, sorted like the snapshot
+    def _select(self, patient=None, loinc_nums=None):
+        ranges = [(start, stop) for (partition_patient, partition_loinc), (start, stop) in self.partitions.items()
+                  if (patient is None or partition_patient == patient)
+                  and (loinc_nums is None or partition_loinc in loinc_nums)]
+        positions = np.concatenate([np.arange(start, stop) for start, stop in sorted(ranges)]) \
+            if ranges else np.array([], dtype=np.int64)
+        selected = {name: np.asarray(column[positions]) for name, column in self.columns.items()}
+
+        delta = np.ones(len(self.delta['id']), dtype=bool)
+        if patient is not None:
+            delta &= self.delta['patient'] == patient
+        if loinc_nums is not None:
+            delta &= np.isin(self.delta['loinc_num'], list(loinc_nums))
+        if not delta.any():
+            return selected
+        selected = {name: np.concatenate([selected[name], self.delta[name][delta]]) for name in SNAPSHOT_COLUMNS}
+        order = _sort_order(selected)
+        return {name: column[order] for name, column in selected.items()}
+
+    def _records(self, columns):
+        patients = self.dictionaries['patient'].decode(columns['patient'])
+        return pd.DataFrame({
+            'first_name': [patient[0] for patient in patients],
+            'last_name': [patient[1] for patient in patients],
+            'loinc_num': self.dictionaries['loinc_num'].decode(columns['loinc_num']),
+            'value': self.dictionaries['value'].decode(columns['value']),
+            'unit': self.dictionaries['unit'].decode(columns['unit']),
+            'valid_start_time': pd.to_datetime(columns['valid_start_time']),
+            'transaction_time': pd.to_datetime(columns['transaction_time']),
+        }, columns=RECORD_COLUMNS)
+
+    def _loinc_codes(self, loinc_num):
+        if loinc_num is None:
+            return None
+        loinc_nums = loinc_num if isinstance(loinc_num, (list, tuple, set)) else [loinc_num]
+        return {self.dictionaries['loinc_num'].codes[code] for code in loinc_nums
+                if code in self.dictionaries['loinc_num'].codes}
+
+    # All the versions of the test results of a patient and LOINC(s), rows in RECORD_COLUMNS order
+    @instrumented('TestResultsSnapshot.query_test_results')
+    def query_test_results(self, first_name=None, last_name=None, loinc_num=None):
+        with self.lock:
+            patient = None
+            if first_name is not None:
+                patient = self.dictionaries['patient'].codes.get((first_name, last_name))
+                if patient is None:
+                    return []
+            with phase('filtering'):
+                columns = self._select(patient, self._loinc_codes(loinc_num))
+            with phase('dataframe'):
+                return list(self._records(columns).itertuples(index=False, name=None))
+
+    # Same rows as PatientData.query_latest_results: the latest measurement of every (patient, LOINC)
+    # known at as_of, latest version only, deleted measurements left out
+    @instrumented('TestResultsSnapshot.query_latest_results')
+    def query_latest_results(self, loinc_nums, as_of):
+        with self.lock:
+            with phase('filtering'):
+                columns = self._select(loinc_nums=self._loinc_codes(list(loinc_nums)))
+                as_of = pd.Timestamp(as_of).value
+                known = (columns['valid_start_time'] <= as_of) & (columns['transaction_time'] <= as_of)
+                columns = {name: column[known] for name, column in columns.items()}
+
+                # Rows are sorted by patient, LOINC, valid time and transaction time:
+                # the last row of a valid time is its latest version, the last of a (patient, LOINC) its latest measurement
+                patients, loinc_nums, valid_times = columns['patient'], columns['loinc_num'], columns['valid_start_time']
+                new_series = (patients[1:] != patients[:-1]) | (loinc_nums[1:] != loinc_nums[:-1])
+                latest_version = np.r_[new_series | (valid_times[1:] != valid_times[:-1]), True] if len(patients) else \
+                    np.array([], dtype=bool)
+                deleted = self.dictionaries['value'].codes.get(DELETED_VALUE, -1)
+                columns = {name: column[latest_version & (columns['value'] != deleted)] for name, column in columns.items()}
+                patients, loinc_nums = columns['patient'], columns['loinc_num']
+                latest = np.r_[(patients[1:] != patients[:-1]) | (loinc_nums[1:] != loinc_nums[:-1]), True] \
+                    if len(patients) else np.array([], dtype=bool)
+                columns = {name: column[latest] for name, column in columns.items()}
+            with phase('dataframe'):
+                records = self._records(columns).sort_values(['first_name', 'last_name', 'loinc_num'], kind='stable')
+                return list(records.itertuples(index=False, name=None))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a columnar snapshot of the test_results table.")
+    parser.add_argument('directory')
+    parser.add_argument('--host', default="localhost")
+    parser.add_argument('--user', default="root")
+    parser.add_argument('--password', default="q6rh3b")
+    parser.add_argument('--database', default="patient_data")
+    parser.add_argument('--sqlite', help="snapshot this SQLite file instead of MySQL")
+    args = parser.parse_args()
+
+    if args.sqlite:
+        patient_data = PatientData(pool=open_storage('sqlite', args.sqlite))
+    else:
+        patient_data = PatientData(host=args.host, user=args.user, password=args.password, database=args.database)
+    rows = write_snapshot(patient_data, args.directory)
+    print(f"Snapshot of {rows} rows written to {args.directory}.")
+
+
+if __name__ == "__main__":
+    main()
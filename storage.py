@@ -0,0 +1,124 @@
+import os
+import re
+
+from connection_pool import ConnectionPool, get_pool
+
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+PATIENT_DATA_SCRIPT = os.path.join(SCRIPTS_DIR, "USE patient_data;.sql")
+KNOWLEDGE_BASE_SCRIPT = os.path.join(SCRIPTS_DIR, "my local mysql.session.sql")
+
+# MySQL error of CREATE INDEX when the index is already there (MySQL has no CREATE INDEX IF NOT EXISTS)
+MYSQL_DUPLICATE_KEY_NAME = 1061
+
+# Auto increment id column of the scripts and its SQLite form (a rowid alias that never reuses ids)
+AUTO_INCREMENT_ID = 'id INT NOT NULL AUTO_INCREMENT PRIMARY KEY'
+SQLITE_AUTO_INCREMENT_ID = 'id INTEGER PRIMARY KEY AUTOINCREMENT'
+
+TEST_RESULT_COLUMNS = "id, first_name, last_name, loinc_num, value, unit, valid_start_time, transaction_time"
+
+# KnowledgeBase reads the hemoglobin ranges from the concepts table, the knowledge base script
+# has them in hemoglobin_range (with good before/after columns it gives no values for)
+CONCEPTS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS concepts (
+    id INT PRIMARY KEY,
+    sex VARCHAR(255) NOT NULL,
+    category VARCHAR(255) NOT NULL,
+    range_value VARCHAR(255) NOT NULL
+)
+"""
+
+
+# Statements of a SQL script, without comments, USE and DROP statements
+def script_statements(script):
+    with open(script, encoding='utf-8') as f:
+        statements = [statement.strip() for statement in re.sub(r'--.*', '', f.read()).split(';')]
+    return [statement for statement in statements
+            if statement and not statement.upper().startswith(('USE ', 'DROP '))]
+
+
+# Create the tables and indexes of a script that are not there yet, existing data is kept
+def _create_schema(pool, statements):
+    with pool.session() as cursor:
+        _execute_schema(cursor, pool.dialect, statements)
+
+
+def _execute_schema(cursor, dialect, statements):
+    for statement in statements:
+        statement = re.sub(r'^CREATE TABLE (?!IF NOT EXISTS)', 'CREATE TABLE IF NOT EXISTS ', statement)
+        if dialect == 'sqlite':
+            statement = re.sub(r'^CREATE INDEX (?!IF NOT EXISTS)', 'CREATE INDEX IF NOT EXISTS ', statement)
+            statement = statement.replace(AUTO_INCREMENT_ID, SQLITE_AUTO_INCREMENT_ID)
+        try:
+            cursor.execute(statement)
+        except Exception as error:
+            if getattr(error, 'errno', None) != MYSQL_DUPLICATE_KEY_NAME:
+                raise
+
+
+# test_results table of 'USE patient_data;.sql' with its bitemporal indexes
+def create_patient_data_schema(pool, script=PATIENT_DATA_SCRIPT):
+    statements = [statement for statement in script_statements(script) if statement.upper().startswith('CREATE')]
+    if pool.dialect == 'sqlite':
+        _migrate_sqlite_test_result_ids(pool, statements)
+    _create_schema(pool, statements)
+    if pool.dialect == 'mysql':
+        _migrate_mysql_test_result_ids(pool)
+
+
+# test_results tables made before the database gave the ids get an auto increment id, rows keep their ids.
+# SQLite can't change a column: the table is made again and the rows are copied, in one transaction
+# (sqlite3 runs DDL outside of transactions unless one is begun), so a failed migration leaves the old table.
+def _migrate_sqlite_test_result_ids(pool, statements):
+    rows = pool.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'test_results'")
+    if not rows or 'AUTOINCREMENT' in rows[0][0].upper():
+        return
+    with pool.session() as cursor:
+        cursor.execute("BEGIN")
+        cursor.execute("ALTER TABLE test_results RENAME TO test_results_old")
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'test_results_old' "
+                       "AND sql IS NOT NULL")
+        for (index,) in cursor.fetchall():
+            cursor.execute(f"DROP INDEX {index}")
+        _execute_schema(cursor, pool.dialect, statements)
+        cursor.execute(f"INSERT INTO test_results ({TEST_RESULT_COLUMNS}) "
+                       f"SELECT {TEST_RESULT_COLUMNS} FROM test_results_old")
+        cursor.execute("DROP TABLE test_results_old")
+
+
+def _migrate_mysql_test_result_ids(pool):
+    rows = pool.execute("""
+        SELECT EXTRA FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'test_results' AND COLUMN_NAME = 'id'
+    """)
+    if rows and 'auto_increment' not in str(rows[0][0]).lower():
+        pool.execute("ALTER TABLE test_results MODIFY id INT NOT NULL AUTO_INCREMENT")
+
+
+# Knowledge base tables and rows of the knowledge base script, on an empty database
+def create_knowledge_base_schema(pool, script=KNOWLEDGE_BASE_SCRIPT):
+    statements = [CONCEPTS_SCHEMA.strip()]
+    for statement in script_statements(script):
+        if statement.upper().startswith('CREATE TABLE HEMOGLOBIN_RANGE'):
+            continue
+        statements.append(re.sub(r'^INSERT INTO hemoglobin_range \([^)]*\)',
+                                 'INSERT INTO concepts (id, sex, category, range_value)', statement))
+    _create_schema(pool, statements)
+
+
+# Connection pool of a storage backend, PatientData and KnowledgeBase work the same on all of them:
+# backend='mysql' - the MySQL server of host/user/password/database
+# backend='sqlite' - the embedded SQLite file path (made with the schema when it is new)
+def open_storage(backend='mysql', path=None, host=None, user=None, password=None, database=None,
+                 size=5, knowledge_base=False):
+    if backend == 'mysql':
+        return get_pool(host, user, password, database, size)
+    if backend != 'sqlite':
+        raise ValueError(f"Unknown storage backend {backend}")
+    is_new = not os.path.exists(path) or os.path.getsize(path) == 0
+    pool = ConnectionPool.for_sqlite(path, size)
+    if knowledge_base and is_new:
+        create_knowledge_base_schema(pool)
+    elif not knowledge_base:
+        create_patient_data_schema(pool)
+    return pool
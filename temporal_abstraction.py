@@ -0,0 +1,109 @@
+import datetime
+import numpy as np
+import pandas as pd
+
+
+PATIENT_KEYS = ['first_name', 'last_name']
+DEFAULT_SEX = 'male'
+
+# State ranges of each concept (LOINC) per sex: (lower bounds, states).
+# A value gets the state of the last lower bound it reaches, states[0] is below the first bound.
+# Lower bounds are inclusive, the same way the knowledge base reads '4000-10000' and '10000+'.
+WBC_RANGES = ([4000, 10000], ['wbc_low', 'wbc_medium', 'wbc_high'])
+HEMOGLOBIN_RANGES = {
+    'male': ([8, 10, 12, 14], ['Severe Anemia', 'Moderate Anemia', 'Mild Anemia', 'Normal Hemoglobin', 'Polycytemia']),
+    'female': ([9, 11, 13, 16], ['Severe Anemia', 'Moderate Anemia', 'Mild Anemia', 'Normal Hemoglobin', 'Polycythemia']),
+}
+FEVER_RANGES = ([38.5, 40.0], ['Grade I', 'Grade II', 'Grade III'])
+
+ABSTRACTION_RANGES = {
+    '11218-5': {'male': WBC_RANGES, 'female': WBC_RANGES},
+    '12181-4': HEMOGLOBIN_RANGES,
+    '30313-1': HEMOGLOBIN_RANGES,
+    '39106-0': {'male': FEVER_RANGES, 'female': FEVER_RANGES},
+}
+
+# How long a state persists without a new measurement, per concept.
+# Measurements closer than this with the same state are one interval,
+# and every interval is extended by it on both sides.
+PERSISTENCE = {
+    '11218-5': datetime.timedelta(days=2),
+    '12181-4': datetime.timedelta(days=7),
+    '30313-1': datetime.timedelta(days=7),
+    '39106-0': datetime.timedelta(days=1),
+}
+DEFAULT_PERSISTENCE = datetime.timedelta(days=2)
+
+INTERVAL_COLUMNS = PATIENT_KEYS + ['loinc_num', 'state', 'start_time', 'end_time', 'measurements']
+
+
+# Keep only the latest version (by transaction time) of every measurement
+def latest_versions(measurements):
+    measurements = measurements.sort_values('transaction_time', kind='stable')
+    return measurements.drop_duplicates(PATIENT_KEYS + ['loinc_num', 'valid_start_time'], keep='last')
+
+
+# Add a 'state' column to the measurements of any patients and concepts.
+# Sex comes from a 'sex' column when there is one, otherwise sex is used for all rows.
+# Concepts without ranges (and non numeric values) get no state.
+def abstract_states(measurements, sex=DEFAULT_SEX, ranges=None):
+    ranges = ABSTRACTION_RANGES if ranges is None else ranges
+    measurements = measurements.copy()
+    values = pd.to_numeric(measurements['value'], errors='coerce').to_numpy(dtype=float)
+    sexes = measurements['sex'] if 'sex' in measurements else pd.Series(sex, index=measurements.index)
+    states = np.full(len(measurements), None, dtype=object)
+
+    # One np.digitize per (concept, sex) group, not per row
+    groups = pd.DataFrame({'loinc_num': measurements['loinc_num'].to_numpy(), 'sex': sexes.to_numpy()})
+    for (loinc_num, group_sex), positions in groups.groupby(['loinc_num', 'sex']).indices.items():
+        concept_ranges = ranges.get(loinc_num, {}).get(group_sex)
+        if concept_ranges is None:
+            continue
+        bounds, labels = concept_ranges
+        group_values = values[positions]
+        known = ~np.isnan(group_values)
+        states[positions[known]] = np.asarray(labels, dtype=object)[np.digitize(group_values[known], bounds)]
+
+    measurements['state'] = states
+    return measurements
+
+
+# Merge the state measurements into state intervals, for any number of patients and concepts at once.
+# A new interval starts when the state changes or the gap from the previous measurement
+# reaches the concept persistence. Returns a table with INTERVAL_COLUMNS.
+def build_intervals(measurements, persistence=None, default_persistence=DEFAULT_PERSISTENCE):
+    persistence = PERSISTENCE if persistence is None else persistence
+    keys = PATIENT_KEYS + ['loinc_num']
+    df = measurements.dropna(subset=['state']).sort_values(keys + ['valid_start_time'], kind='stable')
+    if df.empty:
+        return pd.DataFrame(columns=INTERVAL_COLUMNS)
+
+    max_gap = df['loinc_num'].map(persistence).fillna(default_persistence)
+    max_gap = pd.to_timedelta(max_gap)
+    grouped = df.groupby(keys, sort=False)
+    gap = grouped['valid_start_time'].diff()
+    previous_state = grouped['state'].shift()
+
+    # First row of a series (no previous row), a changed state, or a long gap start a new run
+    new_run = gap.isna() | (df['state'] != previous_state) | (gap >= max_gap)
+    run_id = new_run.cumsum()
+
+    intervals = df.assign(run_id=run_id, max_gap=max_gap).groupby('run_id', sort=False).agg(
+        first_name=('first_name', 'first'),
+        last_name=('last_name', 'first'),
+        loinc_num=('loinc_num', 'first'),
+        state=('state', 'first'),
+        start_time=('valid_start_time', 'min'),
+        end_time=('valid_start_time', 'max'),
+        measurements=('valid_start_time', 'size'),
+        max_gap=('max_gap', 'first'),
+    )
+    intervals['start_time'] = intervals['start_time'] - intervals['max_gap']
+    intervals['end_time'] = intervals['end_time'] + intervals['max_gap']
+    return intervals[INTERVAL_COLUMNS].reset_index(drop=True)
+
+
+# Full abstraction pipeline of test_results rows: latest versions -> states -> intervals
+def abstract_intervals(measurements, sex=DEFAULT_SEX, ranges=None, persistence=None):
+    states = abstract_states(latest_versions(measurements), sex, ranges)
+    return build_intervals(states, persistence)
@@ -0,0 +1,37 @@
+import os
+
+import pytest
+
+from database import PatientData
+from dss_engine import DSSEngine
+from insert_csv_file import ingest_csv
+from knowlege_base import KnowledgeBase
+from storage import open_storage
+
+
+PROJECT_CSV = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'project_db.csv')
+
+
+# Empty test_results in a SQLite file of its own
+@pytest.fixture
+def patient_data(tmp_path):
+    pool = open_storage('sqlite', str(tmp_path / 'patient_data.db'))
+    yield PatientData(pool=pool)
+    pool.close()
+
+
+# Knowledge base of 'my local mysql.session.sql' in a SQLite file of its own
+@pytest.fixture
+def knowlege_base(tmp_path):
+    pool = open_storage('sqlite', str(tmp_path / 'kb.db'), knowledge_base=True)
+    yield KnowledgeBase(pool=pool)
+    pool.close()
+
+
+# DSSEngine of project_db.csv and the knowledge base
+@pytest.fixture
+def engine(patient_data, knowlege_base):
+    ingest_csv(patient_data, PROJECT_CSV)
+    engine = DSSEngine(patient_data, knowlege_base)
+    yield engine
+    engine.writer.close()
@@ -0,0 +1,54 @@
+from bitemporal_index import BitemporalIndex
+from database import PatientData
+from insert_csv_file import ingest_csv
+from tests.conftest import PROJECT_CSV
+
+PATIENT = ('Eyal', 'Rothman')
+ROW = (1, 'Eyal', 'Rothman', '11218-5', '4450', 'cells/ml', '2018-05-17 13:11:00', '2018-05-28 10:00:00')
+WRITE = ('Eyal', 'Rothman', '11218-5', '4000', 'cells/ml', '2018-05-17 13:11:00', '2018-06-01 10:00:00')
+
+
+# Writes of another PatientData (another process) on a loaded key are seen on the next lookup
+def test_index_sees_writes_of_other_writers(patient_data):
+    ingest_csv(patient_data, PROJECT_CSV)
+    index = patient_data.get_patient_index('Eyal', 'Rothman', '11218-5')
+    assert index.value_at(PATIENT, '11218-5', '2018-05-17 13:11:00', '2018-06-02 00:00:00')[3] == '4450'
+
+    other = PatientData(pool=patient_data.pool)
+    other.add_test_results([WRITE], skip_existing=False)
+    index = patient_data.get_patient_index('Eyal', 'Rothman', '11218-5')
+    assert index.value_at(PATIENT, '11218-5', '2018-05-17 13:11:00', '2018-06-02 00:00:00')[3] == '4000'
+    assert index.value_at(PATIENT, '11218-5', '2018-05-17 13:11:00', '2018-05-30 00:00:00')[3] == '4450'
+
+
+# A write committed after the rows were fetched, before they are loaded, is not lost
+def test_write_during_load_is_kept():
+    index = BitemporalIndex()
+    index.begin_load(PATIENT, '11218-5')
+    index.add(WRITE)
+    index.load(PATIENT, '11218-5', [ROW])
+    assert index.value_at(PATIENT, '11218-5', '2018-05-17 13:11:00', '2018-06-02 00:00:00')[3] == '4000'
+    assert index.watermark(PATIENT, '11218-5') == 1
+
+    index.add(WRITE[:3] + ('3900',) + WRITE[4:6] + ('2018-06-03 10:00:00',))
+    assert index.value_at(PATIENT, '11218-5', '2018-05-17 13:11:00', '2018-06-04 00:00:00')[3] == '3900'
+
+
+# Versions recorded at the same transaction time: the one with the higher id is the latest,
+# whatever order the rows come in and when a write of them is seen during the load
+def test_same_transaction_time_versions_in_id_order(patient_data):
+    first = WRITE[:3] + ('4100',) + WRITE[4:]
+    second = WRITE[:3] + ('4200',) + WRITE[4:]
+    index = BitemporalIndex()
+    index.begin_load(PATIENT, '11218-5')
+    index.add(second)
+    index.load(PATIENT, '11218-5', [(3,) + second, (2,) + first])
+    assert index.value_at(PATIENT, '11218-5', WRITE[5], WRITE[6])[3] == '4200'
+
+    patient_data.add_test_results([first, second], skip_existing=False)
+    index = patient_data.get_patient_index('Eyal', 'Rothman', '11218-5')
+    assert index.value_at(PATIENT, '11218-5', WRITE[5], WRITE[6])[3] == '4200'
+    plan = patient_data.pool.execute("EXPLAIN QUERY PLAN SELECT id FROM test_results "
+                                     "WHERE first_name = 'Eyal' AND last_name = 'Rothman' AND loinc_num = '11218-5' "
+                                     "AND id > 5")
+    assert 'idx_test_results_patient_id' in str(plan)
@@ -0,0 +1,32 @@
+import threading
+
+from bitemporal_writer import BitemporalWriter
+from ingestion_service import Ingestor
+from insert_csv_file import ingest_csv
+from tests.conftest import PROJECT_CSV
+
+
+# Corrections of the writer and readings of the ingestor at the same time: every write commits
+def test_writer_and_ingestor_together(patient_data):
+    ingest_csv(patient_data, PROJECT_CSV)
+    writer = BitemporalWriter(patient_data, flush_latency=0.01)
+    ingestor = Ingestor(patient_data, batch_size=20, flush_interval=0.01, dedup_window=None)
+
+    def ingest():
+        for i in range(200):
+            ingestor.submit({'first_name': 'Stream', 'last_name': 'Patient', 'loinc_num': '76477-9', 'value': i,
+                             'unit': 'BPM', 'valid_start_time': f'2024-01-01 {i // 60:02d}:{i % 60:02d}:00'})
+
+    thread = threading.Thread(target=ingest)
+    thread.start()
+    futures = [writer.correct('Eyal', 'Rothman', '11218-5', '2018-05-17 13:11:00', 4000 + i, 'cells/ml')
+               for i in range(50)]
+    committed = [future.result(timeout=30) for future in futures]
+    thread.join()
+    ingestor.close()
+    writer.close()
+
+    assert [row[3] for row in committed] == [str(4000 + i) for i in range(50)]
+    assert ingestor.stats()['written'] == 200
+    ids = [row[0] for row in patient_data.query_test_result_rows()]
+    assert len(ids) == len(set(ids)) == 256 + 50 + 200
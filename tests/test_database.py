@@ -0,0 +1,90 @@
+import pandas as pd
+
+from bitemporal_index import DELETED_VALUE, RECORD_COLUMNS
+from insert_csv_file import ingest_csv
+from tests.conftest import PROJECT_CSV
+
+KEYS = ['first_name', 'last_name', 'loinc_num', 'valid_start_time', 'transaction_time']
+CORRECTIONS = [
+    ('Eli', 'Call', '11218-5', DELETED_VALUE, 'cells/ml', '2018-05-18 15:00:00', '2018-05-25 10:00:00'),
+    ('Eyal', 'Rothman', '11218-5', '4300', 'cells/ml', '2018-05-17 13:11:00', '2018-05-29 10:00:00'),
+]
+
+
+def _loaded(patient_data):
+    ingest_csv(patient_data, PROJECT_CSV)
+    patient_data.add_test_results(CORRECTIONS)
+    rows = pd.DataFrame(patient_data.query_test_result_rows(), columns=['id'] + RECORD_COLUMNS)
+    rows['valid_start_time'] = pd.to_datetime(rows['valid_start_time'])
+    rows['transaction_time'] = pd.to_datetime(rows['transaction_time'])
+    return rows
+
+
+# The pandas filtering the engine did before the filters went to the database
+def _expected(rows, loinc_nums, valid_from=None, valid_to=None, as_of=None, latest_only=False):
+    rows = rows[rows['loinc_num'].isin(loinc_nums)]
+    if valid_from is not None:
+        rows = rows[rows['valid_start_time'] >= valid_from]
+    if valid_to is not None:
+        rows = rows[rows['valid_start_time'] <= valid_to]
+    if as_of is not None:
+        rows = rows[rows['transaction_time'] <= as_of]
+    if latest_only:
+        rows = rows.sort_values(['transaction_time', 'id'])
+        rows = rows.drop_duplicates(['first_name', 'last_name', 'loinc_num', 'valid_start_time'], keep='last')
+        rows = rows[rows['value'] != DELETED_VALUE]
+    return _normalized(rows[RECORD_COLUMNS].itertuples(index=False, name=None))
+
+
+def _normalized(rows):
+    return sorted(tuple(row[:5]) + (pd.Timestamp(row[5]), pd.Timestamp(row[6])) for row in rows)
+
+
+def test_query_test_results_filters(patient_data):
+    rows = _loaded(patient_data)
+    loinc_nums = ['11218-5', '12181-4']
+    for valid_from, valid_to in ((None, None), (pd.Timestamp('2018-05-17 13:11:00'), pd.Timestamp('2018-05-18'))):
+        for as_of in (None, pd.Timestamp('2018-05-21 10:00:00'), pd.Timestamp('2018-05-28')):
+            for latest_only in (False, True):
+                assert _normalized(patient_data.query_test_results(
+                    loinc_num=loinc_nums, valid_from=valid_from, valid_to=valid_to, as_of=as_of,
+                    latest_only=latest_only)) == _expected(rows, loinc_nums, valid_from, valid_to, as_of, latest_only)
+    eli = rows[(rows['first_name'] == 'Eli') & (rows['last_name'] == 'Call')]
+    assert _normalized(patient_data.query_test_results('Eli', 'Call', '11218-5', latest_only=True)) == \
+        _expected(eli, ['11218-5'], latest_only=True)
+
+
+# One row per patient and LOINC: its latest measurement known at as_of
+def test_query_latest_results(patient_data):
+    rows = _loaded(patient_data)
+    loinc_nums = ['11218-5', '12181-4', 'chills']
+    for as_of in (pd.Timestamp('2018-05-20'), pd.Timestamp('2018-05-26'), pd.Timestamp('2030-01-01')):
+        known = pd.DataFrame(_expected(rows, loinc_nums, valid_to=as_of, as_of=as_of, latest_only=True),
+                             columns=RECORD_COLUMNS)
+        expected = known.sort_values('valid_start_time').drop_duplicates(['first_name', 'last_name', 'loinc_num'],
+                                                                          keep='last')
+        assert _normalized(patient_data.query_latest_results(loinc_nums, as_of)) == \
+            _normalized(expected.itertuples(index=False, name=None))
+
+
+# The engine methods on the pushed down queries
+def test_engine_history_update_and_delete(engine):
+    history = engine.retrieval_history_question(('Eyal', 'Rothman', '11218-5', '2018-05-17', '00:00:00',
+                                                 '2018-05-18', '23:59:59'))
+    assert len(history) == len(engine.db.query_test_results('Eyal', 'Rothman', '11218-5',
+                                                            valid_from='2018-05-17', valid_to='2018-05-18 23:59:59'))
+    assert history['valid_start_time'].between('2018-05-17', '2018-05-19').all()
+
+    version = ('Eyal', 'Rothman', '11218-5', '2018-05-17', '13:11:00', '2018-05-28', '10:00:00')
+    message, new_version = engine.update_record('4200', version)
+    assert message == "The update was successful." and new_version['value'].tolist() == ['4200']
+    latest = engine.db.query_test_results('Eyal', 'Rothman', '11218-5', valid_from='2018-05-17 13:11:00',
+                                          valid_to='2018-05-17 13:11:00', latest_only=True)
+    assert [row[3] for row in latest] == ['4200']
+    assert engine.update_record('1', version[:5] + ('2018-05-01', '10:00:00')) == \
+        "No record found in inserted valid time and transaction time."
+
+    message, deleted = engine.delete_record(('Eli', 'Call', '11218-5', '2018-05-18', '15:00:00',
+                                             '2018-05-21', '10:00:00'))
+    assert message == "The delete was successful." and deleted['value'].tolist() == ['5500']
+    assert engine.db.query_test_results('Eli', 'Call', '11218-5', latest_only=True) == []
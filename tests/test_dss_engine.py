@@ -0,0 +1,35 @@
+import pandas as pd
+
+from bitemporal_index import DELETED_VALUE
+
+
+# A retrieval result to compare: the message, or the kind of result and its rows
+def _rows(result):
+    if isinstance(result, str):
+        return result
+    frame = result.to_frame().T if isinstance(result, pd.Series) else result
+    return type(result).__name__, [row[:5] + (pd.Timestamp(row[5]), pd.Timestamp(row[6]))
+                                   for row in frame.itertuples(index=False, name=None)]
+
+
+# retrieval_questions gives every query the same answer as retrieval_question: exact valid times and
+# whole days, before and after corrections and deletes, unknown patients and missing times
+def test_batch_and_single_retrieval_agree(engine):
+    engine.db.add_test_results([('Eli', 'Call', '11218-5', DELETED_VALUE, 'cells/ml',
+                                 '2018-05-18 15:00:00', '2018-05-25 10:00:00')])
+    queries = [('Eli', 'Call', '11218-5', '2018-05-18', None, '2018-05-30', '00:00:00'),
+               ('No', 'Body', '11218-5', '2018-05-18', '15:00:00', '2018-05-30', '00:00:00'),
+               ('Eli', 'Call', '11218-5', None, None, '2018-05-30', '00:00:00'),
+               ('Eli', 'Call', '11218-5', '2018-05-18', '15:00:00', None, None)]
+    for _, first_name, last_name, loinc_num, _, _, valid_time, transaction_time in engine.db.query_test_result_rows():
+        valid_time, transaction_time = pd.Timestamp(valid_time), pd.Timestamp(transaction_time)
+        for as_of in (transaction_time - pd.Timedelta(seconds=1), transaction_time, transaction_time + pd.Timedelta(days=30)):
+            physician = (as_of.strftime('%Y-%m-%d'), as_of.strftime('%H:%M:%S'))
+            queries.append((first_name, last_name, loinc_num, valid_time.strftime('%Y-%m-%d'),
+                            valid_time.strftime('%H:%M:%S')) + physician)
+            queries.append((first_name, last_name, loinc_num, valid_time.strftime('%Y-%m-%d'), None) + physician)
+
+    batch = engine.retrieval_questions(queries)
+    assert len(batch) == len(queries)
+    for query, result in zip(queries, batch):
+        assert _rows(result) == _rows(engine.retrieval_question(query)), query
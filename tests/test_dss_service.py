@@ -0,0 +1,58 @@
+import asyncio
+import http.client
+import json
+import time
+from http import HTTPStatus
+
+from dss_service import DSSService
+
+SPECIFIC = {'first_name': 'Eli', 'last_name': 'Call', 'loinc_num': '11218-5', 'valid_date': '2018-05-18',
+            'valid_time': '15:00:00', 'physician_date': '2030-01-01', 'physician_time': '00:00:00'}
+UPDATE = dict(SPECIFIC, transaction_date='2018-05-21', transaction_time='10:00:00', new_value='6000')
+
+
+def _post(service, path, body):
+    return asyncio.run(service.dispatch('POST', path, json.dumps(body).encode('utf-8')))
+
+
+def test_endpoints_over_http(engine):
+    service = DSSService(engine, workers=2)
+    port = service.start_in_thread()
+    connection = http.client.HTTPConnection('127.0.0.1', port)
+    connection.request('POST', '/specific', json.dumps(SPECIFIC), {'Content-Type': 'application/json'})
+    response = connection.getresponse()
+    body = json.loads(response.read())
+    assert response.status == 200 and body['successful'] and body['results'][0]['value'] == '5500'
+    connection.request('GET', '/health')
+    assert json.loads(connection.getresponse().read())['status'] == 'ok'
+    service.close()
+
+
+# Only a field missing from the request is a bad request, a KeyError of the engine is a server error
+def test_missing_fields_and_engine_errors(engine, monkeypatch):
+    service = DSSService(engine, workers=2)
+    status, payload = _post(service, '/update', {'first_name': 'Eli', 'last_name': 'Call', 'loinc_num': '11218-5'})
+    assert status == HTTPStatus.BAD_REQUEST and payload['message'] == "Missing field new_value"
+
+    def broken(query):
+        raise KeyError('missing_column')
+    monkeypatch.setattr(engine, 'retrieval_question', broken)
+    status, payload = _post(service, '/specific', SPECIFIC)
+    assert status == HTTPStatus.INTERNAL_SERVER_ERROR
+    service.executor.shutdown()
+
+
+# A slow query times out, a slow update is waited for: it is applied once and the client is told so
+def test_writes_are_not_timed_out(engine, monkeypatch):
+    service = DSSService(engine, workers=2, timeout=0.05)
+    update_record = engine.update_record
+
+    def slow(*args, **kwargs):
+        time.sleep(0.2)
+        return update_record(*args, **kwargs)
+    monkeypatch.setattr(engine, 'update_record', slow)
+    monkeypatch.setattr(engine, 'retrieval_question', lambda query: time.sleep(0.2))
+    status, payload = _post(service, '/update', UPDATE)
+    assert status == HTTPStatus.OK and payload['message'] == "Update was Successful"
+    assert _post(service, '/specific', SPECIFIC)[0] == HTTPStatus.GATEWAY_TIMEOUT
+    service.executor.shutdown()
@@ -0,0 +1,37 @@
+import threading
+
+import pytest
+
+gui_interface = pytest.importorskip("gui_interface")
+
+
+class _Window:
+    def __init__(self):
+        self.events = []
+
+    def write_event_value(self, key, value):
+        self.events.append((key, value))
+
+
+# A started update can't be replaced: Cancel and a new update keep it, its result is still shown
+def test_started_write_is_not_replaced(monkeypatch):
+    started, release = threading.Event(), threading.Event()
+
+    def query_database(query_type, **kwargs):
+        started.set()
+        release.wait(5)
+        return (True, [], "Update was Successful", None)
+
+    monkeypatch.setattr(gui_interface, "query_database", query_database)
+    window = _Window()
+    runner = gui_interface.QueryRunner(window)
+    assert runner.submit("-UQ-", "update")
+    started.wait(5)
+    query_id = runner.running["-UQ-"][0]
+    assert runner.cancel("-UQ-") == "applying"
+    assert not runner.submit("-UQ-", "update")
+    release.set()
+    runner.executor.shutdown(wait=True)
+    assert window.events == [("-UQ-DONE-", (query_id, (True, [], "Update was Successful", None)))]
+    assert runner.finish("-UQ-", query_id)
+    assert "-UQ-" not in runner.running
@@ -0,0 +1,71 @@
+import datetime
+import json
+import sqlite3
+
+from database import PatientData
+from ingestion_service import Ingestor
+
+
+def _reading(i, **fields):
+    return dict({'first_name': 'Stream', 'last_name': 'Patient', 'loinc_num': '76477-9', 'value': 60 + i,
+                 'unit': 'BPM', 'valid_start_time': f'2024-01-01 10:{i:02d}:00'}, **fields)
+
+
+# A reading sent again gets a new transaction time, it is still a retransmission
+def test_retransmission_is_dropped(patient_data):
+    ingestor = Ingestor(patient_data, flush_interval=0.01)
+    ingestor.submit(_reading(1))
+    ingestor.flush()
+    ingestor.submit(_reading(1))
+    ingestor.submit(_reading(1, value=99))
+    ingestor.close()
+    assert ingestor.stats()['written'] == 2
+    assert ingestor.stats()['duplicates'] == 1
+
+    # Also after a restart, from the rows recorded in the dedup window
+    ingestor = Ingestor(patient_data, flush_interval=0.01)
+    ingestor.submit(_reading(1))
+    ingestor.close()
+    assert ingestor.stats()['duplicates'] == 1
+
+
+class _RejectingPatientData(PatientData):
+    # Fails every batch with a reading of value 'bad', like a row the database does not take
+    def __init__(self, pool, transient_failures=0):
+        super().__init__(pool=pool)
+        self.transient_failures = transient_failures
+
+    def add_test_results(self, records, skip_existing=True):
+        if self.transient_failures:
+            self.transient_failures -= 1
+            raise sqlite3.OperationalError("database is locked")
+        if any(record[3] == 'bad' for record in records):
+            raise sqlite3.IntegrityError("bad reading")
+        return super().add_test_results(records, skip_existing)
+
+
+# A bad reading goes to the dead letters, the rest of its batch is written
+def test_bad_reading_is_dead_lettered(patient_data, tmp_path):
+    dead_letter_file = str(tmp_path / 'dead_letters.jsonl')
+    ingestor = Ingestor(_RejectingPatientData(patient_data.pool, transient_failures=2), batch_size=100,
+                        flush_interval=0.05, dedup_window=None, retry_seconds=0.01, dead_letter_file=dead_letter_file)
+    for i in range(20):
+        ingestor.submit(_reading(i, value='bad' if i == 7 else 60 + i))
+    ingestor.close()
+
+    assert ingestor.stats()['written'] == 19
+    assert ingestor.stats()['dead_letters'] == 1
+    with open(dead_letter_file) as f:
+        dead_letters = [json.loads(line) for line in f]
+    assert [(letter['value'], letter['error']) for letter in dead_letters] == [('bad', 'bad reading')]
+    assert patient_data.pool.execute("SELECT COUNT(*) FROM test_results")[0][0] == 19
+
+
+# A batch that keeps failing with a transient error is dead lettered after max_attempts
+def test_transient_errors_are_retried_max_attempts(patient_data):
+    ingestor = Ingestor(_RejectingPatientData(patient_data.pool, transient_failures=10), flush_interval=0.05,
+                        dedup_window=None, retry_seconds=0.001, max_attempts=3)
+    ingestor.submit(_reading(1, transaction_time=datetime.datetime(2024, 1, 2)))
+    ingestor.close()
+    assert ingestor.stats()['failed_batches'] == 3
+    assert ingestor.stats()['dead_letters'] == 1
@@ -0,0 +1,55 @@
+from benchmark import generate_test_results, write_csv
+from insert_csv_file import ingest_csv, read_checkpoint
+from tests.conftest import PROJECT_CSV
+
+
+def _count(patient_data):
+    return patient_data.pool.execute("SELECT COUNT(*) FROM test_results")[0][0]
+
+
+# Loading the same file again writes nothing, a different file is not mistaken for it
+def test_ingest_again_and_another_csv(patient_data, tmp_path):
+    rows = ingest_csv(patient_data, PROJECT_CSV)
+    assert rows == _count(patient_data) == 256
+    assert ingest_csv(patient_data, PROJECT_CSV) == 0
+    assert _count(patient_data) == 256
+
+    csv_file = str(tmp_path / 'synthetic.csv')
+    write_csv(generate_test_results(3, 4, 2, measurements=5), csv_file)
+    assert ingest_csv(patient_data, csv_file) == 3 * 4 * 2 * 5
+    assert _count(patient_data) == 256 + 120
+    assert ingest_csv(patient_data, csv_file) == 0
+
+
+# The database gives the ids: CSV rows and single writes never take the same one
+def test_ids_are_generated(patient_data):
+    ingest_csv(patient_data, PROJECT_CSV)
+    patient_data.add_test_results([('Eyal', 'Rothman', '11218-5', '4000', 'cells/ml',
+                                    '2018-05-17 13:11:00', '2018-06-01 10:00:00')], skip_existing=False)
+    ids = [row[0] for row in patient_data.query_test_result_rows()]
+    assert len(ids) == len(set(ids)) == 257
+
+
+# A batch that is partly in the table already writes only its new records, once each,
+# and the write listeners get only those
+def test_batch_skips_existing_records(patient_data):
+    old = ('Eli', 'Call', '11218-5', '5500', 'cells/ml', '2018-05-18 15:00:00', '2018-05-21 10:00:00')
+    new = ('Eli', 'Call', '11218-5', '5600', 'cells/ml', '2018-05-18 15:00:00', '2018-05-22 10:00:00')
+    assert patient_data.add_test_results([old]) == 1
+    written = []
+    patient_data.on_write(written.extend)
+    assert patient_data.add_test_results([old, new, new]) == 1
+    assert written == [new]
+    assert _count(patient_data) == 2
+
+
+# A checkpoint is only resumed for the file it was written for
+def test_checkpoint_of_another_file_is_not_resumed(patient_data, tmp_path):
+    checkpoint = str(tmp_path / 'checkpoint.json')
+    ingest_csv(patient_data, PROJECT_CSV, batch_size=100, checkpoint_file=checkpoint)
+    assert read_checkpoint(checkpoint, PROJECT_CSV) == 256
+
+    csv_file = str(tmp_path / 'synthetic.csv')
+    write_csv(generate_test_results(3, 4, 2, measurements=5), csv_file)
+    assert read_checkpoint(checkpoint, csv_file) == 0
+    assert ingest_csv(patient_data, csv_file, checkpoint_file=checkpoint) == 120
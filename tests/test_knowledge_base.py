@@ -0,0 +1,41 @@
+import numpy as np
+
+from knowlege_base import RangeTable
+
+
+# Fever grades of the knowledge base: '0-38.5' I, '38.5-40.0' II, '40.0+' III, '40.0' IV
+def test_fever_grade_boundaries(knowlege_base):
+    kb = knowlege_base.snapshot()
+    assert kb.toxicity_grade('Fever', 37.0) == 'Grade I'
+    assert kb.toxicity_grade('Fever', 38.5) == 'Grade II'
+    assert kb.toxicity_grade('Fever', 39.9) == 'Grade II'
+    assert kb.toxicity_grade('Fever', 40.0) == 'Grade IV'
+    assert kb.toxicity_grade('Fever', 41.0) == 'Grade III'
+    assert list(kb.toxicity_grade('Fever', [38.4, 40.0, 41.0, np.nan])) == ['Grade I', 'Grade IV', 'Grade III', None]
+
+
+def test_hemoglobin_state_boundaries(knowlege_base):
+    kb = knowlege_base.snapshot()
+    assert kb.hemoglobin_state('male', 7.9) == 'Severe Anemia'
+    assert kb.hemoglobin_state('male', 8.0) == 'Moderate Anemia'
+    assert kb.hemoglobin_state('male', 14.0) == 'Polycytemia'
+    assert kb.hemoglobin_state('female', 15.9) == 'Normal Hemoglobin'
+
+
+# Values past the high bound of every range are in no range, the order of overlapping ranges is kept
+def test_range_table_highs_and_order():
+    table = RangeTable([((0, 10), 'low'), ((5, 5), 'five'), ((10, 20), 'high')])
+    assert list(table.classify([-1, 0, 5, 9.9, 10, 20, 25])) == [None, 'low', 'five', 'low', 'high', None, None]
+    assert table.classify(5.0) == 'five'
+
+
+# The binary search gives every value the label of the last range (in order) that holds it
+def test_range_table_matches_the_ranges():
+    ranges = [((0, 10), 'a'), ((5, 5), 'b'), ((3, 7), 'c'), ((7, 7), 'd'), ((10, None), 'e'), ((2, 4), 'f')]
+    table = RangeTable(ranges)
+    values = np.r_[np.arange(-2, 15, 0.5), [np.nan]]
+    expected = [next((label for (low, high), label in reversed(ranges)
+                      if low <= value < (np.inf if high is None else high) or low == high == value), None)
+                for value in values]
+    assert list(table.classify(values)) == expected
+    assert RangeTable([]).classify(1.0) is None
@@ -0,0 +1,56 @@
+import pandas as pd
+import pytest
+
+from database import BUCKET_COLUMNS, records_frame
+
+PATIENT = ('David', 'Mizrahi', '76477-9')
+
+
+def _pages(fetch, page_size):
+    pages, after = [], None
+    while True:
+        page, after = fetch(after, page_size)
+        pages.append(page)
+        if after is None:
+            return pages
+
+
+# Pages of any size put together are the whole result in (valid time, id) order, versions at one valid time included
+@pytest.mark.parametrize('page_size', [1, 7, 1000])
+def test_pages_are_the_whole_result(engine, page_size):
+    db = engine.db
+    latest = set(db.query_test_results(latest_only=True))
+    for latest_only in (False, True):
+        expected = [row[1:] for row in sorted(db.query_test_result_rows(), key=lambda row: (row[6], row[0]))
+                    if not latest_only or row[1:] in latest]
+        pages = _pages(lambda after, size: db.query_test_results_page(latest_only=latest_only, after=after,
+                                                                      page_size=size), page_size)
+        assert all(0 < len(page) <= page_size for page in pages[:-1])
+        assert [row for page in pages for row in page] == expected
+
+
+# Buckets are the count, min, mean and max of the latest versions per hour or day, paged by bucket start
+@pytest.mark.parametrize('bucket, frequency', [('hour', 'h'), ('day', 'D')])
+def test_buckets_match_pandas(engine, bucket, frequency):
+    rows = records_frame(engine.db.query_test_results(*PATIENT, latest_only=True))
+    rows['value'] = pd.to_numeric(rows['value'])
+    expected = rows.groupby(rows['valid_start_time'].dt.floor(frequency))['value'].agg(
+        ['size', 'min', 'mean', 'max']).reset_index()
+
+    pages = _pages(lambda after, size: engine.db.query_test_result_buckets(*PATIENT, bucket=bucket, after=after,
+                                                                            page_size=size), 3)
+    buckets = pd.DataFrame([row for page in pages for row in page], columns=BUCKET_COLUMNS)
+    assert pd.to_datetime(buckets['bucket_start']).tolist() == expected['valid_start_time'].tolist()
+    assert buckets['measurements'].tolist() == expected['size'].tolist()
+    for column, aggregate in (('min_value', 'min'), ('mean_value', 'mean'), ('max_value', 'max')):
+        assert buckets[column].astype(float).tolist() == pytest.approx(expected[aggregate].tolist())
+
+
+# The engine history pages are the history of the query, a page at a time
+def test_retrieval_history_pages(engine):
+    query = PATIENT + ('2018-05-01', '00:00:00', '2018-06-30', '00:00:00')
+    pages = list(engine.retrieval_history_pages(query, page_size=4))
+    assert len(pages) > 1
+    history = pd.concat(pages, ignore_index=True)
+    expected = records_frame(engine.db.query_test_results(*PATIENT))
+    assert sorted(history.itertuples(index=False, name=None)) == sorted(expected.itertuples(index=False, name=None))
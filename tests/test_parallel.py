@@ -0,0 +1,48 @@
+import pandas as pd
+import pytest
+
+from database import records_frame
+from parallel import ShardedExecutor, pack, shard, unpack
+from patient_state import PATIENT_STATE_LOINCS, SEX_LOINC, latest_results_states
+from temporal_abstraction import abstract_intervals
+
+
+@pytest.fixture
+def executor():
+    executor = ShardedExecutor(processes=2, shards_per_process=3, min_rows=0)
+    yield executor
+    executor.close()
+
+
+# Shards hold whole patients and put together in order are the rows sorted by patient
+def test_shards_hold_whole_patients(engine):
+    rows = records_frame(engine.db.query_test_results())
+    parts = shard(rows, 4)
+    assert len(parts) > 1
+    patients = [set(zip(part['first_name'], part['last_name'])) for part in parts]
+    assert sum(len(part) for part in patients) == len(set().union(*patients))
+    pd.testing.assert_frame_equal(pd.concat(parts), rows.sort_values(['first_name', 'last_name'], kind='stable'))
+    pd.testing.assert_frame_equal(unpack(pack(rows)), rows, check_dtype=False)
+
+
+# Intervals abstracted in shards on the pool are the serial intervals
+def test_sharded_intervals_are_the_serial_ones(engine, executor):
+    rows = records_frame(engine.db.query_test_results(latest_only=True))
+    for sex in ('male', 'female'):
+        pd.testing.assert_frame_equal(executor.abstract_intervals(rows, sex), abstract_intervals(rows, sex),
+                                      check_dtype=False)
+    pd.testing.assert_frame_equal(engine.db.time_interval_tables(executor=executor), engine.db.time_interval_tables(),
+                                  check_dtype=False)
+    assert executor.abstract_intervals(rows.iloc[:0]).empty
+    assert executor.pool is not None
+
+
+# Patient states evaluated in shards on the pool are the serial states, in the same order
+def test_sharded_patient_states_are_the_serial_ones(engine, executor):
+    loinc_nums = list(PATIENT_STATE_LOINCS.values()) + [SEX_LOINC]
+    latest = records_frame(engine.db.query_latest_results(loinc_nums, pd.Timestamp('2018-06-30')))
+    kb = engine.kb.snapshot()
+    states = latest_results_states(kb, latest)
+    assert len(states) > 1
+    assert executor.patient_states(kb, latest) == states
+    assert executor.patient_states(kb, latest, sex='female') == latest_results_states(kb, latest, sex='female')
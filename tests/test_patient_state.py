@@ -0,0 +1,53 @@
+from database import PatientData
+from patient_state import SEX_LOINC
+
+NOW = ('2030-01-01', '00:00:00')
+
+
+def _recommendations(states, patient_name):
+    return next(state['recommendations'] for state in states if state['patient_name'] == patient_name)
+
+
+# A new recommendation of the knowledge base reaches the states of the patients it is for,
+# also when none of their results changed
+def test_knowledge_base_change_updates_recommendations(engine, knowlege_base):
+    assert _recommendations(engine.patients_states_and_recommendations(NOW), 'Eli Call') == []
+    assert _recommendations(engine.states.current_states(), 'Eli Call') == []
+
+    knowlege_base.pool.execute(
+        "INSERT INTO treatment_recommendations "
+        "(id, gender, hemoglobin_state, hematological_state, systemic_toxicity, recommendation) "
+        "VALUES (%s, %s, %s, %s, %s, %s)", (100, 'male', 'Moderate Anemia', 'Anemia', 'GRADE I', 'Check again'))
+    knowlege_base._changed()
+
+    assert _recommendations(engine.patients_states_and_recommendations(NOW), 'Eli Call') == ['Check again']
+    assert _recommendations(engine.states.current_states(), 'Eli Call') == ['Check again']
+
+
+def _state(states, patient_name):
+    return next(state for state in states if state['patient_name'] == patient_name)
+
+
+# Results written by another PatientData (another process) are in the "now" states
+def test_current_states_see_other_writers(engine):
+    assert _state(engine.states.current_states(), 'Eli Call')['hemoglobin_state'] == 'Moderate Anemia'
+    other = PatientData(pool=engine.db.pool)
+    other.add_test_results([('Eli', 'Call', '12181-4', '7.5', 'mg/dl', '2018-05-22 08:00:00', '2018-05-22 10:00:00')])
+    assert _state(engine.states.current_states(), 'Eli Call')['hemoglobin_state'] == 'Severe Anemia'
+
+
+# Every patient is classified by the ranges of its own sex, now and as of a past time
+def test_states_use_the_sex_of_each_patient(engine):
+    engine.db.add_test_results([
+        ('Eli', 'Call', '12181-4', '8.5', 'mg/dl', '2018-05-22 08:00:00', '2018-05-22 10:00:00'),
+        ('Eli', 'Call', SEX_LOINC, 'female', 'none', '2018-05-01 00:00:00', '2018-05-22 10:00:00'),
+    ])
+    now = engine.patients_states_and_recommendations(NOW)
+    past = engine.patients_states_and_recommendations(('2018-05-23', '00:00:00'))
+    assert _state(now, 'Eli Call')['hemoglobin_state'] == 'Severe Anemia'
+    assert _state(past, 'Eli Call')['hemoglobin_state'] == 'Severe Anemia'
+    # Patients without a sex result are male, an explicit sex is used for everyone
+    assert _state(now, 'Eyal Rothman')['hemoglobin_state'] == _state(past, 'Eyal Rothman')['hemoglobin_state']
+    everyone_male = engine.patients_states_and_recommendations(NOW, sex='male')
+    assert _state(everyone_male, 'Eli Call')['hemoglobin_state'] == 'Moderate Anemia'
+    assert [state['patient_name'] for state in now] == [state['patient_name'] for state in everyone_male]
@@ -0,0 +1,21 @@
+from insert_csv_file import ingest_csv
+from pick_lists import PickLists
+from tests.conftest import PROJECT_CSV
+
+
+# The first refresh reads every patient and LOINC, later ones only the rows added since, from any writer
+def test_refresh_reads_new_rows_by_id(patient_data, tmp_path):
+    ingest_csv(patient_data, PROJECT_CSV)
+    pick_lists = PickLists(str(tmp_path / 'pick_lists.json'))
+    pick_lists.refresh(patient_data)
+    assert 'Eli Call' in pick_lists.patients and '11218-5' in pick_lists.loinc_numbers
+    assert pick_lists.last_id == patient_data.get_max_test_result_id()
+
+    # Recorded with an old transaction time, e.g. by a writer whose clock is behind
+    patient_data.add_test_results([('New', 'Patient', 'new-loinc', '1', 'none', '2000-01-01 00:00:00',
+                                    '2000-01-01 00:00:00')])
+    saved = PickLists(str(tmp_path / 'pick_lists.json'))
+    assert saved.patients == pick_lists.patients and saved.last_id == pick_lists.last_id
+    saved.refresh(patient_data)
+    assert 'New Patient' in saved.patients and 'new-loinc' in saved.loinc_numbers
+    assert sorted(saved.patients) == sorted({f"{first} {last}" for first, last in patient_data.get_all_patients()})
@@ -0,0 +1,42 @@
+import pandas as pd
+
+from result_cache import ResultCache
+
+QUERY = ('Eli', 'Call', '11218-5', '2018-05-18', '15:00:00', '2030-01-01', '00:00:00')
+UPDATE = ('Eli', 'Call', '11218-5', '2018-05-18', '15:00:00', '2018-05-21', '10:00:00')
+
+
+# A write evicts the entries of its patient LOINC that could see it, not the ones asked before it
+def test_invalidate_by_tag_and_cutoff():
+    cache = ResultCache()
+    cache.put('now', 1, {(('Eli', 'Call'), '11218-5')})
+    cache.put('past', 2, {(('Eli', 'Call'), '11218-5')}, cutoff=pd.Timestamp('2018-05-20'), permanent=True)
+    cache.put('other', 3, {(('Eyal', 'Rothman'), '11218-5')})
+    cache.put('everyone', 4, {('*', '11218-5')}, cutoff=pd.Timestamp('2030-01-01'))
+    cache.invalidate(('Eli', 'Call'), '11218-5', '2018-05-25')
+    assert [cache.get(key)[0] for key in ('now', 'past', 'other', 'everyone')] == [False, True, True, False]
+
+
+# The least recently used entry goes first, a result computed while a write came in is not kept
+def test_lru_and_generation():
+    cache = ResultCache(max_entries=2)
+    cache.put('a', 1, set())
+    cache.put('b', 2, set())
+    assert cache.get('a') == (True, 1)
+    cache.put('c', 3, set())
+    assert cache.get('b') == (False, None) and cache.get('a') == (True, 1)
+    generation = cache.generation
+    cache.invalidate(('Eli', 'Call'), '11218-5', '2018-05-25')
+    cache.put('d', 4, set(), generation=generation)
+    assert cache.get('d') == (False, None)
+
+
+# A correction through the engine is seen by the next query, a cached result is the caller's own copy
+def test_engine_cache_sees_corrections(engine):
+    first = engine.retrieval_question(QUERY)
+    assert first['value'].tolist() == ['5500']
+    first.loc[:, 'value'] = 'changed'
+    assert engine.retrieval_question(QUERY)['value'].tolist() == ['5500']
+    assert engine.cache.hits >= 1
+    engine.update_record('6000', UPDATE)
+    assert engine.retrieval_question(QUERY)['value'].tolist() == ['6000']
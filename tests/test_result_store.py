@@ -0,0 +1,49 @@
+import pandas as pd
+
+from bitemporal_index import DELETED_VALUE
+
+from database import PatientData
+from insert_csv_file import ingest_csv
+from result_store import ResultStore
+from tests.conftest import PROJECT_CSV
+
+LOINCS = ['11218-5', '12181-4', '39106-0', 'chills']
+NOW = pd.Timestamp('2030-01-01')
+
+
+def _normalized(rows):
+    return [tuple(row[:5]) + (pd.Timestamp(row[5]), pd.Timestamp(row[6])) for row in rows]
+
+
+# Writes of the PatientData and of other writers are in the store, each row once
+def test_store_follows_the_writes(patient_data):
+    ingest_csv(patient_data, PROJECT_CSV)
+    store = ResultStore.load(patient_data)
+    assert store.size == 256
+    patient_data.add_test_results([('Eli', 'Call', '11218-5', '9000', 'cells/ml',
+                                    '2018-05-30 08:00:00', '2018-05-30 09:00:00')])
+    assert store.size == 257
+    PatientData(pool=patient_data.pool).add_test_results([('Eyal', 'Rothman', '11218-5', '100', 'cells/ml',
+                                                            '2010-01-01 08:00:00', '2010-01-01 09:00:00')])
+    assert store.refresh() == 1 and store.refresh() == 0
+    assert store.size == 258
+    assert _normalized(store.query_latest_results(LOINCS, NOW)) == \
+        _normalized(patient_data.query_latest_results(LOINCS, NOW))
+
+
+# Values are answered as they were written, corrections and deletes like the database
+def test_store_answers_like_the_database(patient_data):
+    ingest_csv(patient_data, PROJECT_CSV)
+    patient_data.add_test_results([
+        ('Eli', 'Call', '39106-0', '38.50', 'C', '2018-05-30 08:00:00', '2018-05-30 09:00:00'),
+        ('Eli', 'Call', '11218-5', DELETED_VALUE, 'cells/ml', '2018-05-18 15:00:00', '2018-05-25 10:00:00'),
+    ])
+    store = ResultStore.load(patient_data)
+    assert store.query_test_results('Eli', 'Call', '39106-0', latest_only=True)[-1][3] == '38.50'
+    for as_of in (pd.Timestamp('2018-05-21 10:00:00'), NOW):
+        assert _normalized(store.query_latest_results(LOINCS, as_of)) == \
+            _normalized(patient_data.query_latest_results(LOINCS, as_of))
+        assert _normalized(store.query_test_results('Eli', 'Call', LOINCS, as_of=as_of, latest_only=True)) == \
+            _normalized(patient_data.query_test_results('Eli', 'Call', LOINCS, as_of=as_of, latest_only=True))
+    assert _normalized(store.query_test_results('Eyal', 'Rothman')) == \
+        _normalized(patient_data.query_test_results('Eyal', 'Rothman'))
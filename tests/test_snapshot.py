@@ -0,0 +1,52 @@
+import pandas as pd
+
+from insert_csv_file import ingest_csv
+from snapshot import TestResultsSnapshot as Snapshot, write_snapshot
+from tests.conftest import PROJECT_CSV
+
+LOINCS = ['11218-5', '12181-4', '39106-0', 'chills']
+NOW = pd.Timestamp('2030-01-01')
+
+
+def _snapshot(patient_data, tmp_path):
+    ingest_csv(patient_data, PROJECT_CSV)
+    write_snapshot(patient_data, str(tmp_path / 'snapshot'))
+    return Snapshot(str(tmp_path / 'snapshot'), patient_data)
+
+
+def _normalized(rows):
+    return [tuple(row[:5]) + (pd.Timestamp(row[5]), pd.Timestamp(row[6])) for row in rows]
+
+
+# The snapshot answers like PatientData, as of any time
+def test_snapshot_answers_like_the_database(patient_data, tmp_path):
+    snapshot = _snapshot(patient_data, tmp_path)
+    for as_of in (pd.Timestamp('2018-05-21 10:00:00'), pd.Timestamp('2018-05-25'), NOW):
+        assert _normalized(snapshot.query_latest_results(LOINCS, as_of)) == \
+            _normalized(patient_data.query_latest_results(LOINCS, as_of))
+    assert _normalized(snapshot.query_test_results('Eli', 'Call', '11218-5')) == \
+        _normalized(patient_data.query_test_results('Eli', 'Call', '11218-5'))
+
+
+# Rows written after the snapshot are in the delta, also a backfill with an old transaction time
+def test_delta_reads_new_ids(patient_data, tmp_path):
+    snapshot = _snapshot(patient_data, tmp_path)
+    patient_data.add_test_results([
+        ('Eli', 'Call', '11218-5', '9000', 'cells/ml', '2018-05-30 08:00:00', '2018-05-30 09:00:00'),
+        ('Eyal', 'Rothman', '11218-5', '100', 'cells/ml', '2010-01-01 08:00:00', '2010-01-01 09:00:00'),
+    ])
+    assert snapshot.apply_delta() == 2
+    assert snapshot.apply_delta() == 0
+    assert _normalized(snapshot.query_test_results('Eyal', 'Rothman', '11218-5')) == \
+        _normalized(patient_data.query_test_results('Eyal', 'Rothman', '11218-5'))
+    assert _normalized(snapshot.query_latest_results(LOINCS, NOW)) == \
+        _normalized(patient_data.query_latest_results(LOINCS, NOW))
+
+
+# A snapshot read without its database has no delta, the engine still answers from it
+def test_snapshot_without_database(engine, tmp_path):
+    write_snapshot(engine.db, str(tmp_path / 'snapshot'))
+    snapshot = Snapshot(str(tmp_path / 'snapshot'))
+    assert snapshot.apply_delta() == 0
+    engine.snapshot = snapshot
+    assert engine.patients_states_and_recommendations(('2018-05-25', '00:00:00'))
@@ -0,0 +1,67 @@
+import sqlite3
+
+import pytest
+
+import storage
+from database import PatientData
+from storage import open_storage
+
+OLD_SCHEMA = """
+CREATE TABLE test_results (
+    id INT PRIMARY KEY,
+    first_name VARCHAR(255) NOT NULL,
+    last_name VARCHAR(255) NOT NULL,
+    loinc_num VARCHAR(255) NOT NULL,
+    value VARCHAR(255) NOT NULL,
+    unit VARCHAR(255) NOT NULL,
+    valid_start_time DATETIME NOT NULL,
+    transaction_time DATETIME NOT NULL
+);
+CREATE INDEX idx_test_results_bitemporal
+    ON test_results (first_name, last_name, loinc_num, valid_start_time, transaction_time);
+INSERT INTO test_results VALUES (7, 'Eli', 'Call', '11218-5', '5000', 'cells/ml', '2018-05-18 15:00:00', '2018-05-20 10:00:00');
+INSERT INTO test_results VALUES (9, 'Eli', 'Call', '11218-5', '5500', 'cells/ml', '2018-05-18 15:00:00', '2018-05-21 10:00:00');
+"""
+RECORD = ('Eli', 'Call', '11218-5', '6000', 'cells/ml', '2018-05-19 15:00:00', '2018-05-22 10:00:00')
+
+
+@pytest.fixture
+def old_database(tmp_path):
+    path = str(tmp_path / 'old.db')
+    connection = sqlite3.connect(path)
+    connection.executescript(OLD_SCHEMA)
+    connection.close()
+    return path
+
+
+def _schema(path):
+    connection = sqlite3.connect(path)
+    try:
+        return connection.execute("SELECT type, name, sql FROM sqlite_master ORDER BY name").fetchall()
+    finally:
+        connection.close()
+
+
+# An old test_results gets the auto increment id and the indexes, rows keep their ids
+def test_sqlite_ids_migration(old_database):
+    pool = open_storage('sqlite', old_database)
+    try:
+        patient_data = PatientData(pool=pool)
+        assert [row[0] for row in patient_data.query_test_result_rows()] == [7, 9]
+        patient_data.add_test_results([RECORD])
+        assert patient_data.query_test_result_rows(after_id=9) == [(10,) + RECORD]
+        schema = pool.execute("SELECT name, sql FROM sqlite_master WHERE tbl_name LIKE 'test_results%'")
+        assert 'AUTOINCREMENT' in dict(schema)['test_results'].upper()
+        assert {'idx_test_results_bitemporal', 'idx_test_results_patient_id'} <= dict(schema).keys()
+        assert 'test_results_old' not in dict(schema)
+    finally:
+        pool.close()
+
+
+# A migration failing half way leaves the old table as it was
+def test_failed_sqlite_migration_is_rolled_back(old_database, monkeypatch):
+    schema = _schema(old_database)
+    monkeypatch.setattr(storage, 'TEST_RESULT_COLUMNS', storage.TEST_RESULT_COLUMNS + ', missing_column')
+    with pytest.raises(sqlite3.OperationalError):
+        open_storage('sqlite', old_database)
+    assert _schema(old_database) == schema
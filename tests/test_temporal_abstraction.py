@@ -0,0 +1,71 @@
+import pandas as pd
+
+from database import records_frame
+from temporal_abstraction import INTERVAL_COLUMNS, abstract_intervals, abstract_states, build_intervals, latest_versions
+
+DAY = pd.Timestamp('2018-05-10')
+
+
+def _at(days):
+    return DAY + pd.Timedelta(days=days)
+
+
+# Lower bounds are inclusive, the ranges follow the sex, values without ranges or numbers get no state
+def test_abstract_states():
+    measurements = records_frame([
+        ('Eli', 'Call', '11218-5', '3999', 'cells/ml', _at(0), _at(0)),
+        ('Eli', 'Call', '11218-5', '4000', 'cells/ml', _at(1), _at(1)),
+        ('Eli', 'Call', '11218-5', '10000', 'cells/ml', _at(2), _at(2)),
+        ('Eli', 'Call', '11218-5', 'n/a', 'cells/ml', _at(3), _at(3)),
+        ('Eli', 'Call', '30313-1', '12.5', 'g/dl', _at(0), _at(0)),
+        ('Ann', 'Lee', '30313-1', '12.5', 'g/dl', _at(0), _at(0)),
+        ('Eli', 'Call', 'other', '1', 'none', _at(0), _at(0)),
+    ])
+    measurements['sex'] = ['male'] * 5 + ['female', 'male']
+    states = [state if isinstance(state, str) else None for state in abstract_states(measurements)['state']]
+    assert states == ['wbc_low', 'wbc_medium', 'wbc_high', None, 'Normal Hemoglobin', 'Mild Anemia', None]
+    assert abstract_states(measurements.drop(columns='sex'), sex='female')['state'].tolist()[4] == 'Mild Anemia'
+
+
+# Measurements of one state closer than the persistence are one interval, extended by it on both sides
+def test_build_intervals():
+    states = pd.DataFrame([
+        ('Eli', 'Call', '11218-5', _at(0), 'wbc_low'),
+        ('Eli', 'Call', '11218-5', _at(1), 'wbc_low'),
+        ('Eli', 'Call', '11218-5', _at(3), 'wbc_low'),
+        ('Eli', 'Call', '11218-5', _at(4), 'wbc_high'),
+        ('Eli', 'Call', '11218-5', _at(5), None),
+        ('Ann', 'Lee', '11218-5', _at(0), 'wbc_low'),
+    ], columns=['first_name', 'last_name', 'loinc_num', 'valid_start_time', 'state'])
+    intervals = build_intervals(states, persistence={'11218-5': pd.Timedelta(days=2)})
+    assert list(intervals.columns) == INTERVAL_COLUMNS
+    assert [tuple(row) for row in intervals.itertuples(index=False, name=None)] == [
+        ('Ann', 'Lee', '11218-5', 'wbc_low', _at(-2), _at(2), 1),
+        ('Eli', 'Call', '11218-5', 'wbc_low', _at(-2), _at(3), 2),
+        ('Eli', 'Call', '11218-5', 'wbc_low', _at(1), _at(5), 1),
+        ('Eli', 'Call', '11218-5', 'wbc_high', _at(2), _at(6), 1),
+    ]
+    assert build_intervals(states.iloc[4:5]).empty
+
+
+# Only the latest version of a measurement is abstracted
+def test_abstract_intervals_of_latest_versions():
+    measurements = records_frame([
+        ('Eli', 'Call', '11218-5', '11000', 'cells/ml', _at(0), _at(0)),
+        ('Eli', 'Call', '11218-5', '5000', 'cells/ml', _at(0), _at(1)),
+        ('Eli', 'Call', '11218-5', '5500', 'cells/ml', _at(1), _at(1)),
+    ])
+    assert len(latest_versions(measurements)) == 2
+    intervals = abstract_intervals(measurements)
+    assert intervals[['state', 'start_time', 'end_time', 'measurements']].values.tolist() == [
+        ['wbc_medium', _at(-2), _at(3), 2]]
+
+
+# The population intervals of the database are the intervals of every patient abstracted alone
+def test_time_interval_tables_per_patient(engine):
+    intervals = engine.db.time_interval_tables()
+    rows = records_frame(engine.db.query_test_results(latest_only=True))
+    expected = pd.concat([abstract_intervals(patient_rows) for _, patient_rows in
+                          rows.groupby(['first_name', 'last_name'])], ignore_index=True)
+    assert len(intervals)
+    pd.testing.assert_frame_equal(intervals, expected, check_dtype=False)
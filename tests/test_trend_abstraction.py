@@ -0,0 +1,82 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from bitemporal_index import DELETED_VALUE
+from database import records_frame
+from trend_abstraction import TREND_SETTINGS, SlidingWindow, TrendAbstraction
+
+HOUR = datetime.timedelta(hours=1)
+START = pd.Timestamp('2018-05-17 08:00:00')
+PATIENT = ('Eli', 'Call')
+SETTINGS = {'76477-9': (2 * HOUR, 5.0)}
+
+
+# The window keeps the readings of (time - window, time], its statistics are the ones of those readings
+def test_sliding_window_matches_numpy():
+    window = SlidingWindow(3 * HOUR)
+    rng = np.random.default_rng(1)
+    times = START + pd.to_timedelta(np.cumsum(rng.integers(10, 90, 60)), unit='min')
+    values = rng.normal(80, 10, 60)
+    for i, (time, value) in enumerate(zip(times, values)):
+        window.add(time, value)
+        inside = (times[:i + 1] > time - 3 * HOUR)
+        hours = (times[:i + 1][inside] - START) / HOUR
+        assert len(window.readings) == inside.sum()
+        assert (window.minimum, window.maximum) == (values[:i + 1][inside].min(), values[:i + 1][inside].max())
+        assert window.mean == pytest.approx(values[:i + 1][inside].mean())
+        if inside.sum() > 1:
+            assert window.slope == pytest.approx(np.polyfit(hours, values[:i + 1][inside], 1)[0])
+        else:
+            assert window.slope is None
+
+
+# Readings of the same trend in a row are one interval, a reading alone in its window has no trend
+def test_trend_intervals():
+    trends = TrendAbstraction(SETTINGS)
+    for minutes, value in [(0, 60), (30, 70), (60, 80), (90, 81), (120, 79), (150, 80), (180, 80), (400, 90)]:
+        trends.add(PATIENT, '76477-9', START + pd.Timedelta(minutes=minutes), str(value))
+    assert trends.add(PATIENT, 'other', START, '1') is None
+    assert trends.add(PATIENT, '76477-9', START, 'n/a') is None
+    intervals = trends.interval_table()[['state', 'start_time', 'end_time', 'measurements']].values.tolist()
+    assert intervals == [['increasing', START + pd.Timedelta(minutes=30), START + pd.Timedelta(minutes=120), 4],
+                         ['stable', START + pd.Timedelta(minutes=150), START + pd.Timedelta(minutes=180), 2]]
+    assert trends.current(PATIENT, '76477-9')[6] is None
+    assert trends.dictinary_of_time_interval(PATIENT, '76477-9', 'stable') == {
+        'interval_1': [START + pd.Timedelta(minutes=150), START + pd.Timedelta(minutes=180)]}
+
+
+# Readings out of order, corrections and deletes give the abstraction of the resulting readings
+def test_late_readings_corrections_and_deletes_replay():
+    records = [PATIENT + ('76477-9', str(value), 'BPM', START + pd.Timedelta(minutes=minutes), START)
+               for minutes, value in [(0, 60), (30, 70), (60, 80), (90, 75), (120, 70)]]
+    streamed = TrendAbstraction(SETTINGS)
+    streamed.apply([records[i] for i in (0, 2, 4, 1)])
+    streamed.apply([records[3][:3] + ('90',) + records[3][4:], records[3], records[2][:3] + (DELETED_VALUE,) + records[2][4:]])
+
+    expected = TrendAbstraction(SETTINGS)
+    expected.apply([record for i, record in enumerate(records) if i != 2])
+    pd.testing.assert_frame_equal(streamed.rolling_table(), expected.rolling_table())
+    pd.testing.assert_frame_equal(streamed.interval_table(), expected.interval_table())
+
+
+# The trends of the database are the trends of its latest versions, streamed in valid time order
+def test_from_records_and_write_listener(engine):
+    rows = engine.db.query_test_results(loinc_num=list(TREND_SETTINGS), latest_only=True)
+    streamed = TrendAbstraction()
+    streamed.apply(sorted(rows, key=lambda row: row[5]))
+    from_records = TrendAbstraction.from_records(records_frame(engine.db.query_test_results()))
+    assert len(streamed.interval_table())
+    pd.testing.assert_frame_equal(from_records.rolling_table(), streamed.rolling_table())
+    pd.testing.assert_frame_equal(engine.db.trend_interval_tables(), streamed.interval_table(), check_dtype=False)
+
+    engine.db.on_write(streamed.apply)
+    first_name, last_name, loinc_num, value, unit, valid_start_time, _ = rows[0]
+    engine.db.add_test_results([(first_name, last_name, loinc_num, DELETED_VALUE, unit, valid_start_time,
+                                 '2018-06-30 00:00:00')])
+    rolling = streamed.rolling_table()
+    rolling = rolling[(rolling['first_name'] == first_name) & (rolling['last_name'] == last_name) &
+                      (rolling['loinc_num'] == loinc_num)]
+    assert len(rolling) and pd.Timestamp(valid_start_time) not in set(rolling['valid_start_time'])
@@ -0,0 +1,53 @@
+import pandas as pd
+
+from bitemporal_index import DELETED_VALUE
+from database import records_frame
+from result_store import ResultStore
+from validity import ValidityIndex, validity_windows
+
+DAY = pd.Timestamp('2018-05-10')
+WINDOWS = {'11218-5': (pd.DateOffset(days=1), pd.DateOffset(days=2))}
+
+
+def _at(days):
+    return DAY + pd.Timedelta(days=days)
+
+
+# A measurement is in force from its good-before to its good-after time, the latest one first
+def test_value_in_force():
+    index = ValidityIndex(WINDOWS).load(records_frame([
+        ('Eli', 'Call', '11218-5', '5000', 'cells/ml', _at(0), _at(0)),
+        ('Eli', 'Call', '11218-5', '6000', 'cells/ml', _at(10), _at(10)),
+        ('Eli', 'Call', '11218-5', '6500', 'cells/ml', _at(10), _at(11)),
+        ('Eli', 'Call', '11218-5', '7000', 'cells/ml', _at(20), _at(20)),
+        ('Eli', 'Call', '11218-5', DELETED_VALUE, 'cells/ml', _at(20), _at(21)),
+        ('Eli', 'Call', 'other', '1', 'none', _at(0), _at(0)),
+    ]))
+    patient = ('Eli', 'Call')
+    expected = {-2: None, -0.5: '5000', 1.5: '5000', 3: None, 9.5: '6500', 12: '6500', 19.5: None, 22: None}
+    for days, value in expected.items():
+        found = index.value_at(patient, '11218-5', _at(days))
+        assert (found and found['value']) == value, days
+    assert index.value_at(patient, 'other', _at(0)) is None
+
+    queries = pd.DataFrame([('Eli', 'Call', '11218-5', _at(days)) for days in expected] +
+                           [('No', 'Body', '11218-5', _at(0))], columns=['first_name', 'last_name', 'loinc_num', 'time'])
+    values = [value if isinstance(value, str) else None for value in index.values_at(queries)['value']]
+    assert values == list(expected.values()) + [None]
+
+
+# The engine reads only the queried patients, the answer is the one of an index of everyone
+def test_engine_values_in_force(engine):
+    queries = [(first_name, last_name, loinc_num, time)
+               for first_name, last_name in (('Eli', 'Call'), ('Eyal', 'Rothman'), ('No', 'Body'))
+               for loinc_num in ('11218-5', '12181-4', '39106-0')
+               for time in pd.date_range('2018-05-15', '2018-05-30', freq='12h')]
+    frame = pd.DataFrame(queries, columns=['first_name', 'last_name', 'loinc_num', 'time'])
+    for as_of in (None, pd.Timestamp('2018-05-22')):
+        everyone = records_frame(engine.db.query_test_results(loinc_num=['11218-5', '12181-4', '39106-0'],
+                                                              as_of=as_of, latest_only=True))
+        expected = ValidityIndex(validity_windows(engine.kb)).load(everyone).values_at(frame)
+        pd.testing.assert_frame_equal(engine.values_in_force(queries, as_of), expected)
+        engine.store = ResultStore.load(engine.db)
+        pd.testing.assert_frame_equal(engine.values_in_force(queries, as_of), expected)
+        engine.store = None
@@ -0,0 +1,236 @@
+import bisect
+import collections
+import datetime
+import threading
+
+import numpy as np
+import pandas as pd
+
+from bitemporal_index import DELETED_VALUE
+from temporal_abstraction import INTERVAL_COLUMNS, PATIENT_KEYS, latest_versions
+
+
+# Trend settings of the vital signs: (window, stable band). The trend of a reading is the least squares
+# slope of the readings in the window before it (units per hour), a slope within the band is stable.
+TREND_SETTINGS = {
+    '76477-9': (datetime.timedelta(hours=2), 5.0),     # heart rate, BPM per hour
+    '39106-0': (datetime.timedelta(hours=6), 0.2),     # temperature, degrees per hour
+    '2055-2': (datetime.timedelta(hours=4), 5.0),      # blood pressure, mmHg per hour
+    '20252-3': (datetime.timedelta(hours=4), 5.0),     # blood pressure, mmHg per hour
+}
+
+ROLLING_COLUMNS = PATIENT_KEYS + ['loinc_num', 'valid_start_time', 'value', 'window_min', 'window_mean',
+                                  'window_max', 'slope_per_hour', 'trend']
+
+
+def _hours(delta):
+    return delta / datetime.timedelta(hours=1)
+
+
+class SlidingWindow:
+    # Readings of the last window of time, updated in O(1) (amortized) per reading:
+    # running sums for the mean and the least squares slope, monotonic deques for the min and max.
+    # Readings must come in time order.
+    def __init__(self, window):
+        self.window = window
+        self.readings = collections.deque()
+        self.minimums = collections.deque()
+        self.maximums = collections.deque()
+        self.origin = None
+        self.sums = [0.0, 0.0, 0.0, 0.0]    # time, value, time^2, time*value (time in hours from origin)
+
+    def _sum(self, time, value, sign):
+        self.sums[0] += sign * time
+        self.sums[1] += sign * value
+        self.sums[2] += sign * time * time
+        self.sums[3] += sign * time * value
+
+    def add(self, time, value):
+        if self.origin is None:
+            self.origin = time
+        hours = _hours(time - self.origin)
+        self.readings.append((time, hours, value))
+        self._sum(hours, value, 1)
+        while self.minimums and self.minimums[-1][1] >= value:
+            self.minimums.pop()
+        self.minimums.append((time, value))
+        while self.maximums and self.maximums[-1][1] <= value:
+            self.maximums.pop()
+        self.maximums.append((time, value))
+
+        # The window is (time - window, time]
+        start = time - self.window
+        while self.readings[0][0] <= start:
+            _, old_hours, old_value = self.readings.popleft()
+            self._sum(old_hours, old_value, -1)
+        while self.minimums[0][0] <= start:
+            self.minimums.popleft()
+        while self.maximums[0][0] <= start:
+            self.maximums.popleft()
+
+    @property
+    def minimum(self):
+        return self.minimums[0][1]
+
+    @property
+    def maximum(self):
+        return self.maximums[0][1]
+
+    @property
+    def mean(self):
+        return self.sums[1] / len(self.readings)
+
+    # Least squares slope per hour, None with less than two readings
+    @property
+    def slope(self):
+        n = len(self.readings)
+        times, values, squares, products = self.sums
+        denominator = n * squares - times * times
+        if n < 2 or denominator <= 0:
+            return None
+        return (n * products - times * values) / denominator
+
+
+class _TrendSeries:
+    # Readings of one (patient, LOINC): their window, rolling rows and trend intervals.
+    # Readings after the last one are added in O(1), an earlier reading, a correction or a delete
+    # replays the series from its readings.
+    def __init__(self, window, band):
+        self.window = window
+        self.band = band
+        self.times = []
+        self.values = []
+        self._reset()
+
+    def _reset(self):
+        self.sliding = SlidingWindow(self.window)
+        self.rows = []
+        self.intervals = []    # [trend, start_time, end_time, readings]
+
+    def _trend(self, slope):
+        if slope is None:
+            return None
+        if slope > self.band:
+            return 'increasing'
+        if slope < -self.band:
+            return 'decreasing'
+        return 'stable'
+
+    def _append(self, time, value):
+        self.sliding.add(time, value)
+        slope = self.sliding.slope
+        trend = self._trend(slope)
+        row = (time, value, self.sliding.minimum, self.sliding.mean, self.sliding.maximum, slope, trend)
+        self.rows.append(row)
+        if trend is None:
+            return row
+        # Readings of the same trend in a row are one interval, a reading without a trend
+        # (alone in its window) ends the interval before it
+        if len(self.rows) > 1 and self.rows[-2][6] == trend:
+            self.intervals[-1][2] = time
+            self.intervals[-1][3] += 1
+        else:
+            self.intervals.append([trend, time, time, 1])
+        return row
+
+    def add(self, time, value):
+        if value is None:
+            self._remove(time)
+            return None
+        if not self.times or time > self.times[-1]:
+            self.times.append(time)
+            self.values.append(value)
+            return self._append(time, value)
+        i = bisect.bisect_left(self.times, time)
+        if i < len(self.times) and self.times[i] == time:
+            self.values[i] = value
+        else:
+            self.times.insert(i, time)
+            self.values.insert(i, value)
+        self._replay()
+        return self.rows[i]
+
+    def _remove(self, time):
+        i = bisect.bisect_left(self.times, time)
+        if i < len(self.times) and self.times[i] == time:
+            del self.times[i]
+            del self.values[i]
+            self._replay()
+
+    def _replay(self):
+        self._reset()
+        for time, value in zip(self.times, self.values):
+            self._append(time, value)
+
+
+class TrendAbstraction:
+    # Streaming trend abstraction of vital signs: rolling min/mean/max and the increasing / decreasing /
+    # stable trend of every reading, and the intervals of the same trend, kept up to date as readings come.
+    # Other LOINCs and non numeric values are ignored. Thread safe, apply is a PatientData write listener.
+    # settings - LOINC -> (window, stable band per hour), TREND_SETTINGS by default
+    def __init__(self, settings=None):
+        self.settings = TREND_SETTINGS if settings is None else settings
+        self.series = {}
+        self.lock = threading.Lock()
+
+    # Trend abstraction of test_results rows (the latest version of each measurement is used)
+    @classmethod
+    def from_records(cls, measurements, settings=None):
+        abstraction = cls(settings)
+        measurements = latest_versions(measurements[measurements['loinc_num'].isin(list(abstraction.settings))])
+        measurements = measurements.sort_values('valid_start_time', kind='stable')
+        abstraction.apply(measurements[['first_name', 'last_name', 'loinc_num', 'value', 'unit',
+                                        'valid_start_time', 'transaction_time']].itertuples(index=False, name=None))
+        return abstraction
+
+    # Add one reading, returns its rolling row (time, value, min, mean, max, slope, trend) or None.
+    # A reading at the valid time of an earlier one replaces it, value None removes it.
+    def add(self, patient, loinc_num, time, value):
+        settings = self.settings.get(loinc_num)
+        if settings is None:
+            return None
+        if value is not None:
+            value = float(pd.to_numeric(value, errors='coerce'))
+            if np.isnan(value):
+                return None
+        with self.lock:
+            series = self.series.get((patient, loinc_num))
+            if series is None:
+                series = self.series[(patient, loinc_num)] = _TrendSeries(*settings)
+            return series.add(pd.Timestamp(time), value)
+
+    # Add records (RECORD_COLUMNS order), also the PatientData write listener. Deletes remove the reading.
+    def apply(self, records):
+        for first_name, last_name, loinc_num, value, unit, valid_start_time, transaction_time in records:
+            self.add((first_name, last_name), loinc_num, valid_start_time,
+                     None if value == DELETED_VALUE else value)
+
+    # Rolling row of the newest reading of a patient LOINC
+    def current(self, patient, loinc_num):
+        with self.lock:
+            series = self.series.get((patient, loinc_num))
+            return series.rows[-1] if series is not None and series.rows else None
+
+    # Rolling rows of all the readings, with ROLLING_COLUMNS
+    def rolling_table(self):
+        with self.lock:
+            rows = [patient + (loinc_num,) + row for (patient, loinc_num), series in sorted(self.series.items())
+                    for row in series.rows]
+        return pd.DataFrame(rows, columns=ROLLING_COLUMNS)
+
+    # Trend intervals with INTERVAL_COLUMNS (the state is the trend), like temporal_abstraction.build_intervals
+    def interval_table(self):
+        with self.lock:
+            rows = [patient + (loinc_num,) + tuple(interval)
+                    for (patient, loinc_num), series in sorted(self.series.items()) for interval in series.intervals]
+        return pd.DataFrame(rows, columns=INTERVAL_COLUMNS)
+
+    # Intervals of a patient LOINC in the form of PatientData.dictinary_of_time_interval:
+    # {'interval_1': [start_time, end_time], ...}, only the intervals of one trend when given
+    def dictinary_of_time_interval(self, patient, loinc_num, trend=None):
+        with self.lock:
+            series = self.series.get((patient, loinc_num))
+            intervals = [interval for interval in (series.intervals if series is not None else [])
+                         if trend is None or interval[0] == trend]
+        return {f'interval_{i}': [start_time, end_time]
+                for i, (_, start_time, end_time, _) in enumerate(intervals, start=1)}
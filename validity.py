@@ -0,0 +1,136 @@
+import numpy as np
+import pandas as pd
+
+from bitemporal_index import DELETED_VALUE
+from temporal_abstraction import PATIENT_KEYS, latest_versions
+
+
+# Knowledge base good-before/good-after parameter of each concept (LOINC)
+VALIDITY_PARAMS = {
+    '12181-4': 'hemoglobin_level',
+    '30313-1': 'hemoglobin_level',
+    '11218-5': 'wbc_level',
+    '39106-0': 'systemic_toxicity',
+    'chills': 'systemic_toxicity',
+    'skin-look': 'systemic_toxicity',
+    'allergic-state': 'systemic_toxicity',
+}
+
+VALIDITY_COLUMNS = ['value', 'valid_start_time', 'good_from', 'good_until']
+
+
+# (months, weeks, days) of the knowledge base -> calendar offset
+def window_offset(window):
+    months, weeks, days = window
+    return pd.DateOffset(months=months, weeks=weeks, days=days)
+
+
+# LOINC -> (good before offset, good after offset) from the knowledge base windows
+def validity_windows(knowlege_base, params=None):
+    params = VALIDITY_PARAMS if params is None else params
+    windows = {}
+    for loinc_num, param in params.items():
+        good_before, good_after = knowlege_base.get_goodbefore_goodafter(param)
+        windows[loinc_num] = (window_offset(good_before), window_offset(good_after))
+    return windows
+
+
+class _Persistence:
+    # Persistence intervals of one (patient, LOINC), sorted by valid time.
+    # All the intervals of a concept have the same windows, so both endpoints are sorted too.
+    def __init__(self, valid_times, good_from, good_until, values):
+        self.valid_times = valid_times
+        self.good_from = good_from
+        self.good_until = good_until
+        self.values = values
+
+    # Position of the measurement in force at each time, -1 for none.
+    # The latest measurement at or before the time while it is still good,
+    # otherwise the next measurement once it is good (its good-before window).
+    def positions(self, times):
+        before = np.searchsorted(self.valid_times, times, side='right') - 1
+        in_force = np.full(len(times), -1)
+        still_good = (before >= 0) & (self.good_until[np.maximum(before, 0)] >= times)
+        in_force[still_good] = before[still_good]
+        after = before + 1
+        already_good = ~still_good & (after < len(self.valid_times))
+        already_good[already_good] = self.good_from[after[already_good]] <= times[already_good]
+        in_force[already_good] = after[already_good]
+        return in_force
+
+
+class ValidityIndex:
+    # Which value of a concept is in force for a patient at a given time, from the good-before/good-after
+    # windows of the knowledge base: a measurement taken at t is good from t - before until t + after.
+    # Intervals are kept per (patient, LOINC) as sorted endpoint arrays, lookups are binary searches.
+    # windows - LOINC -> (before offset, after offset), see validity_windows
+    def __init__(self, windows):
+        self.windows = windows
+        self.intervals = {}
+
+    # Index test_results records (records_frame), only the latest version of a measurement counts
+    # and deleted measurements are left out. Concepts without windows are skipped.
+    def load(self, measurements):
+        measurements = latest_versions(measurements)
+        measurements = measurements[(measurements['value'] != DELETED_VALUE)
+                                    & measurements['loinc_num'].isin(list(self.windows))]
+        measurements = measurements.sort_values('valid_start_time', kind='stable')
+        for (first_name, last_name, loinc_num), group in measurements.groupby(PATIENT_KEYS + ['loinc_num'], sort=False):
+            good_before, good_after = self.windows[loinc_num]
+            valid_times = pd.DatetimeIndex(group['valid_start_time'])
+            self.intervals[((first_name, last_name), loinc_num)] = _Persistence(
+                valid_times.to_numpy('datetime64[ns]'),
+                (valid_times - good_before).to_numpy('datetime64[ns]'),
+                (valid_times + good_after).to_numpy('datetime64[ns]'),
+                group['value'].to_numpy(dtype=object),
+            )
+        return self
+
+    # Persistence intervals of a patient concept, with VALIDITY_COLUMNS
+    def persistence_intervals(self, patient, loinc_num):
+        intervals = self.intervals.get((patient, loinc_num))
+        if intervals is None:
+            return pd.DataFrame(columns=VALIDITY_COLUMNS)
+        return pd.DataFrame({
+            'value': intervals.values,
+            'valid_start_time': intervals.valid_times,
+            'good_from': intervals.good_from,
+            'good_until': intervals.good_until,
+        })
+
+    # The value in force at time, as a dict with VALIDITY_COLUMNS, None when no value is in force
+    def value_at(self, patient, loinc_num, time):
+        intervals = self.intervals.get((patient, loinc_num))
+        if intervals is None:
+            return None
+        i = intervals.positions(np.array([pd.Timestamp(time).to_datetime64()], dtype='datetime64[ns]'))[0]
+        if i < 0:
+            return None
+        return {
+            'value': intervals.values[i],
+            'valid_start_time': pd.Timestamp(intervals.valid_times[i]),
+            'good_from': pd.Timestamp(intervals.good_from[i]),
+            'good_until': pd.Timestamp(intervals.good_until[i]),
+        }
+
+    # Values in force for many (first_name, last_name, loinc_num, time) rows at once.
+    # Returns the queries (same order) with VALIDITY_COLUMNS added, missing where no value is in force.
+    def values_at(self, queries):
+        queries = queries.reset_index(drop=True)
+        times = pd.to_datetime(queries['time']).to_numpy('datetime64[ns]')
+        values = np.full(len(queries), None, dtype=object)
+        valid_times, good_from, good_until = (np.full(len(queries), np.datetime64('NaT'), dtype='datetime64[ns]')
+                                              for _ in range(3))
+        # One vectorized search per (patient, LOINC) group
+        for (first_name, last_name, loinc_num), positions in queries.groupby(PATIENT_KEYS + ['loinc_num']).indices.items():
+            intervals = self.intervals.get(((first_name, last_name), loinc_num))
+            if intervals is None:
+                continue
+            in_force = intervals.positions(times[positions])
+            found = in_force >= 0
+            positions, in_force = positions[found], in_force[found]
+            values[positions] = intervals.values[in_force]
+            valid_times[positions] = intervals.valid_times[in_force]
+            good_from[positions] = intervals.good_from[in_force]
+            good_until[positions] = intervals.good_until[in_force]
+        return queries.assign(value=values, valid_start_time=valid_times, good_from=good_from, good_until=good_until)